@@ -2,7 +2,20 @@
 # Polyglot Node Server for EnvisaLink EVL 3/4 Device (DSC)
 
 import sys
+import os
+import time
+import random
+import math
+import resource
+import threading
+import collections
+import cProfile
+import pstats
+import tracemalloc
 import envisalinktpi as EVL
+import envisalinkproxy
+import envisalinkprocess
+import envisalinkhistory
 import polyinterface
 
 # contstants for ISY Nodeserver interface
@@ -10,6 +23,8 @@ _ISY_BOOL_UOM = 2 # Used for reporting status values for Controller node
 _ISY_INDEX_UOM = 25 # Index UOM for custom states (must match editor/NLS in profile):
 _ISY_USER_NUM_UOM = 70 # User Number UOM for reporting last user number
 _ISY_SECONDS_UOM = 58 # used for reporting duration in seconds
+_ISY_RAW_UOM = 56 # used for reporting counts
+_ISY_MILLISECONDS_UOM = 42 # used for reporting latency
 
 _LOGGER = polyinterface.LOGGER
 
@@ -24,6 +39,19 @@ _PARM_NUM_PARTITIONS_NAME = "numpartitions"
 _PARM_NUM_ZONES_NAME = "numzones"
 _PARM_NUM_CMD_OUTS_NAME = "numcmdouts"
 _PARM_DISABLE_WATCHDOG_TIMER = "disablewatchdog"
+_PARM_WATCHDOG_INTERVAL = "watchdoginterval"
+_PARM_BYPASS_DUMP_INTERVAL = "bypassdumpinterval"
+_PARM_ZONE_TIMER_DUMP_INTERVAL = "zonetimerdumpinterval"
+_PARM_PROXY_PORT = "proxyport"
+_PARM_PROXY_BIND_ADDRESS = "proxybindaddress"
+_PARM_PROFILE_SECONDS = "profileseconds"
+_PARM_READER_PROCESS = "readerprocess"
+_PARM_ZONE_DEBOUNCE = "zonedebounce"
+_PARM_HISTORY_DB = "historydb"
+_PARM_MASTER_CODE = "mastercode"
+_PARM_INSTALLER_CODE = "installercode"
+_PARM_TRACE_SAMPLE = "tracesample"
+_PARM_REQUEST_FRESHNESS = "requestfreshness"
 
 _DEFAULT_IP_ADDRESS = "0.0.0.0"
 _DEFAULT_PASSWORD = "user"
@@ -31,14 +59,75 @@ _DEFAULT_USER_CODE = "5555"
 _DEFAULT_NUM_PARTITIONS = 1
 _DEFAULT_NUM_ZONES = 16
 _DEFAULT_NUM_CMDOUTS = 4
+_DEFAULT_PROXY_BIND_ADDRESS = "127.0.0.1"
+_DEFAULT_SHORT_POLL = 30
+_DEFAULT_LONG_POLL = 600
 
 # values for zonetimerdumpflag in custom configuration'
 _PARM_ZONE_TIMER_DUMP_FLAG = "zonetimerdumpflag"
 _ZONE_TIMER_DUMP_DISABLED = 0
 _ZONE_TIMER_DUMP_SHORTPOLL = 1
 _ZONE_TIMER_DUMP_LONGPOLL = 2
+_ZONE_TIMER_DUMP_ADAPTIVE = 3
 _DEFAULT_ZONE_TIMER_DUMP_FLAG = _ZONE_TIMER_DUMP_SHORTPOLL
 
+# key for storing the learned zone/partition membership in custom data
+_CUSTOM_DATA_ZONE_PARTITIONS = "zonepartitions"
+
+# value of the number of zones parameter for discovering the zones from the panel traffic, and the key for storing
+# the discovered zones in custom data
+_ZONE_DISCOVERY_AUTO = "auto"
+_CUSTOM_DATA_DISCOVERED_ZONES = "discoveredzones"
+
+# zone timer (in seconds) of a zone with no activity (saturated countdown), e.g., a zone not used by the panel
+_ZONE_TIMER_INACTIVE = 0xFFFF * 5
+
+# time window (in seconds) for correlating a zone opening or closing with a partition ready state change
+_MEMBERSHIP_CORRELATION_WINDOW = 2.0
+
+# time window (in seconds) for coalescing zone bypass requests into a single keypad macro
+_BYPASS_COALESCE_WINDOW = 1.0
+
+# default file name for the history database (in the nodeserver folder)
+_DEFAULT_HISTORY_DB = "history.db"
+
+# bitmask of all the keypad LEDs (reported as changed for the first LED state received)
+_ALL_LEDS = 0xFF
+
+# timer wheel settings for the zone debouncing - tick (in seconds) and number of slots
+_TIMER_WHEEL_TICK = 0.1
+_TIMER_WHEEL_SLOTS = 64
+
+# retry intervals for the connection manager (in seconds) - doubles after each failure up to max
+_CONNECT_RETRY_MIN_INTERVAL = 5
+_CONNECT_RETRY_MAX_INTERVAL = 60
+
+# time to defer a scheduled task (in seconds) if it can't be run because of the connection or panel state
+_TASK_DEFER_INTERVAL = 1.0
+
+# liveness check of the EnvisaLink connection: if nothing has been received from the EnvisaLink for the idle time, a
+# poll is sent, and if the poll isn't answered, the connection is dropped to reconnect (or fail over to the next
+# endpoint) - a dead connection is detected within about the idle time plus the check interval
+_LIVENESS_CHECK_INTERVAL = 15.0
+_LIVENESS_IDLE_TIME = 30.0
+
+# interval to check whether Polyglot is available again to report the node updates held while it was unavailable
+_HELD_UPDATES_FLUSH_INTERVAL = 5.0
+
+# commands from the nodes (e.g., alarms and zone open/close) that are held in order while Polyglot is unavailable
+# NOTE: other commands (e.g., heartbeats) are meaningless once late and are dropped
+_HELD_CMDS = ("DON", "DOF")
+
+# settings for profiling sessions
+_PROFILE_TRACEMALLOC_FRAMES = 10 # number of stack frames stored for each allocation
+_PROFILE_TOP_ALLOCATIONS = 50 # number of allocation sites in the report
+_PROFILE_FINISH_TIMEOUT = 5.0 # time to wait for profiled calls in progress to finish (in seconds)
+
+# settings for latency tracing
+_TRACE_RING_SIZE = 200 # number of recent traces kept for the dump
+_TRACE_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 25.0, 50.0, 100.0, 250.0, 500.0, 1000.0) # histogram bucket limits (in milliseconds)
+_TRACE_STAGES = ("receive", "process", "publish", "first update", "total")
+
 # constants from nodeserver profile
 _IX_ALARM_STATE_OK = 0
 _IX_ALARM_STATE_SMOKE = 1
@@ -63,12 +152,914 @@ _IX_PARTITION_STATE_DELAY_ENTRY = 8
 _IX_COMMAND_STATE_OFF = 0
 _IX_COMMAND_STATE_ACTIVE = 1
 
+_IX_DUMP_MODE_DISABLED = 0
+_IX_DUMP_MODE_FIXED = 1
+_IX_DUMP_MODE_ACTIVE = 2
+_IX_DUMP_MODE_IDLE = 3
+_IX_DUMP_MODE_SUSPENDED = 4
+
+# Parse a task interval configuration value in the form "period[,jitter]" (in seconds)
+# Returns a tuple with the period and jitter, using the default period (and no jitter) if the value is missing or invalid
+def parse_interval(value, defaultPeriod):
+
+    try:
+        parts = str(value).split(",")
+        period = float(parts[0])
+        jitter = float(parts[1]) if len(parts) > 1 else 0.0
+    except (ValueError, TypeError):
+        return (float(defaultPeriod), 0.0)
+
+    if period <= 0 or jitter < 0:
+        return (float(defaultPeriod), 0.0)
+
+    return (period, min(jitter, period))
+
+# Parse a zone debounce parameter value of the form "<seconds>[,<zone>:<seconds>...]" with a default hold-off window
+# for all zones and optional windows for specific zones
+# Returns:  tuple of the default window and a dictionary of zone number to window (in seconds)
+def parse_zone_windows(value):
+
+    defaultWindow = 0.0
+    windows = {}
+
+    if value is None:
+        return (defaultWindow, windows)
+
+    try:
+        for part in str(value).split(","):
+            if ":" in part:
+                (zone, window) = part.split(":", 1)
+                windows[int(zone)] = max(float(window), 0.0)
+            elif part.strip():
+                defaultWindow = max(float(part), 0.0)
+    except ValueError:
+        _LOGGER.warning("Invalid value for the '%s' parameter: %s. Zone debouncing disabled.", _PARM_ZONE_DEBOUNCE, value)
+        return (0.0, {})
+
+    return (defaultWindow, windows)
+
+# Check that a data field received from the EnvisaLink is a number (decimal or, with base 16, hex digits only)
+def valid_number(field, base=10):
+
+    digits = "0123456789" if base == 10 else "0123456789ABCDEFabcdef"
+    return len(field) > 0 and all(c in digits for c in field)
+
+# Indexes of zone state flags counted per partition
+_ZONE_FLAG_OPEN = 0
+_ZONE_FLAG_BYPASSED = 1
+_ZONE_FLAG_ALARMING = 2
+
+# Indexes of zone trouble flags counted for the panel
+_ZONE_TROUBLE_TAMPER = 0
+_ZONE_TROUBLE_FAULT = 1
+_MAX_ZONES = 64
+
+# Learned partition/zone membership index with incremental per-partition counts of open, bypassed, and alarming zones
+class PartitionZoneIndex(object):
+
+    def __init__(self):
+        self._zonePartitions = {} # zone number -> set of partition numbers
+        self._zoneFlags = {} # zone number -> [open, bypassed, alarming]
+        self._counts = {} # partition number -> [open, bypassed, alarming] zone counts
+
+    # Load the membership from a dictionary (e.g., from custom data) of zone number strings to lists of partitions
+    def load(self, membership):
+
+        for (zone, parts) in membership.items():
+            for part in parts:
+                self.add_member(int(zone), int(part))
+
+    # Get the membership as a dictionary of zone number strings to lists of partitions (e.g., for custom data)
+    def save(self):
+        return {str(zone): sorted(parts) for (zone, parts) in self._zonePartitions.items()}
+
+    # Get the set of partitions the zone is a member of
+    def partitions(self, zone):
+        return self._zonePartitions.get(zone, ())
+
+    # Get the open, bypassed, and alarming zone counts for the partition
+    def counts(self, part):
+        return self._counts.get(part, [0, 0, 0])
+
+    # Add a zone to a partition - returns True if the membership is new
+    def add_member(self, zone, part):
+
+        parts = self._zonePartitions.setdefault(zone, set())
+        if part in parts:
+            return False
+
+        parts.add(part)
+
+        # add the current state of the zone to the partition counts
+        flags = self._zoneFlags.get(zone)
+        counts = self._counts.setdefault(part, [0, 0, 0])
+        if flags is not None:
+            for i in range(len(counts)):
+                counts[i] += flags[i]
+
+        return True
+
+    # Set a state flag for a zone - returns the partitions for which the counts changed
+    def set_flag(self, zone, flag, value):
+
+        flags = self._zoneFlags.setdefault(zone, [0, 0, 0])
+        value = 1 if value else 0
+        if flags[flag] == value:
+            return ()
+
+        delta = value - flags[flag]
+        flags[flag] = value
+
+        parts = self._zonePartitions.get(zone, ())
+        for part in parts:
+            self._counts.setdefault(part, [0, 0, 0])[flag] += delta
+
+        return parts
+
+# Cached keypad LED state for a partition
+# The steady and flashing LED bitmasks are combined into the lit LEDs, and only the LEDs that changed (XOR against the
+# cached bitmask) are returned for processing
+class KeypadLEDState(object):
+
+    def __init__(self):
+        self.steady = 0
+        self.flashing = 0
+        self.lit = None # unknown until the first LED state is received
+
+    # Update the steady or flashing LED bitmask - returns the bitmask of lit LEDs that changed
+    def update(self, leds, flashing):
+
+        if flashing:
+            self.flashing = leds
+        else:
+            self.steady = leds
+
+        lit = self.steady | self.flashing
+        changed = _ALL_LEDS if self.lit is None else lit ^ self.lit
+        self.lit = lit
+
+        return changed
+
+# Adaptive rate policy for zone timer dumps
+# Dumps at the minimum interval after zone activity, doubles the interval (up to the maximum) after each dump with
+# no intervening zone activity, and suspends dumps while a partition is armed or in alarm
+class AdaptiveDumpPolicy(object):
+
+    def __init__(self, minInterval, maxInterval):
+        self.minInterval = minInterval
+        self.maxInterval = max(minInterval, maxInterval)
+        self.interval = minInterval
+        self.mode = _IX_DUMP_MODE_ACTIVE
+        self._activity = False
+
+    # Note zone activity - returns True if the interval was shortened
+    def zone_activity(self):
+
+        self._activity = True
+        if self.mode == _IX_DUMP_MODE_SUSPENDED or self.interval == self.minInterval:
+            return False
+
+        self.interval = self.minInterval
+        self.mode = _IX_DUMP_MODE_ACTIVE
+        return True
+
+    # Update the interval after a dump (or suspend dumps if armed) - returns True if a dump should be performed
+    def next_dump(self, armed):
+
+        if armed:
+            self.interval = self.minInterval
+            self.mode = _IX_DUMP_MODE_SUSPENDED
+            return False
+
+        # if the dumps were suspended, dump right away at the minimum interval
+        if self.mode == _IX_DUMP_MODE_SUSPENDED or self._activity:
+            self.interval = self.minInterval
+            self.mode = _IX_DUMP_MODE_ACTIVE
+        else:
+            self.interval = min(self.interval * 2, self.maxInterval)
+            self.mode = _IX_DUMP_MODE_IDLE
+
+        self._activity = False
+        return True
+
+# Periodic maintenance task run by the task scheduler
+class ScheduledTask(object):
+
+    def __init__(self, name, func, period, jitter=0.0, needsConnection=True):
+        self.name = name
+        self.func = func
+        self.period = period
+        self.jitter = jitter
+        self.needsConnection = needsConnection
+        self.nextRun = 0.0
+
+    # Set the next run time from the period and a random jitter
+    def schedule_next(self, now):
+        self.nextRun = now + max(self.period + random.uniform(-self.jitter, self.jitter), 0.0)
+
+# Scheduler for periodic maintenance tasks, each with its own period and jitter, run on a seperate thread
+# The canRunCallback is called with the task before the task is run and, if it returns False, the task is deferred
+class TaskScheduler(object):
+
+    def __init__(self, canRunCallback=None):
+        self._tasks = {}
+        self._cond = threading.Condition(threading.RLock())
+        self._thread = None
+        self._stopping = False
+        self._canRun = canRunCallback
+
+    # Add a task to the scheduler (first run is after initialDelay seconds, or after one period if not specified)
+    def add_task(self, name, func, period, jitter=0.0, needsConnection=True, initialDelay=None):
+
+        task = ScheduledTask(name, func, period, jitter, needsConnection)
+        with self._cond:
+            if initialDelay is None:
+                task.schedule_next(time.monotonic())
+            else:
+                task.nextRun = time.monotonic() + initialDelay
+            self._tasks[name] = task
+            self._cond.notify()
+
+        return task
+
+    # Remove a task from the scheduler
+    def remove_task(self, name):
+        with self._cond:
+            self._tasks.pop(name, None)
+            self._cond.notify()
+
+    # Change the period (and optionally jitter) of a task and reschedule it
+    def set_period(self, name, period, jitter=None):
+        with self._cond:
+            task = self._tasks.get(name)
+            if task is not None:
+                task.period = period
+                if jitter is not None:
+                    task.jitter = jitter
+                task.schedule_next(time.monotonic())
+                self._cond.notify()
+
+    # Get the task for the specified name (or None if no such task)
+    def get_task(self, name):
+        return self._tasks.get(name)
+
+    # Start the scheduler thread
+    def start(self):
+
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name="Scheduler")
+        self._thread.daemon = True
+        self._thread.start()
+
+    # Stop the scheduler thread
+    def stop(self):
+
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+
+        if self._thread is not None:
+            self._thread.join(2.0)
+
+    # Scheduler loop - to be executed on seperate, non-blocking thread
+    def _run(self):
+
+        with self._cond:
+            while not self._stopping:
+
+                now = time.monotonic()
+                for task in list(self._tasks.values()):
+
+                    # skip a task that isn't due (or was removed while another task ran)
+                    if task.nextRun > now or self._tasks.get(task.name) is not task:
+                        continue
+
+                    # defer the task if it can't be run right now
+                    if self._canRun is not None and not self._canRun(task):
+                        task.nextRun = now + _TASK_DEFER_INTERVAL
+                        continue
+
+                    # run the task without holding the lock, so that tasks can be changed from other threads (e.g.,
+                    # the listener thread adjusting the period for zone activity) while it runs
+                    self._cond.release()
+                    try:
+                        task.func()
+                    except Exception:
+                        _LOGGER.exception("Error running scheduled task %s.", task.name)
+                    finally:
+                        self._cond.acquire()
+
+                    task.schedule_next(time.monotonic())
+
+                # wait until the next task is due (or until a task is added or changed)
+                if self._tasks:
+                    timeout = max(min(t.nextRun for t in self._tasks.values()) - time.monotonic(), 0.0)
+                else:
+                    timeout = None
+                self._cond.wait(timeout)
+
+
+# Hashed timer wheel for many short timers, e.g., the zone debounce windows - timers are put in the slot for the tick
+# they expire on and a single thread advances the wheel one tick at a time (only while there are timers), so adding a
+# timer costs a list append rather than a thread
+class TimerWheel(object):
+
+    def __init__(self, tick=_TIMER_WHEEL_TICK, slots=_TIMER_WHEEL_SLOTS):
+        self._tick = tick
+        self._slots = [[] for i in range(slots)]
+        self._cond = threading.Condition()
+        self._count = 0
+        self._currentTick = 0
+        self._baseTime = 0.0
+        self._thread = None
+        self._stopping = False
+
+    # Add a timer that calls the function with the arguments (on the wheel thread) after the delay (in seconds)
+    def add(self, delay, func, *args):
+
+        with self._cond:
+
+            # restart the tick count from now if the wheel is idle
+            if self._count == 0:
+                self._baseTime = time.monotonic()
+                self._currentTick = 0
+
+            expiry = self._currentTick + max(int(math.ceil(delay / self._tick)), 1)
+            self._slots[expiry % len(self._slots)].append((expiry, func, args))
+            self._count += 1
+            self._cond.notify()
+
+    # Start the wheel thread
+    def start(self):
+
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name="TimerWheel")
+        self._thread.daemon = True
+        self._thread.start()
+
+    # Stop the wheel thread (pending timers are dropped)
+    def stop(self):
+
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+
+        if self._thread is not None:
+            self._thread.join(2.0)
+
+    # Wheel loop - to be executed on seperate, non-blocking thread
+    def _run(self):
+
+        while True:
+
+            with self._cond:
+
+                # sleep until there are timers
+                while self._count == 0 and not self._stopping:
+                    self._cond.wait()
+                if self._stopping:
+                    return
+
+                # wait for the next tick
+                timeout = self._baseTime + (self._currentTick + 1) * self._tick - time.monotonic()
+                if timeout > 0:
+                    self._cond.wait(timeout)
+                    continue
+
+                # take the expired timers from the slot for the tick (timers for later rounds stay in the slot)
+                self._currentTick += 1
+                slot = self._slots[self._currentTick % len(self._slots)]
+                expired = [timer for timer in slot if timer[0] <= self._currentTick]
+                if expired:
+                    slot[:] = [timer for timer in slot if timer[0] > self._currentTick]
+                    self._count -= len(expired)
+
+            for (expiry, func, args) in expired:
+                try:
+                    func(*args)
+                except Exception:
+                    _LOGGER.exception("Error running timer.")
+
+# Debouncing of zone open and closed events with a hold-off window for each zone
+# The first change after a quiet period is passed through right away, further changes within the window are
+# suppressed, and when the window expires the settled state is passed through if it differs from the last one passed
+# through (starting a new window)
+class ZoneDebouncer(object):
+
+    def __init__(self, wheel, passCallback):
+        self._wheel = wheel
+        self._pass = passCallback
+        self._lock = threading.Lock()
+        self._zones = {} # zone number -> [last command passed, latest command, latest data] while window active
+        self.defaultWindow = 0.0
+        self.windows = {}
+        self.suppressed = 0
+
+    # Set the default hold-off window and the windows for specific zones (in seconds)
+    def configure(self, defaultWindow, windows):
+        self.defaultWindow = defaultWindow
+        self.windows = windows
+
+    # Get the hold-off window for the zone (in seconds)
+    def window(self, zoneNum):
+        return self.windows.get(zoneNum, self.defaultWindow)
+
+    # Process a zone open or closed event (called on the listener thread)
+    def process(self, zoneNum, cmd, data):
+
+        window = self.window(zoneNum)
+        with self._lock:
+
+            # suppress the event if the hold-off window for the zone is active, keeping the latest state
+            state = self._zones.get(zoneNum)
+            if state is not None:
+                state[1] = cmd
+                state[2] = data
+                self.suppressed += 1
+                return
+
+            if window > 0:
+                self._zones[zoneNum] = [cmd, cmd, data]
+                self._wheel.add(window, self._expire, zoneNum)
+
+        self._pass(zoneNum, cmd, data)
+
+    # End the hold-off window for the zone (called on the wheel thread)
+    def _expire(self, zoneNum):
+
+        with self._lock:
+
+            state = self._zones.get(zoneNum)
+            if state is None:
+                return
+
+            # end the window if the zone settled back in the state last passed through
+            if state[1] == state[0]:
+                del self._zones[zoneNum]
+                return
+
+            # otherwise pass the settled state through and start a new window
+            state[0] = state[1]
+            (cmd, data) = (state[1], state[2])
+            self._wheel.add(self.window(zoneNum), self._expire, zoneNum)
+
+        self._pass(zoneNum, cmd, data)
+
+# Profiling session that collects CPU profiles (cProfile) for the calls run through it on each thread and samples
+# memory allocations (tracemalloc) for the duration, then writes a pstats file and a top allocations report
+class ProfileSession(object):
+
+    def __init__(self, duration, outputDir, doneCallback=None):
+        self.duration = duration
+        self.active = False
+        self._outputDir = outputDir
+        self._doneCallback = doneCallback
+        self._profiles = {} # thread ident -> cProfile.Profile
+        self._running = 0
+        self._cond = threading.Condition()
+
+    # Start the profiling session and the timer to finish it
+    def start(self):
+
+        tracemalloc.start(_PROFILE_TRACEMALLOC_FRAMES)
+        self.active = True
+
+        timer = threading.Timer(self.duration, self.finish)
+        timer.daemon = True
+        timer.start()
+
+    # Run the function, profiling it in the CPU profile for the current thread if the session is active
+    def runcall(self, func, *args):
+
+        with self._cond:
+            active = self.active
+            if active:
+                profile = self._profiles.get(threading.get_ident())
+                if profile is None:
+                    profile = cProfile.Profile()
+                    self._profiles[threading.get_ident()] = profile
+                self._running += 1
+
+        if not active:
+            return func(*args)
+
+        try:
+
+            # newer Python versions only allow one active profiler at a time, so run the function unprofiled
+            # if another thread's profile is active
+            try:
+                profile.enable()
+            except ValueError:
+                profile = None
+
+            try:
+                return func(*args)
+            finally:
+                if profile is not None:
+                    profile.disable()
+
+        finally:
+            with self._cond:
+                self._running -= 1
+                self._cond.notify_all()
+
+    # Finish the profiling session and write the reports - returns the list of files written
+    def finish(self):
+
+        with self._cond:
+            if not self.active:
+                return []
+            self.active = False
+
+            # wait for the profiled calls in progress
+            self._cond.wait_for(lambda: self._running == 0, _PROFILE_FINISH_TIMEOUT)
+            profiles = list(self._profiles.values())
+
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+
+        baseName = os.path.join(self._outputDir, time.strftime("profile_%Y%m%d_%H%M%S"))
+        files = []
+
+        try:
+
+            # combine the CPU profiles of all the threads into one pstats file
+            stats = None
+            for profile in profiles:
+                try:
+                    if stats is None:
+                        stats = pstats.Stats(profile)
+                    else:
+                        stats.add(profile)
+                except TypeError:
+                    pass # profile never collected any calls
+
+            if stats is not None:
+                stats.dump_stats(baseName + ".pstats")
+                files.append(baseName + ".pstats")
+
+            # write the top allocation sites
+            with open(baseName + "_alloc.txt", "w") as f:
+                f.write("Top %d allocations by line after %d seconds:\n" % (_PROFILE_TOP_ALLOCATIONS, self.duration))
+                for stat in snapshot.statistics("lineno")[:_PROFILE_TOP_ALLOCATIONS]:
+                    f.write("%s\n" % stat)
+            files.append(baseName + "_alloc.txt")
+
+        except OSError as e:
+            _LOGGER.error("Unable to write profiling results to %s: %s", self._outputDir, str(e))
+
+        if self._doneCallback is not None:
+            self._doneCallback(files)
+
+        return files
+
+# Latency tracer for a sample of the events from the EnvisaLink
+# Each sampled event is timed from when its frame was received from the EnvisaLink, through the dispatching and
+# processing in the nodeserver, to the node updates published to Polyglot. The stage times are added to histograms and
+# the most recent traces are kept in a ring buffer for the dump.
+#   receive - frame received to dispatched to the nodeserver (event listeners, proxy, and reader process hand-off)
+#   process - time in the nodeserver processing the event, excluding the publishing
+#   publish - time publishing the node updates to Polyglot (setDriver and reportCmd)
+#   first update - frame received to the first node update published
+#   total - frame received to the processing of the event finished
+class LatencyTracer(object):
+
+    def __init__(self):
+        self.sampleRate = 0 # trace every Nth event (0 for disabled)
+        self._count = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._traces = collections.deque(maxlen=_TRACE_RING_SIZE)
+        self._histograms = dict((stage, [0] * (len(_TRACE_BUCKETS) + 1)) for stage in _TRACE_STAGES)
+        self._totals = dict.fromkeys(_TRACE_STAGES, 0.0)
+        self._maximums = dict.fromkeys(_TRACE_STAGES, 0.0)
+        self._startTime = time.time()
+        self.traced = 0
+
+    # Check whether the next event should be traced - called on the listener thread only
+    # NOTE: the sample rate is read once, since it may be changed (e.g., to 0) on the configuration thread
+    def sample(self):
+
+        rate = self.sampleRate
+        if not rate:
+            return False
+
+        self._count += 1
+        return self._count % rate == 0
+
+    # Run the function processing the event, tracing the node updates published by it on this thread
+    def trace(self, frameTime, cmd, data, func, *args):
+
+        dispatchTime = time.monotonic()
+        trace = self._local.trace = [None, 0.0, 0] # time of first update published, time publishing, number of updates
+
+        try:
+            return func(*args)
+
+        finally:
+            endTime = time.monotonic()
+            self._local.trace = None
+
+            (firstUpdate, publish, updates) = trace
+            self.record(cmd, data, updates, (
+                dispatchTime - frameTime,
+                endTime - dispatchTime - publish,
+                publish,
+                (firstUpdate if firstUpdate is not None else endTime) - frameTime,
+                endTime - frameTime
+            ))
+
+    # Publish a node update, timing it if an event is being traced on this thread
+    def publish(self, func, *args):
 
+        trace = getattr(self._local, "trace", None)
+        if trace is None:
+            return func(*args)
+
+        startTime = time.monotonic()
+        try:
+            return func(*args)
+        finally:
+            endTime = time.monotonic()
+            if trace[0] is None:
+                trace[0] = endTime
+            trace[1] += endTime - startTime
+            trace[2] += 1
+
+    # Add the stage times (in seconds) of a traced event to the histograms and the ring buffer
+    def record(self, cmd, data, updates, times):
+
+        times = [t * 1000.0 for t in times]
+
+        with self._lock:
+            for (stage, t) in zip(_TRACE_STAGES, times):
+                bucket = 0
+                while bucket < len(_TRACE_BUCKETS) and t > _TRACE_BUCKETS[bucket]:
+                    bucket += 1
+                self._histograms[stage][bucket] += 1
+                self._totals[stage] += t
+                self._maximums[stage] = max(self._maximums[stage], t)
+
+            self._traces.append((time.time(), cmd, data, updates, times))
+            self.traced += 1
+
+    # Write the histograms and the recent traces to a text file in the output directory - returns the file name
+    def dump(self, outputDir):
+
+        fileName = os.path.join(outputDir, time.strftime("trace_%Y%m%d_%H%M%S.txt"))
+
+        with self._lock:
+            traces = list(self._traces)
+            histograms = dict((stage, list(counts)) for (stage, counts) in self._histograms.items())
+            totals = dict(self._totals)
+            maximums = dict(self._maximums)
+            traced = self.traced
+
+        with open(fileName, "w") as f:
+
+            f.write("Latency traces: %d events traced since %s (sample rate %s)\n\n" % (
+                traced,
+                time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(self._startTime)),
+                "1 in %d" % self.sampleRate if self.sampleRate > 0 else "disabled"
+            ))
+
+            # stage histograms with the event counts for each bucket
+            f.write("%-12s %8s %8s" % ("stage (ms)", "mean", "max"))
+            for limit in _TRACE_BUCKETS:
+                f.write(" %7s" % ("<=%g" % limit))
+            f.write(" %7s\n" % (">%g" % _TRACE_BUCKETS[-1]))
+            for stage in _TRACE_STAGES:
+                f.write("%-12s %8.3f %8.3f" % (stage, totals[stage] / traced if traced else 0.0, maximums[stage]))
+                for count in histograms[stage]:
+                    f.write(" %7d" % count)
+                f.write("\n")
+
+            # most recent traces last
+            f.write("\nRecent traces (ms):\n")
+            f.write("%-15s %-3s %-16s %7s" % ("time", "cmd", "data", "updates"))
+            for stage in _TRACE_STAGES:
+                f.write(" %12s" % stage)
+            f.write("\n")
+            for (timestamp, cmd, data, updates, times) in traces:
+                f.write("%-15s %-3s %-16s %7d" % (
+                    time.strftime("%H:%M:%S", time.localtime(timestamp)) + ".%03d" % (timestamp % 1 * 1000),
+                    cmd.decode("ascii"),
+                    data[:16],
+                    updates
+                ))
+                for t in times:
+                    f.write(" %12.3f" % t)
+                f.write("\n")
+
+        return fileName
+
+# Get the directory of the nodeserver log files
+def get_log_dir():
+
+    for handler in _LOGGER.handlers:
+        if hasattr(handler, "baseFilename"):
+            return os.path.dirname(handler.baseFilename)
+
+    return os.getcwd()
+
+# Get the resident memory (RSS) of the nodeserver process (in KB)
+# Uses the current RSS from /proc on Linux, otherwise the peak RSS
+def get_memory_usage():
+
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * resource.getpagesize() // 1024
+    except (OSError, ValueError, IndexError):
+        peakRSS = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peakRSS // 1024 if sys.platform == "darwin" else peakRSS # bytes on macOS
+
+# Mixin for nodes to run the commands from the ISY through the controller's profiling session (if active)
+class ProfiledCommandsNode(object):
+
+    def runCmd(self, command):
+        self.controller.run_profiled(super(ProfiledCommandsNode, self).runCmd, command)
+
+# Check whether the nodeserver's connection to Polyglot (through the MQTT broker) is available for reporting
+def polyglot_available(poly):
+    return poly.connected and getattr(poly, "polyglotConnected", True)
+
+# Central store for the driver values of all the nodes
+# Driver values are set through the store by one writer at a time (listener thread or Polyglot thread). Each change
+# publishes a new snapshot dictionary of (address, driver) -> value that is never modified afterwards, so readers get
+# a consistent view of the whole panel without locking.
+# While Polyglot is unavailable, the reporting of driver changes and commands is held in an outbound buffer: the
+# latest value of each node driver (from the snapshot) and the last DON and DOF of each node in order. The held updates
+# are reported in bulk once Polyglot is available again, so the buffer is bounded by the number of nodes rather than
+# the length of the outage.
+class StateStore(object):
+
+    def __init__(self):
+        self._writeLock = threading.Lock()
+        self._snapshot = {}
+        self._refreshTime = 0.0
+        self.history = None # HistoryWriter for recording transitions of the history drivers of the nodes
+        self.tracer = None # LatencyTracer for timing the node updates of traced events (None when tracing is disabled)
+        self._heldDrivers = {} # (address, driver) -> (node, force) of the driver changes held while Polyglot is unavailable
+        self._heldCmds = collections.OrderedDict() # (address, command) -> (node, value, uom) of the held commands, in order
+
+    # Set the driver value for a node and record it in a new snapshot
+    def set_driver(self, node, driver, value, report=True, force=False, uom=None):
+
+        with self._writeLock:
+            snapshot = dict(self._snapshot)
+            previous = snapshot.get((node.address, driver))
+            snapshot[(node.address, driver)] = value
+            self._snapshot = snapshot
+
+            # record the transition in the history database
+            # NOTE: the first value set after a (re)start is not a transition, since the previous value is unknown
+            if self.history is not None and driver in node.historyDrivers and previous is not None and value != previous:
+                self.history.record(time.time(), node.address, driver, value)
+
+            # hold the report while Polyglot is unavailable, updating only the node's driver list
+            if not polyglot_available(node.controller.poly):
+                polyinterface.Node.setDriver(node, driver, value, False, force, uom)
+                if report:
+                    self._hold_driver(node, driver, force)
+                return
+
+            # report the held updates first, so that the updates are reported in order
+            if self._heldDrivers or self._heldCmds:
+                self._flush()
+
+            # update (and report) the driver value of the node while holding the lock so that updates to the node's
+            # driver list and the reporting to Polyglot are serialized as well
+            if self.tracer is None:
+                polyinterface.Node.setDriver(node, driver, value, report, force, uom)
+            else:
+                self.tracer.publish(polyinterface.Node.setDriver, node, driver, value, report, force, uom)
+
+    # Report a command from the node to Polyglot
+    def report_cmd(self, node, command, value=None, uom=None):
+
+        with self._writeLock:
+
+            # hold the command while Polyglot is unavailable, keeping only the last of each command for each node
+            if not polyglot_available(node.controller.poly):
+                if command in _HELD_CMDS:
+                    self._log_held()
+                    self._heldCmds.pop((node.address, command), None)
+                    self._heldCmds[(node.address, command)] = (node, value, uom)
+                return
+
+            if self._heldDrivers or self._heldCmds:
+                self._flush()
+
+            if self.tracer is None:
+                polyinterface.Node.reportCmd(node, command, value, uom)
+            else:
+                self.tracer.publish(polyinterface.Node.reportCmd, node, command, value, uom)
+
+    # Hold the report of a driver change until Polyglot is available (called with the write lock held)
+    def _hold_driver(self, node, driver, force):
+
+        self._log_held()
+        held = self._heldDrivers.get((node.address, driver))
+        self._heldDrivers[(node.address, driver)] = (node, force or (held is not None and held[1]))
+
+    # Log the start of holding updates (called with the write lock held)
+    def _log_held(self):
+        if not self._heldDrivers and not self._heldCmds:
+            _LOGGER.warning("Polyglot is not available. Holding node updates until it is available again.")
+
+    # Report the held updates if Polyglot is available again
+    def flush(self, poly):
+
+        with self._writeLock:
+            if (self._heldDrivers or self._heldCmds) and polyglot_available(poly):
+                self._flush()
+
+    # Report the held driver values and then the held commands in order (called with the write lock held)
+    def _flush(self):
+
+        heldDrivers = self._heldDrivers
+        heldCmds = self._heldCmds
+        self._heldDrivers = {}
+        self._heldCmds = collections.OrderedDict()
+
+        _LOGGER.info("Polyglot is available. Reporting %d held driver values and %d held commands.", len(heldDrivers), len(heldCmds))
+
+        # the driver values are reported from the node's driver list, which has the latest value, and only if different
+        # from the value last reported (unless forced)
+        for ((address, driver), (node, force)) in heldDrivers.items():
+            if node.controller.nodes.get(address) is not node:
+                continue # node was deleted
+            for d in node.drivers:
+                if d["driver"] == driver:
+                    polyinterface.Node.reportDriver(node, d, True, force)
+                    break
+
+        for ((address, command), (node, value, uom)) in heldCmds.items():
+            if node.controller.nodes.get(address) is node:
+                polyinterface.Node.reportCmd(node, command, value, uom)
+
+    # Get the current snapshot of driver values - must not be modified by the caller
+    def snapshot(self):
+        return self._snapshot
+
+    # Report all the driver values of the node to Polyglot from the current snapshot
+    def report_drivers(self, node):
+
+        # hold the report of all the drivers while Polyglot is unavailable
+        if not polyglot_available(node.controller.poly):
+            with self._writeLock:
+                for driver in node.drivers:
+                    self._hold_driver(node, driver["driver"], True)
+            return
+
+        self.flush(node.controller.poly)
+
+        snapshot = self._snapshot
+        for driver in node.drivers:
+            node.controller.poly.send({
+                "status": {
+                    "address": node.address,
+                    "driver": driver["driver"],
+                    "value": str(snapshot.get((node.address, driver["driver"]), driver["value"])),
+                    "uom": driver["uom"]
+                }
+            })
+
+    # Mark the snapshot as refreshed from a full status report from the panel
+    def refreshed(self):
+        self._refreshTime = time.time()
+
+    # Mark the snapshot as stale, e.g., when the connection to the panel is lost
+    def invalidate(self):
+        self._refreshTime = 0.0
+
+    # Get the time since the snapshot was last refreshed from a full status report (in seconds)
+    def age(self):
+        return time.time() - self._refreshTime
+
+# Mixin for nodes to set and report driver values through the controller's state store
+class StoredStateNode(object):
+
+    # drivers for which transitions are recorded in the history database
+    historyDrivers = ()
+
+    # Set the driver value through the state store
+    def setDriver(self, driver, value, report=True, force=False, uom=None):
+        self.controller.state.set_driver(self, driver, value, report, force, uom)
+
+    # Report the driver values from the state store snapshot
+    def reportDrivers(self):
+        self.controller.state.report_drivers(self)
+
+    # Report the command through the state store
+    def reportCmd(self, command, value=None, uom=None):
+        self.controller.state.report_cmd(self, command, value, uom)
 
 # Node class for partitions
-class Partition(polyinterface.Node):
+class Partition(StoredStateNode, ProfiledCommandsNode, polyinterface.Node):
 
     id = "PARTITION"
+    historyDrivers = ("ST", "GV1")
 
     # Override init to handle partition number
     def __init__(self, controller, primary, partNum):
@@ -76,6 +1067,7 @@ class Partition(polyinterface.Node):
         self.partitionNum = partNum
         self.initialBypassZoneDump = False
         self.readyState = False
+        self.armedState = False
 
     # Update the driver values based on the command received from the EnvisaLink for the partition
     def update_state_values(self, cmd, data):
@@ -85,11 +1077,13 @@ class Partition(polyinterface.Node):
             self.setDriver("ST", _IX_PARTITION_STATE_READY) # Ready
 
             self.readyState = True
+            self.armedState = False
 
         elif cmd == EVL.CMD_PARTITION_NOT_READY:
             self.setDriver("ST", _IX_PARTITION_STATE_NOT_READY) # Not Ready
 
             self.readyState = False
+            self.armedState = False
 
         elif cmd == EVL.CMD_PARTITION_ARMED:
 
@@ -105,6 +1099,7 @@ class Partition(polyinterface.Node):
                 self.setDriver("ST", _IX_PARTITION_STATE_ARMED_STAY_ZE)
 
             self.readyState = False
+            self.armedState = True
             
         elif cmd == EVL.CMD_PARTITION_IN_ALARM:
 
@@ -115,12 +1110,15 @@ class Partition(polyinterface.Node):
             self.setDriver("ST", _IX_PARTITION_STATE_ALARMING)
 
             self.readyState = False
+            self.armedState = True
 
         elif cmd == EVL.CMD_PARTITION_DISARMED:
             
             # send a DOF commmand when the partition is disarmed
             self.reportCmd("DOF")
 
+            self.armedState = False
+
         elif cmd == EVL.CMD_EXIT_DELAY_IN_PROGRESS:
             self.setDriver("ST", _IX_PARTITION_STATE_DELAY_EXIT) 
 
@@ -143,9 +1141,40 @@ class Partition(polyinterface.Node):
             self.setDriver("GV1", 0)
 
         elif cmd in (EVL.CMD_USER_CLOSING, EVL.CMD_USER_OPENING):
+            if not valid_number(data[-4:]):
+                _LOGGER.warning("Invalid user number received from EnvisaLink. Data: %s", data)
+                return
             userNum = int(data[-4:])
             self.setDriver("GV1", userNum)
 
+    # Update the driver values from the lit keypad LEDs that changed
+    def update_led_state(self, lit, changed):
+
+        if changed & EVL.LED_READY:
+            self.readyState = bool(lit & EVL.LED_READY)
+
+        # the armed state suspends the adaptive zone timer dumps
+        if changed & EVL.LED_ARMED:
+            self.armedState = bool(lit & EVL.LED_ARMED)
+
+        # refresh the zone bypass states when the bypass LED changes (e.g., zones bypassed from a keypad), except for
+        # the first LED state (all LEDs changed) and while the partition isn't ready, since the bypass keystrokes
+        # would change the arming of an armed partition
+        if changed & EVL.LED_BYPASS and changed != _ALL_LEDS and self.readyState:
+            self.controller.request_bypass_dump(self.partitionNum)
+
+        if changed & EVL.LED_MEMORY:
+            self.setDriver("GV5", 1 if lit & EVL.LED_MEMORY else 0)
+
+        if changed & EVL.LED_TROUBLE:
+            self.setDriver("GV6", 1 if lit & EVL.LED_TROUBLE else 0)
+
+    # Update the open, bypassed, and alarming zone counts for the partition
+    def set_zone_counts(self, counts):
+        self.setDriver("GV2", counts[_ZONE_FLAG_OPEN])
+        self.setDriver("GV3", counts[_ZONE_FLAG_BYPASSED])
+        self.setDriver("GV4", counts[_ZONE_FLAG_ALARMING])
+
     # Arm the partition in Away mode (the listener thread will update the corresponding driver values)
     def arm_away(self, command):
 
@@ -204,7 +1233,12 @@ class Partition(polyinterface.Node):
     drivers = [
         {"driver": "ST", "value": 0, "uom": _ISY_INDEX_UOM},
         {"driver": "GV0", "value": 0, "uom": _ISY_BOOL_UOM},
-        {"driver": "GV1", "value": 0, "uom": _ISY_USER_NUM_UOM}
+        {"driver": "GV1", "value": 0, "uom": _ISY_USER_NUM_UOM},
+        {"driver": "GV2", "value": 0, "uom": _ISY_RAW_UOM},
+        {"driver": "GV3", "value": 0, "uom": _ISY_RAW_UOM},
+        {"driver": "GV4", "value": 0, "uom": _ISY_RAW_UOM},
+        {"driver": "GV5", "value": 0, "uom": _ISY_BOOL_UOM},
+        {"driver": "GV6", "value": 0, "uom": _ISY_BOOL_UOM}
     ]
     commands = {
         "DISARM": disarm,
@@ -215,9 +1249,10 @@ class Partition(polyinterface.Node):
     }
 
 # Node class for zones
-class Zone(polyinterface.Node):
+class Zone(StoredStateNode, ProfiledCommandsNode, polyinterface.Node):
 
     id = "ZONE"
+    historyDrivers = ("ST", "GV0")
 
     # Override init to handle partition number
     def __init__(self, controller, primary, zoneNum):
@@ -234,6 +1269,7 @@ class Zone(polyinterface.Node):
             self.reportCmd("DOF")
 
             self.setDriver("ST", _IX_ZONE_STATE_CLOSED) 
+            self.controller.update_zone_flag(self.zoneNum, _ZONE_FLAG_OPEN, False)
 
         elif cmd == EVL.CMD_ZONE_OPEN:
 
@@ -243,32 +1279,61 @@ class Zone(polyinterface.Node):
             # update the driver value and preset the zone timer to zero (will be updated on next short poll)
             self.setDriver("ST", _IX_ZONE_STATE_OPEN) 
             self.setDriver("GV1", 0)
+            self.controller.update_zone_flag(self.zoneNum, _ZONE_FLAG_OPEN, True)
 
         elif cmd == EVL.CMD_ZONE_ALARM:
             self.setDriver("ST", _IX_ZONE_STATE_ALARMING)
+            self.controller.update_zone_flag(self.zoneNum, _ZONE_FLAG_ALARMING, True)
 
         elif cmd == EVL.CMD_ZONE_ALARM_RESTORED:
             self.setDriver("ST", _IX_ZONE_STATE_CLOSED)
+            self.controller.update_zone_flag(self.zoneNum, _ZONE_FLAG_ALARMING, False)
+
+    # Set the tamper or fault driver value
+    def set_trouble(self, trouble, value):
+        if trouble == _ZONE_TROUBLE_TAMPER:
+            self.setDriver("GV2", value)
+        else:
+            self.setDriver("GV3", value)
 
     # Set the bypasse driver value
     def set_bypass(self, bypass):
         self.setDriver("GV0", bypass)
+        self.controller.update_zone_flag(self.zoneNum, _ZONE_FLAG_BYPASSED, bypass)
 
     # Set the zone timer driver value
     def set_timer(self, time):
         self.setDriver("GV1", time)
+
+    # Bypass the zone (the listener thread will update the corresponding driver value)
+    def cmd_bypass(self, command):
+
+        _LOGGER.info("Bypassing zone %d in cmd_bypass()...", self.zoneNum)
+        self.controller.request_zone_bypass(self.zoneNum, True)
+
+    # Clear the bypass of the zone (the listener thread will update the corresponding driver value)
+    def cmd_unbypass(self, command):
+
+        _LOGGER.info("Clearing bypass of zone %d in cmd_unbypass()...", self.zoneNum)
+        self.controller.request_zone_bypass(self.zoneNum, False)
         
     drivers = [
         {"driver": "ST", "value": 0, "uom": _ISY_INDEX_UOM},
         {"driver": "GV0", "value": 0, "uom": _ISY_BOOL_UOM},
         {"driver": "GV1", "value": 327675, "uom": _ISY_SECONDS_UOM},
+        {"driver": "GV2", "value": 0, "uom": _ISY_BOOL_UOM},
+        {"driver": "GV3", "value": 0, "uom": _ISY_BOOL_UOM}
     ]
-    commands = {}
+    commands = {
+        "BYPASS": cmd_bypass,
+        "UNBYPASS": cmd_unbypass
+    }
 
 # Node class for zones
-class CommandOutput(polyinterface.Node):
+class CommandOutput(StoredStateNode, ProfiledCommandsNode, polyinterface.Node):
 
     id = "COMMAND_OUTPUT"
+    historyDrivers = ("ST",)
 
     # Override init to handle partition number
     def __init__(self, controller, primary, cmdOutNum):
@@ -306,9 +1371,10 @@ class CommandOutput(polyinterface.Node):
     }
 
 # Node class for controller
-class AlarmPanel(polyinterface.Controller):
+class AlarmPanel(StoredStateNode, ProfiledCommandsNode, polyinterface.Controller):
 
     id = "CONTROLLER"
+    historyDrivers = ("GV1",)
 
     def __init__(self, poly):
         super(AlarmPanel, self).__init__(poly)
@@ -317,10 +1383,46 @@ class AlarmPanel(polyinterface.Controller):
         self.name = "Alarm Panel"
         self.envisalink = None
         self.userCode = ""
+        self.masterCode = ""
+        self.installerCode = ""
         self.numPartitions = 0
+        self._connectThread = None
+        self.endpoints = []
+        self.activeEndpoint = None
+        self._connectFailed = False
+        self._disconnectTime = None
+        self._connectEvent = threading.Event()
+        self._stopping = False
+        self.scheduler = None
+        self.zoneTimerDumpPolicy = None
+        self.proxy = None
+        self.zonePartitions = PartitionZoneIndex()
+        self.state = StateStore()
+        self.longPollInterval = _DEFAULT_LONG_POLL
+        self.profileSession = None
+        self.tracer = LatencyTracer()
+        self._bypassDumpPartition = None
+        self._lastZoneChange = None
+        self._bypassRequests = {}
+        self._bypassLock = threading.Lock()
+        self.keypadLEDs = {}
+        self.timerWheel = TimerWheel()
+        self.historyPath = None
+        self.zoneDiscovery = False
+        self.discoveredZones = set()
+        self.zoneDebouncer = ZoneDebouncer(self.timerWheel, self.process_zone_change)
+        self.zoneTroubles = (bytearray(_MAX_ZONES + 1), bytearray(_MAX_ZONES + 1)) # tamper and fault flags by zone number
+        self.zoneTroubleCounts = [0, 0]
+        self._started = False
+        self._appliedConfig = None
+        self._processLock = threading.RLock() # serializes node and configuration changes with processing panel commands
+        self._configChanged = False
+
+        # apply changes to the configuration while running
+        self.poly.onConfig(self.process_config)
 
     # Create nodes for zones, partitions, and command outputs as specified by the parameters
-    def build_nodes(self, numPartitions, numZones, numCmdOuts):
+    def build_nodes(self, numPartitions, numCmdOuts):
 
         # create partition nodes for the number of partitions specified
         for i in range(0, numPartitions):
@@ -328,17 +1430,175 @@ class AlarmPanel(polyinterface.Controller):
             # create a partition node and add it to the node list
             self.addNode(Partition(self, self.address, i+1))
 
-        # create zone nodes for the number of partitions specified
-        for i in range(0, numZones):
+        # load the zones discovered from the panel traffic from custom data
+        discoveredZones = self.getCustomData(_CUSTOM_DATA_DISCOVERED_ZONES)
+        if discoveredZones is not None:
+            self.discoveredZones = set(int(zoneNum) for zoneNum in discoveredZones)
+
+        # create zone nodes for the number of zones specified (or the discovered zones)
+        for zoneNum in self.configured_zones():
             
-            # create a partition node and add it to the node list
-            self.addNode(Zone(self, self.address, i+1))
+            # create a zone node and add it to the node list
+            self.addNode(Zone(self, self.address, zoneNum))
 
         # create command output nodes for the number of command outputs specified
         for i in range(0, numCmdOuts):
             
             # create a command output node and add it to the node list
             self.addNode(CommandOutput(self, self.address, i+1))
+
+        # load the learned zone membership of the partitions from custom data
+        membership = self.getCustomData(_CUSTOM_DATA_ZONE_PARTITIONS)
+        if membership is not None:
+            self.zonePartitions.load(membership)
+
+        # with a single partition, all zones are known to be in partition 1
+        if numPartitions == 1:
+            for i in range(0, self.numZones):
+                self.zonePartitions.add_member(i+1, 1)
+
+    # Add and remove nodes for changes in the number of zones, partitions, and command outputs in the parameters
+    def update_nodes(self, oldPartitions, oldCmdOuts):
+
+        # remove the nodes beyond the new counts
+        for i in range(self.numPartitions, oldPartitions):
+            self.delNode(_PART_ADDR_FORMAT_STRING % (i+1))
+        for i in range(self.numCmdOuts, oldCmdOuts):
+            self.delNode(_CMD_OUTPUT_ADDR_FORMAT_STRING % (i+1))
+
+        # add the nodes for the new counts
+        for i in range(oldPartitions, self.numPartitions):
+            self.addNode(Partition(self, self.address, i+1))
+        for i in range(oldCmdOuts, self.numCmdOuts):
+            self.addNode(CommandOutput(self, self.address, i+1))
+
+        # add and remove zone nodes for the configured (or discovered) zones
+        zones = set(self.configured_zones())
+        for zoneNum in range(1, _MAX_ZONES + 1):
+            address = _ZONE_ADDR_FORMAT_STRING % zoneNum
+            if address in self.nodes and zoneNum not in zones:
+                self.delNode(address)
+            elif address not in self.nodes and zoneNum in zones:
+                self.addNode(Zone(self, self.address, zoneNum))
+                if self.numPartitions == 1:
+                    self.zonePartitions.add_member(zoneNum, 1)
+
+        # update the zone counts for the partitions with the added zones
+        for partition in self.partition_nodes():
+            self.update_zone_counts(partition.partitionNum)
+
+    # Get the zone numbers to create zone nodes for - the discovered zones in zone discovery mode, otherwise the
+    # configured number of zones
+    def configured_zones(self):
+        if self.zoneDiscovery:
+            return sorted(self.discoveredZones)
+        return range(1, self.numZones + 1)
+
+    # Create zone nodes for zones found in the traffic from the panel (in zone discovery mode) and store the
+    # discovered zones
+    # NOTE: called on the listener thread while processing a command, i.e., under the process lock
+    def discover_zones(self, zoneNums):
+
+        if not self.zoneDiscovery:
+            return
+
+        newZones = [zoneNum for zoneNum in zoneNums if 1 <= zoneNum <= _MAX_ZONES and zoneNum not in self.discoveredZones]
+        if not newZones:
+            return
+
+        for zoneNum in newZones:
+            _LOGGER.info("Discovered zone %d.", zoneNum)
+            self.discoveredZones.add(zoneNum)
+            self.addNode(Zone(self, self.address, zoneNum))
+
+        self.addCustomData(_CUSTOM_DATA_DISCOVERED_ZONES, sorted(self.discoveredZones))
+        self.saveCustomData(self._customData)
+
+    # Get the partition nodes
+    def partition_nodes(self):
+        nodes = [self.nodes.get(_PART_ADDR_FORMAT_STRING % (i+1)) for i in range(self.numPartitions)]
+        return [node for node in nodes if node is not None]
+
+    # Get the zone nodes
+    def zone_nodes(self):
+        nodes = [self.nodes.get(_ZONE_ADDR_FORMAT_STRING % (i+1)) for i in range(self.numZones)]
+        return [node for node in nodes if node is not None]
+
+    # Add a zone to a partition in the membership index and store the membership if it is new
+    def learn_zone_partition(self, zoneNum, partNum):
+
+        if self.zonePartitions.add_member(zoneNum, partNum):
+
+            _LOGGER.info("Learned zone %d is in partition %d.", zoneNum, partNum)
+
+            self.update_zone_counts(partNum)
+            self.addCustomData(_CUSTOM_DATA_ZONE_PARTITIONS, self.zonePartitions.save())
+            self.saveCustomData(self._customData)
+
+    # Update a state flag for a zone and the zone counts of the partitions the zone is in
+    def update_zone_flag(self, zoneNum, flag, value):
+        for partNum in self.zonePartitions.set_flag(zoneNum, flag, value):
+            self.update_zone_counts(partNum)
+
+    # Request the bypass of a zone be set or cleared - requests made within the coalescing window are sent together
+    # as a single keypad macro for each partition
+    def request_zone_bypass(self, zoneNum, bypass):
+
+        # bypass the zone through the first partition it is known to be in
+        parts = self.zonePartitions.partitions(zoneNum)
+        partNum = min(parts) if parts else 1
+
+        with self._bypassLock:
+            requests = self._bypassRequests.get(partNum)
+            if requests is None:
+                requests = self._bypassRequests[partNum] = {}
+                timer = threading.Timer(_BYPASS_COALESCE_WINDOW, self.send_zone_bypass, [partNum])
+                timer.daemon = True
+                timer.start()
+
+            # a later request for the same zone replaces an earlier one
+            requests[zoneNum] = bypass
+
+    # Send the coalesced zone bypass requests for the partition
+    def send_zone_bypass(self, partNum):
+
+        with self._bypassLock:
+            requests = self._bypassRequests.pop(partNum, {})
+
+        # the keypad bypass menu toggles the bypass, so only include the zones not already in the requested state
+        snapshot = self.state.snapshot()
+        zones = [zoneNum for (zoneNum, bypass) in requests.items()
+                 if bool(snapshot.get((_ZONE_ADDR_FORMAT_STRING % zoneNum, "GV0"), 0)) != bypass]
+        if not zones:
+            return
+
+        envisalink = self.envisalink
+
+        # refresh the zone bypass state when the macro completes
+        def doneCallback(success, sent, total):
+            if success:
+                _LOGGER.info("Bypass of zones %s toggled for partition %d.", zones, partNum)
+            else:
+                _LOGGER.warning("Bypass of zones %s for partition %d failed after %d of %d commands.", zones, partNum, sent, total)
+            self._bypassDumpPartition = partNum
+            envisalink.send_command(EVL.CMD_SEND_KEYSTROKES, "%1d%s" % (partNum, EVL.KEYS_DUMP_BYPASS_ZONES))
+
+        if envisalink is None or not envisalink.send_macro(EVL.KeypadMacro().bypass_zones(partNum, zones), doneCallback):
+            _LOGGER.warning("Call to EnvisaLink to bypass zones %s failed for partition %d.", zones, partNum)
+
+    # Request a zone bypass dump for the partition through the keypad
+    def request_bypass_dump(self, partNum):
+
+        envisalink = self.envisalink
+        if envisalink is not None:
+            self._bypassDumpPartition = partNum
+            envisalink.send_command(EVL.CMD_SEND_KEYSTROKES, "%1d%s" % (partNum, EVL.KEYS_DUMP_BYPASS_ZONES))
+
+    # Report the zone counts for the partition to the partition node
+    def update_zone_counts(self, partNum):
+        partition = self.nodes.get(_PART_ADDR_FORMAT_STRING % partNum)
+        if partition is not None:
+            partition.set_zone_counts(self.zonePartitions.counts(partNum))
             
     # Update the driver values based on the command received from the EnvisaLink for the partition
     def update_state_values(self, cmd, data):
@@ -414,6 +1674,11 @@ class AlarmPanel(polyinterface.Controller):
         # update trouble state values from the trouble LED states
         elif cmd == EVL.CMD_VERBOSE_TROUBLE_STATUS:
             
+            # check for a complete trouble bitfield
+            if len(data) != 2 or not valid_number(data, 16):
+                _LOGGER.warning("Invalid verbose trouble status received from EnvisaLink. Data: %s", data)
+                return
+
             # convert the hex value string in the data to a numeric value
             bitfield = int(data,base=16) 
 
@@ -434,16 +1699,52 @@ class AlarmPanel(polyinterface.Controller):
                 self.setDriver("GV11", 1) # set GV11 (Zone Sensor Low Battery)
 
         # clear all trouble states if trouble LED for partition 1 is turned off
-        elif cmd == EVL.CMD_TROUBLE_LED_OFF and int(data[:1]) == 1:
-        
-            self.setDriver("GV4", 0) # Bell Trouble
-            self.setDriver("GV5", 0) # Battery Trouble
-            self.setDriver("GV6", 0) # AC Trouble
-            self.setDriver("GV7", 0) # FTC Trouble
-            self.setDriver("GV8", 0) # Tamper Trouble
-            self.setDriver("GV9", 0) # Fire Trouble
-            self.setDriver("GV10", 0) # Zone Fault
-            self.setDriver("GV11", 0) # Zone Sensor Low Battery
+        elif cmd == EVL.CMD_TROUBLE_LED_OFF and data[:1] == "1":
+            self.clear_trouble_states()
+
+    # Clear all the trouble states (other than zone tampers and faults that haven't been restored)
+    def clear_trouble_states(self):
+
+        self.setDriver("GV4", 0) # Bell Trouble
+        self.setDriver("GV5", 0) # Battery Trouble
+        self.setDriver("GV6", 0) # AC Trouble
+        self.setDriver("GV7", 0) # FTC Trouble
+        self.setDriver("GV8", 1 if self.zoneTroubleCounts[_ZONE_TROUBLE_TAMPER] else 0) # Tamper Trouble
+        self.setDriver("GV9", 0) # Fire Trouble
+        self.setDriver("GV10", 1 if self.zoneTroubleCounts[_ZONE_TROUBLE_FAULT] else 0) # Zone Fault
+        self.setDriver("GV11", 0) # Zone Sensor Low Battery
+
+    # Update the tamper or fault flag for a zone and the counts of zones in tamper and fault for the panel
+    def update_zone_trouble(self, zoneNum, trouble, value):
+
+        if zoneNum < 1 or zoneNum > _MAX_ZONES or self.zoneTroubles[trouble][zoneNum] == value:
+            return
+
+        self.zoneTroubles[trouble][zoneNum] = value
+        self.zoneTroubleCounts[trouble] += 1 if value else -1
+        count = self.zoneTroubleCounts[trouble]
+
+        zone = self.nodes.get(_ZONE_ADDR_FORMAT_STRING % zoneNum)
+        if zone is not None:
+            zone.set_trouble(trouble, value)
+
+        if trouble == _ZONE_TROUBLE_TAMPER:
+            self.setDriver("GV17", count) # Zones in Tamper
+
+            # set the tamper trouble flag with the first zone tamper (cleared with the trouble LED)
+            if count == 1 and value:
+                self.setDriver("GV8", 1)
+
+        else:
+            self.setDriver("GV18", count) # Zones in Fault
+
+            # set the zone fault flag with the first zone fault (cleared with the trouble LED)
+            if count == 1 and value:
+                self.setDriver("GV10", 1)
+
+        # report the zone with the latest tamper or fault
+        if value:
+            self.setDriver("GV19", zoneNum)
 
     # Trigger the panic fire alarm (the listener thread will update the corresponding driver values)
     def trigger_panic_fire(self, command):
@@ -503,24 +1804,86 @@ class AlarmPanel(polyinterface.Controller):
         # update the state driver to the level set
         self.setDriver("GV20", value)
         
-    def cmd_query(self):
+    # Profile the nodeserver for the number of seconds specified
+    def cmd_profile(self, command):
 
-        # Force EnvisaLink to report all statuses available for reporting
+        _LOGGER.info("Starting profiling session in cmd_profile(): %s", str(command))
 
-        # check for existing EnvisaLink connection
-        if self.envisalink is None or not self.envisalink.connected():
+        # retrieve the parameter value for the command
+        self.start_profiling(int(command.get("value")))
 
-            # Update the alarm panel connected status
-            self.setDriver("GV1", 1, True, True)
+    # Start a profiling session for the listener and command threads
+    def start_profiling(self, duration):
 
-            # send the status polling command to the EnvisaLink device
-            self.envisalink.send_command(EVL.CMD_STATUS_REPORT)
+        if self.profileSession is not None and self.profileSession.active:
+            _LOGGER.warning("Profiling session already in progress.")
+            return
+
+        self.profileSession = ProfileSession(duration, get_log_dir(), self.profiling_done)
+        self.profileSession.start()
+
+        # update the profiling driver value
+        self.setDriver("GV14", 1)
+
+    # Callback function for the end of the profiling session
+    def profiling_done(self, files):
+
+        _LOGGER.info("Profiling session finished. Results written to: %s", ", ".join(files))
+
+        # update the profiling driver value
+        self.setDriver("GV14", 0)
+
+    # Write the latency histograms and recent traces to the nodeserver's logs folder
+    def cmd_trace_dump(self, command=None):
+
+        if self.tracer.sampleRate == 0:
+            _LOGGER.warning("Latency tracing is not enabled. Set the '%s' parameter to trace events.", _PARM_TRACE_SAMPLE)
+
+        try:
+            fileName = self.tracer.dump(get_log_dir())
+        except OSError as e:
+            _LOGGER.error("Unable to write latency traces: %s", str(e))
+            return
 
+        _LOGGER.info("Latency traces for %d events written to: %s", self.tracer.traced, fileName)
 
+    # Run the function in the profiling session (if active)
+    def run_profiled(self, func, *args):
+
+        profileSession = self.profileSession
+        if profileSession is None:
+            return func(*args)
         else:
+            return profileSession.runcall(func, *args)
 
-            # Update the alarm panel connected status
-            self.setDriver("GV1", 0, True, True)
+    # Report the state of all the nodes from the state store, refreshing the state from the panel only if stale
+    def cmd_query(self, command=None):
+
+        # check for existing EnvisaLink connection
+        connected = self.envisalink is not None and self.envisalink.connected()
+
+        # Update the alarm panel connected status
+        self.setDriver("GV1", 1 if connected else 0, True, True)
+
+        # report the driver values of all the nodes from the current snapshot
+        # NOTE: iterates over a copy of the nodes, since nodes may be added or removed on other threads
+        for node in list(self.nodes.values()):
+            node.reportDrivers()
+
+        # if the snapshot hasn't been refreshed since the connection was established (or in the long poll interval),
+        # force EnvisaLink to report all statuses available for reporting
+        if connected and self.state.age() > self.longPollInterval:
+            self.request_status_report()
+
+    # Send the status polling command to the EnvisaLink device, marking the state store as refreshed when acknowledged
+    # Only generates general zone status and trouble LED on keypad
+    def request_status_report(self):
+
+        def ackCallback(cmd, respCmd, respData):
+            if respCmd == EVL.CMD_ACK:
+                self.state.refreshed()
+
+        self.envisalink.send_command(EVL.CMD_STATUS_REPORT, ackCallback=ackCallback)
 
     # Start the nodeserver
     def start(self):
@@ -549,11 +1912,23 @@ class AlarmPanel(polyinterface.Controller):
         else:
 
             #  setup the nodes based on the counts of zones and partition in the configuration parameters
-            self.build_nodes(self.numPartitions, self.numZones, self.numCmdOuts)
+            self.build_nodes(self.numPartitions, self.numCmdOuts)
+
+            # start the scheduler for periodic maintenance tasks
+            self.start_scheduler()
+
+            # start the timer wheel for the zone debouncing
+            self.timerWheel.start()
 
-            # setting up the interface moved to shortpoll so that it is retried if initial attempt to connection fails
-            # NOTE: this is for, e.g., startup after power failure where Polyglot may restart faster than network or
-            # EnvisaLink
+            # start recording the state transitions in the history database if configured
+            self.configure_history()
+
+            # start latency tracing if configured
+            self.configure_tracing()
+
+            # start the TPI proxy for other clients to share the EnvisaLink connection
+            if self.proxyPort > 0:
+                self.start_proxy()
 
         # Set the nodeserver status flag to indicate nodeserver is running
         self.setDriver("ST", 1, True, True)
@@ -563,9 +1938,47 @@ class AlarmPanel(polyinterface.Controller):
 
         # Report the logger level to the ISY
         self.setDriver("GV20", _LOGGER.level, True, True)
+
+        # start profiling from startup if configured
+        if self.profileSeconds > 0:
+            self.start_profiling(self.profileSeconds)
+
+        # apply subsequent configuration changes while running
+        self._appliedConfig = self.get_config_values()
+        self._started = True
+
+        # start the connection manager to connect to the EnvisaLink right away in the background
+        # NOTE: the connection manager retries on its own schedule if the initial connection attempt fails, e.g.,
+        # for startup after power failure where Polyglot may restart faster than network or EnvisaLink
+        self.start_connection_manager()
                        
     # Called when the nodeserver is stopped
     def stop(self):
+
+        # stop the connection manager so it doesn't reconnect
+        self._stopping = True
+        self._connectEvent.set()
+        if self._connectThread is not None:
+            self._connectThread.join(2.0)
+
+        # stop the maintenance task scheduler
+        if self.scheduler is not None:
+            self.scheduler.stop()
+
+        # stop the timer wheel for the zone debouncing
+        self.timerWheel.stop()
+
+        # write the remaining state transitions to the history database
+        if self.state.history is not None:
+            self.state.history.stop()
+
+        # finish any profiling session in progress
+        if self.profileSession is not None:
+            self.profileSession.finish()
+
+        # stop the TPI proxy and disconnect the proxy clients
+        if self.proxy is not None:
+            self.proxy.stop()
         
         # shudtown the connection to the EnvisaLink device
         if not self.envisalink is None:
@@ -580,76 +1993,460 @@ class AlarmPanel(polyinterface.Controller):
         
         
     # called every long_poll seconds
+    # NOTE: periodic maintenance is run by the task scheduler with its own intervals
     def longPoll(self):
-
-        # if the EVL's watchdog timer is to be disabled, send a poll command to reset the timer
-        # NOTE: this prevents the EnvisaLink from resetting the connection if it can't communicate with EyezON service
-        if self.disableWDTimer and self.envisalink is not None and self.envisalink.connected():
-            self.envisalink.send_command(EVL.CMD_POLL)
-            
-        # if connection and all partitions have had zone bypass dumps, check zone timer dump flag
-        # and force a zone timer dump
-        if self.zoneTimerDumpFlag == _ZONE_TIMER_DUMP_LONGPOLL:
-            self.envisalink.send_command(EVL.CMD_DUMP_ZONE_TIMERS)
+        pass
 
     # called every short_poll seconds
+    # NOTE: periodic maintenance is run by the task scheduler with its own intervals
     def shortPoll(self):
+        pass
 
-        # check for existing EnvisaLink connection
-        if self.envisalink is None or not self.envisalink.connected():
+    # Setup the maintenance tasks from the configuration parameters and start the task scheduler
+    def start_scheduler(self):
+
+        self.scheduler = TaskScheduler(self._task_can_run)
+
+        # make sure the bypass zones are dumped for each partition shortly after the connection is established
+        self.scheduler.add_task("bypassdump", self.task_bypass_dump, *self.bypassDumpInterval, initialDelay=_TASK_DEFER_INTERVAL)
+
+        # periodically report the receive buffer and memory footprint of the nodeserver
+        self.scheduler.add_task("memory", self.task_memory_report, self.longPollInterval, needsConnection=False, initialDelay=_TASK_DEFER_INTERVAL)
+
+        # check that the connection to the EnvisaLink is still alive, so a dead endpoint is failed over from quickly
+        self.scheduler.add_task("liveness", self.task_liveness_check, _LIVENESS_CHECK_INTERVAL)
+
+        # report the node updates held while Polyglot was unavailable as soon as it is available again
+        self.scheduler.add_task("heldupdates", self.task_flush_held_updates, _HELD_UPDATES_FLUSH_INTERVAL, needsConnection=False)
+
+        self.configure_watchdog_task()
+        self.configure_zone_timer_dump_task()
+
+        self.scheduler.start()
+
+    # Add or remove the watchdog timer reset task based on the configuration parameters
+    def configure_watchdog_task(self):
+
+        # if the EVL's watchdog timer is to be disabled, send a periodic poll command to reset the timer
+        if self.disableWDTimer:
+            self.scheduler.add_task("watchdog", self.task_watchdog_poll, *self.watchdogInterval)
+        else:
+            self.scheduler.remove_task("watchdog")
+
+    # Add or remove the zone timer dump task based on the configuration parameters
+    def configure_zone_timer_dump_task(self):
 
-            # Setup the interface to the EnvisaLink device and connect (starts the listener thread)
-            self.envisalink = EVL.EnvisaLinkInterface(_LOGGER)
+        # if the zone timer dumps are enabled, periodically force a zone timer dump
+        if self.zoneTimerDumpFlag == _ZONE_TIMER_DUMP_ADAPTIVE:
             
-            _LOGGER.info("Establishing connection to EnvisaLink device...")
+            # adapt the interval between the zone timer dump interval and the long poll interval
+            self.zoneTimerDumpPolicy = AdaptiveDumpPolicy(self.zoneTimerDumpInterval[0], self.longPollInterval)
+            self.scheduler.add_task("zonetimerdump", self.task_zone_timer_dump, *self.zoneTimerDumpInterval)
+            self.report_zone_timer_dump_rate(self.zoneTimerDumpPolicy.interval, self.zoneTimerDumpPolicy.mode)
 
-            if self.envisalink.connect(self.ip, self.password, self.process_command, self.process_heartbeat):
+        elif self.zoneTimerDumpFlag != _ZONE_TIMER_DUMP_DISABLED:
+            self.zoneTimerDumpPolicy = None
+            self.scheduler.add_task("zonetimerdump", self.task_zone_timer_dump, *self.zoneTimerDumpInterval)
+            self.report_zone_timer_dump_rate(self.zoneTimerDumpInterval[0], _IX_DUMP_MODE_FIXED)
 
-                # clear any prior connection failure notices
-                self.removeNotice("no_connect")
+        else:
+            self.zoneTimerDumpPolicy = None
+            self.scheduler.remove_task("zonetimerdump")
+            self.report_zone_timer_dump_rate(0, _IX_DUMP_MODE_DISABLED)
+
+    # Check whether a scheduled task can be run - don't run tasks while disconnected, while a command is waiting
+    # to be acknowledged, or while the panel is busy
+    def _task_can_run(self, task):
+
+        if self.envisalink is None or not self.envisalink.connected():
+            return not task.needsConnection
+
+        return not (self.envisalink.command_pending() or self.envisalink.panel_busy())
+
+    # Start (or stop) recording the state transitions in the history database for the configured path
+    def configure_history(self):
+
+        if self.state.history is not None:
+            self.state.history.stop()
+            self.state.history = None
+
+        if self.historyPath is None:
+            return
+
+        history = envisalinkhistory.HistoryWriter(self.historyPath, _LOGGER)
+        try:
+            history.start()
+        except Exception as e:
+            _LOGGER.error("Unable to open history database %s: %s", self.historyPath, str(e))
+            return
+
+        _LOGGER.info("Recording state transitions in history database %s.", self.historyPath)
+        self.state.history = history
+
+    # Set the sample rate for latency tracing of the events from the EnvisaLink
+    def configure_tracing(self):
+
+        if self.traceSample == self.tracer.sampleRate:
+            return
+
+        if self.traceSample > 0:
+            _LOGGER.info("Tracing latency of 1 in %d events from the EnvisaLink.", self.traceSample)
+            self.state.tracer = self.tracer
+        else:
+            _LOGGER.info("Latency tracing disabled.")
+            self.state.tracer = None
+
+        self.tracer.sampleRate = self.traceSample
+
+    # Scheduled task to reset the EVL's watchdog timer
+    # NOTE: this prevents the EnvisaLink from resetting the connection if it can't communicate with EyezON service
+    def task_watchdog_poll(self):
+        self.envisalink.send_command(EVL.CMD_POLL)
+
+    # Scheduled task to make sure the bypass zones are dumped for each partition
+    # NOTE: this is done after the intiial connection is established, but only once for each partition
+    def task_bypass_dump(self):
+
+        for partition in self.partition_nodes():
+
+            # If the zone bypass dump for the partition has not yet been performed and the partition is ready
+            if not partition.initialBypassZoneDump and partition.readyState:
+                        
+                # force a bypass zone dump through the keypad for the partition
+                self._bypassDumpPartition = partition.partitionNum
+                self.envisalink.send_command(EVL.CMD_SEND_KEYSTROKES, "%1d%s" % (partition.partitionNum, EVL.KEYS_DUMP_BYPASS_ZONES))
+                partition.initialBypassZoneDump = True
+
+                # exit the function leaving the remaining partitions for a subsequent run
+                return
+
+    # Scheduled task to report the receive buffer and memory footprint of the nodeserver
+    def task_memory_report(self):
+
+        bufferLength = 0
+        envisalink = self.envisalink
+        if envisalink is not None:
+            bufferLength += envisalink.buffer_length()
+        if self.proxy is not None:
+            bufferLength += self.proxy.buffer_length()
+
+        self.setDriver("GV15", bufferLength)
+        self.setDriver("GV16", get_memory_usage())
+        self.setDriver("GV23", self.zoneDebouncer.suppressed)
+
+    # Scheduled task to poll the EnvisaLink if nothing has been received for a while, dropping the connection if the
+    # poll isn't answered
+    def task_liveness_check(self):
+
+        envisalink = self.envisalink
+        lastReceived = envisalink.frame_time()
+        if time.monotonic() - lastReceived < _LIVENESS_IDLE_TIME:
+            return
+
+        # the response is handled on the sender thread, so drop the connection from the timer wheel thread
+        def ackCallback(cmd, respCmd, respData):
+            if respCmd is None:
+                self.timerWheel.add(0, self.drop_connection, envisalink, lastReceived if lastReceived > 0 else None)
+
+        envisalink.send_command(EVL.CMD_POLL, ackCallback=ackCallback)
+
+    # Drop a connection to the EnvisaLink that is no longer responding and reconnect (or fail over to the next endpoint)
+    def drop_connection(self, envisalink, lostTime):
+
+        # ignore a connection that has already been lost or replaced
+        if envisalink is not self.envisalink or not envisalink.connected():
+            return
+
+        _LOGGER.warning("No response from EnvisaLink device at %s. Dropping connection...", self.activeEndpoint)
+        envisalink.shutdown()
+        self.process_disconnect(lostTime)
+
+    # Scheduled task to report the node updates held while Polyglot was unavailable
+    def task_flush_held_updates(self):
+        self.state.flush(self.poly)
 
-                # set alarm panel connected status
-                self.setDriver("GV1", 1, True, True)
+    # Scheduled task to force a zone timer dump
+    def task_zone_timer_dump(self):
 
-                # send the status polling command to the EnvisaLink device
-                # Only generates general zone status and trouble LED on keypad
-                self.envisalink.send_command(EVL.CMD_STATUS_REPORT)
+        # if the rate is adaptive, update the interval and check whether the dump should be performed
+        policy = self.zoneTimerDumpPolicy
+        if policy is not None:
+
+            armed = False
+            for partition in self.partition_nodes():
+                if partition.armedState:
+                    armed = True
+                    break
+
+            dump = policy.next_dump(armed)
+            self.scheduler.set_period("zonetimerdump", policy.interval)
+            self.report_zone_timer_dump_rate(policy.interval, policy.mode)
+
+            if not dump:
+                return
+
+        self.envisalink.send_command(EVL.CMD_DUMP_ZONE_TIMERS)
+
+    # Shorten the adaptive zone timer dump interval when there is zone activity
+    def zone_activity(self):
+
+        policy = self.zoneTimerDumpPolicy
+        if policy is not None and policy.zone_activity():
+            self.scheduler.set_period("zonetimerdump", policy.interval)
+            self.report_zone_timer_dump_rate(policy.interval, policy.mode)
+
+    # Report the current zone timer dump interval and the reason for it
+    def report_zone_timer_dump_rate(self, interval, mode):
+        self.setDriver("GV12", int(interval))
+        self.setDriver("GV13", mode)
+
+    # Start the TPI proxy for sharing the EnvisaLink connection with other clients
+    def start_proxy(self):
+
+        self.proxy = envisalinkproxy.TPIProxy(self.password, self.proxyPort, bindAddr=self.proxyBindAddress, logger=_LOGGER)
+        try:
+            self.proxy.start()
+        except OSError as e:
+            _LOGGER.error("Unable to start TPI proxy on %s port %d: %s", self.proxyBindAddress, self.proxyPort, str(e))
+            self.addNotice({"no_proxy": "Could not start the TPI proxy on port %d. Please check the '%s' and '%s' parameters." % (self.proxyPort, _PARM_PROXY_PORT, _PARM_PROXY_BIND_ADDRESS)})
+            self.proxy = None
+
+    # Start the connection manager thread that connects (and reconnects) to the EnvisaLink device in the background
+    def start_connection_manager(self):
+
+        self._stopping = False
+        self._connectEvent.clear()
+
+        self._connectThread = threading.Thread(target=self._connection_manager, name="EVLConnect")
+        self._connectThread.daemon = True
+        self._connectThread.start()
+
+    # Connection manager - to be executed on seperate, non-blocking thread
+    # Connects immediately, then waits for a disconnect (signaled by the listener thread through the
+    # disconnect callback) and reconnects, backing off between failed attempts
+    # Also applies configuration changes from Polyglot (signaled by the MQTT thread)
+    def _connection_manager(self):
+
+        retryInterval = _CONNECT_RETRY_MIN_INTERVAL
+
+        while not self._stopping:
+
+            # apply a configuration change from Polyglot
+            if self._configChanged:
+                self._configChanged = False
+                try:
+                    self.apply_config()
+                except Exception:
+                    _LOGGER.exception("Error applying configuration change.")
+
+            # if there is no existing EnvisaLink connection, try to connect
+            if self.envisalink is None or not self.envisalink.connected():
+
+                if self.connect_envisalink():
+                    retryInterval = _CONNECT_RETRY_MIN_INTERVAL
+                    waitInterval = None
+
+                    # drop a connection that completed after the nodeserver was stopped
+                    if self._stopping:
+                        self.envisalink.shutdown()
+                else:
+                    waitInterval = retryInterval
+                    retryInterval = min(retryInterval * 2, _CONNECT_RETRY_MAX_INTERVAL)
 
             else:
-                
-                # set alarm panel connected status
-                self.setDriver("GV1", 0, True, True)
+                waitInterval = None
+
+            # wait for the retry interval (or indefinitely if connected) or until a disconnect or stop is signaled
+            self._connectEvent.wait(waitInterval)
+            self._connectEvent.clear()
 
-                # Format errors
-                _LOGGER.warning("Could not connect to EnvisaLink device at %s.", self.ip)
-                self.addNotice({"no_connect": "Could not connect to EnvisaLink device. Please check the network and configuration parameters and restart the nodeserver."})
-                self.envisalink = None              
+    # Setup the interface to the EnvisaLink device and connect (starts the listener thread)
+    def connect_envisalink(self):
+
+        # run the EnvisaLink interface in a seperate reader process if configured
+        if self.readerProcess:
+            envisalink = envisalinkprocess.EnvisaLinkProcessInterface(_LOGGER)
+        else:
+            envisalink = EVL.EnvisaLinkInterface(_LOGGER)
+        
+        _LOGGER.info("Establishing connection to EnvisaLink device...")
+
+        endpoints = list(self.endpoints)
+        if len(endpoints) > 1:
+
+            # if the last attempt failed, try the reachable endpoints fastest first, then the rest in configured order
+            # NOTE: probing opens a TCP connection to the TPI port of each endpoint, which could push another client
+            # off a single-session EnvisaLink, so the endpoints are only probed when none could be connected to
+            if self._connectFailed:
+                reachable = [addr for (addr, latency) in EVL.probe_endpoints(endpoints, logger=_LOGGER)]
+                endpoints = reachable + [addr for addr in endpoints if addr not in reachable]
+
+            # otherwise, after a lost connection, fail over to the other endpoints in configured order first
+            elif self._disconnectTime is not None and self.activeEndpoint in endpoints:
+                endpoints.remove(self.activeEndpoint)
+                endpoints.append(self.activeEndpoint)
+
+        for addr in endpoints:
+            if envisalink.connect(addr, self.password, self.dispatch_command, self.process_heartbeat, self.process_disconnect):
+                break
+        else:
+            addr = None
+
+        if addr is not None:
+
+            _LOGGER.info("Connected to EnvisaLink device at %s.", addr)
+
+            self.envisalink = envisalink
+            self.activeEndpoint = addr
+            self._connectFailed = False
+
+            # report the active endpoint and, after a lost connection, the time taken to reconnect
+            self.setDriver("GV21", self.endpoints.index(addr) + 1)
+            if self._disconnectTime is not None:
+                self.setDriver("GV22", int((time.monotonic() - self._disconnectTime) * 1000))
+                self._disconnectTime = None
+
+            # share the new connection with the TPI proxy clients
+            if self.proxy is not None:
+                self.proxy.attach(envisalink)
+
+            # clear any prior connection failure notices
+            self.removeNotice("no_connect")
+
+            # set alarm panel connected status
+            self.setDriver("GV1", 1, True, True)
+
+            # the keypad LED states are unknown until reported on the new connection
+            self.keypadLEDs = {}
+
+            # reset the zone bypass dump flags so the dumps are redone for the new connection
+            for partition in self.partition_nodes():
+                partition.initialBypassZoneDump = False
+
+            # answer the code prompts from the panel directly from the EnvisaLink interface
+            self.configure_auto_responders()
+
+            # reuse the recent results of status report and dump requests within the freshness window
+            envisalink.set_freshness_window(self.requestFreshness)
+
+            # send the status polling command to the EnvisaLink device
+            self.request_status_report()
+
+            return True
 
         else:
             
-            # make sure the bypass zones are dumped for each partition
-            # NOTE this is done in a subsequent short poll after the intiial connection is established,
-            # but only once for each partition
-            for part in range(1, self.numPartitions + 1):
-                    
-                # get the node for the partition
-                partition = self.nodes[_PART_ADDR_FORMAT_STRING % part]
+            # set alarm panel connected status
+            self.setDriver("GV1", 0, True, True)
 
-                # If the zone bypass dump for the partition has not yet been performed and the partition is ready
-                if not partition.initialBypassZoneDump and partition.readyState:
-                            
-                    # force a bypass zone dump through the keypad for the partition
-                    self.envisalink.send_command(EVL.CMD_SEND_KEYSTROKES, "%1d%s" % (partition.partitionNum, EVL.KEYS_DUMP_BYPASS_ZONES))
-                    partition.initialBypassZoneDump = True
+            # Format errors
+            _LOGGER.warning("Could not connect to EnvisaLink device at any of: %s.", ", ".join(endpoints))
+            self._connectFailed = True
+            self.addNotice({"no_connect": "Could not connect to EnvisaLink device. Please check the network and configuration parameters. The nodeserver will keep retrying."})
+            self.envisalink = None
+
+            return False
+
+    # Register the auto-responders for the code prompts from the panel with the EnvisaLink interface for the
+    # configured codes
+    def configure_auto_responders(self):
+
+        envisalink = self.envisalink
+        if envisalink is None:
+            return
+
+        for (cmd, code) in (
+            (EVL.CMD_CODE_REQD, self.userCode),
+            (EVL.CMD_MASTER_CODE_REQD, self.masterCode),
+            (EVL.CMD_INSTALLER_CODE_REQD, self.installerCode)
+        ):
+            if code:
+                envisalink.set_auto_responder(cmd, EVL.CMD_SEND_CODE, code)
+            else:
+                envisalink.remove_auto_responder(cmd)
+
+    # Get the configuration values that can be changed while running (custom parameters and poll intervals)
+    def get_config_values(self):
+        return (dict(self.poly.config["customParams"]), self.poly.config.get("shortPoll"), self.poly.config.get("longPoll"))
+
+    # Callback function for configuration updates from Polyglot (called on the MQTT thread)
+    def process_config(self, config):
+
+        # ignore the configuration until the nodeserver is started and if the configuration values haven't changed
+        if not self._started or self.get_config_values() == self._appliedConfig:
+            return
+
+        # apply the configuration on the connection manager thread rather than blocking the MQTT thread, since
+        # restarting the history writer, the TPI proxy, or the EnvisaLink connection can take several seconds
+        _LOGGER.info("Configuration changed. Applying new configuration...")
+        self._configChanged = True
+        self._connectEvent.set()
+
+    # Apply changes to the configuration while running - nodes are added and removed for changed counts and
+    # the maintenance tasks are reconfigured in place, without reconnecting to the EnvisaLink
+    # NOTE: called on the connection manager thread
+    def apply_config(self):
+
+        oldCounts = (self.numPartitions, self.numCmdOuts)
+        oldConnection = (self.ip, self.password)
+        oldProxy = (self.proxyPort, self.proxyBindAddress)
+        oldHistoryPath = self.historyPath
+        oldCodes = (self.userCode, self.masterCode, self.installerCode)
+        oldFreshness = self.requestFreshness
+        oldLongPoll = self.longPollInterval
+        oldBypassDump = self.bypassDumpInterval
+        oldWatchdog = (self.disableWDTimer, self.watchdogInterval)
+        oldZoneTimerDump = (self.zoneTimerDumpFlag, self.zoneTimerDumpInterval, self.longPollInterval)
+
+        # get the new parameters and add and remove nodes for changed counts
+        # NOTE: under the process lock to keep the configuration and nodes from changing while the listener thread
+        # processes a command
+        with self._processLock:
+            self.getCustomParams()
+            self._appliedConfig = self.get_config_values()
+            self.update_nodes(*oldCounts)
+
+        # reconfigure the maintenance tasks that changed
+        if self.longPollInterval != oldLongPoll:
+            self.scheduler.set_period("memory", self.longPollInterval)
+        if self.bypassDumpInterval != oldBypassDump:
+            self.scheduler.set_period("bypassdump", *self.bypassDumpInterval)
+        if (self.disableWDTimer, self.watchdogInterval) != oldWatchdog:
+            self.configure_watchdog_task()
+        if (self.zoneTimerDumpFlag, self.zoneTimerDumpInterval, self.longPollInterval) != oldZoneTimerDump:
+            self.configure_zone_timer_dump_task()
+
+        # update the auto-responders if the codes changed
+        if (self.userCode, self.masterCode, self.installerCode) != oldCodes:
+            self.configure_auto_responders()
+
+        # update the freshness window for the status report and dump requests if it changed
+        if self.requestFreshness != oldFreshness and self.envisalink is not None:
+            self.envisalink.set_freshness_window(self.requestFreshness)
+
+        # reopen the history database if the path changed
+        if self.historyPath != oldHistoryPath:
+            self.configure_history()
+
+        # change the sample rate for latency tracing
+        self.configure_tracing()
+
+        # restart the TPI proxy if the port or bind address changed (clients reconnect to the new port)
+        if (self.proxyPort, self.proxyBindAddress) != oldProxy:
+            if self.proxy is not None:
+                self.proxy.stop()
+                self.proxy = None
+            if self.proxyPort > 0:
+                self.start_proxy()
+                if self.proxy is not None and self.envisalink is not None:
+                    self.proxy.attach(self.envisalink)
+
+        # reconnect only if the address or password for the EnvisaLink changed
+        if (self.ip, self.password) != oldConnection and self.envisalink is not None:
+            _LOGGER.info("EnvisaLink address or password changed. Reconnecting...")
+            self.envisalink.shutdown()
+            self._connectEvent.set()
 
-                    # exit the function leaving the remaining partitions for a subsequent shortPoll()
-                    return
-        
-            # if connection and all partitions have had zone bypass dumps, check zone timer dump flag
-            # and force a zone timer dump
-            if self.zoneTimerDumpFlag == _ZONE_TIMER_DUMP_SHORTPOLL:
-                self.envisalink.send_command(EVL.CMD_DUMP_ZONE_TIMERS)
-             
     # Get custom configuration parameter values
     def getCustomParams(self):
 
@@ -659,6 +2456,9 @@ class AlarmPanel(polyinterface.Controller):
         # get IP address of the EnvisaLink device from custom parameters
         try:
             self.ip = customParams[_PARM_IP_ADDRESS_NAME]      
+
+            # the IP address may be a comma-seperated list of EnvisaLink endpoints in order of preference
+            self.endpoints = [addr.strip() for addr in self.ip.split(",") if addr.strip()]
         except KeyError:
             _LOGGER.error("Missing IP address for EnvisaLink device in configuration.")
 
@@ -695,16 +2495,25 @@ class AlarmPanel(polyinterface.Controller):
             customParams.update({_PARM_USER_CODE_NAME: _DEFAULT_USER_CODE})
             complete = False
 
+        # get the optional master and installer codes for answering the code prompts from the panel
+        self.masterCode = customParams.get(_PARM_MASTER_CODE, "").strip()
+        self.installerCode = customParams.get(_PARM_INSTALLER_CODE, "").strip()
+
         # get the optional number of partitions, zones, and command outputs to create nodes for
         try:
             self.numPartitions = int(customParams[_PARM_NUM_PARTITIONS_NAME])
         except (KeyError, ValueError, TypeError):
             self.numPartitions = _DEFAULT_NUM_PARTITIONS
 
-        try:
-            self.numZones = int(customParams[_PARM_NUM_ZONES_NAME])
-        except (KeyError, ValueError, TypeError):
-            self.numZones = _DEFAULT_NUM_ZONES
+        # the number of zones may be "auto" to create zone nodes only for the zones discovered from the panel traffic
+        self.zoneDiscovery = str(customParams.get(_PARM_NUM_ZONES_NAME, "")).strip().lower() == _ZONE_DISCOVERY_AUTO
+        if self.zoneDiscovery:
+            self.numZones = _MAX_ZONES
+        else:
+            try:
+                self.numZones = int(customParams[_PARM_NUM_ZONES_NAME])
+            except (KeyError, ValueError, TypeError):
+                self.numZones = _DEFAULT_NUM_ZONES
 
         try:
             self.numCmdOuts = int(customParams[_PARM_NUM_CMD_OUTS_NAME])
@@ -723,11 +2532,87 @@ class AlarmPanel(polyinterface.Controller):
         except (KeyError, ValueError, TypeError):
             self.zoneTimerDumpFlag = _DEFAULT_ZONE_TIMER_DUMP_FLAG
 
+        # get the optional port for the TPI proxy (disabled if not specified)
+        try:
+            self.proxyPort = int(customParams[_PARM_PROXY_PORT])
+        except (KeyError, ValueError, TypeError):
+            self.proxyPort = 0
+
+        # get the optional address for the TPI proxy to listen on (local clients only if not specified)
+        self.proxyBindAddress = customParams.get(_PARM_PROXY_BIND_ADDRESS, "").strip() or _DEFAULT_PROXY_BIND_ADDRESS
+
+        # get optional setting for running the EnvisaLink interface in a seperate reader process
+        try:
+            self.readerProcess = (int(customParams[_PARM_READER_PROCESS]) == 1)
+        except (KeyError, ValueError, TypeError):
+            self.readerProcess = False
+
+        if self.readerProcess and not envisalinkprocess.available():
+            _LOGGER.warning("The '%s' parameter requires Python 3.8 or later. Ignoring.", _PARM_READER_PROCESS)
+            self.readerProcess = False
+
+        # get the optional hold-off windows for debouncing zone open and closed events (disabled if not specified)
+        self.zoneDebouncer.configure(*parse_zone_windows(customParams.get(_PARM_ZONE_DEBOUNCE)))
+
+        # get the optional path of the history database ("1" for the default path, disabled if not specified or "0")
+        historyPath = customParams.get(_PARM_HISTORY_DB, "").strip()
+        if historyPath in ("", "0"):
+            self.historyPath = None
+        elif historyPath == "1":
+            self.historyPath = _DEFAULT_HISTORY_DB
+        else:
+            self.historyPath = historyPath
+
+        # get the optional window for reusing the results of status report and dump requests (disabled if not specified)
+        try:
+            self.requestFreshness = max(float(customParams[_PARM_REQUEST_FRESHNESS]), 0.0)
+        except (KeyError, ValueError, TypeError):
+            self.requestFreshness = 0.0
+
+        # get the optional sample rate for latency tracing of the events from the EnvisaLink (disabled if not specified)
+        try:
+            self.traceSample = max(int(customParams[_PARM_TRACE_SAMPLE]), 0)
+        except (KeyError, ValueError, TypeError):
+            self.traceSample = 0
+
+        # get the optional number of seconds to profile the nodeserver for at startup (disabled if not specified)
+        try:
+            self.profileSeconds = int(customParams[_PARM_PROFILE_SECONDS])
+        except (KeyError, ValueError, TypeError):
+            self.profileSeconds = 0
+
+        # get the optional intervals for the maintenance tasks - the defaults are based on the poll intervals
+        try:
+            shortPoll = int(self.poly.config["shortPoll"])
+        except (KeyError, ValueError, TypeError):
+            shortPoll = _DEFAULT_SHORT_POLL
+        try:
+            longPoll = int(self.poly.config["longPoll"])
+        except (KeyError, ValueError, TypeError):
+            longPoll = _DEFAULT_LONG_POLL
+        self.longPollInterval = longPoll
+
+        self.watchdogInterval = parse_interval(customParams.get(_PARM_WATCHDOG_INTERVAL), longPoll)
+        self.bypassDumpInterval = parse_interval(customParams.get(_PARM_BYPASS_DUMP_INTERVAL), shortPoll)
+        self.zoneTimerDumpInterval = parse_interval(customParams.get(_PARM_ZONE_TIMER_DUMP_INTERVAL), longPoll if self.zoneTimerDumpFlag == _ZONE_TIMER_DUMP_LONGPOLL else shortPoll)
+
         self.poly.saveCustomParams(customParams)
 
         return complete
 
-    # Callback function for listener thread
+    # Callback function for listener thread - processes the command in the profiling session (if active)
+    def dispatch_command(self, cmd, data):
+
+        # keep the nodes from being added or removed while the command is processed
+        with self._processLock:
+            if self.tracer.sample():
+                envisalink = self.envisalink
+                frameTime = envisalink.frame_time() if envisalink is not None else time.monotonic()
+                self.tracer.trace(frameTime, cmd, data, self.run_profiled, self.process_command, cmd, data)
+            else:
+                self.run_profiled(self.process_command, cmd, data)
+
+    # Process a command from the EnvisaLink
     def process_command(self, cmd, data):
 
         # Pass partition status commands to correct partition node
@@ -748,21 +2633,33 @@ class AlarmPanel(polyinterface.Controller):
         ):
 
             # get the partition number from the data
+            if not valid_number(data[:1]):
+                _LOGGER.warning("Invalid partition number received from EnvisaLink. Command: %s, Data: %s", cmd, data)
+                return
             partNum = int(data[:1])
 
-            # check if node for partition exists
-            for addr in self.nodes:
-                if addr == _PART_ADDR_FORMAT_STRING % partNum:
-
-                    # update the driver values of the node from the commands
-                    self.nodes[addr].update_state_values(cmd, data)
-                    break
+            # update the driver values of the partition node (if it exists) from the commands
+            partition = self.nodes.get(_PART_ADDR_FORMAT_STRING % partNum)
+            if partition is not None:
+                partition.update_state_values(cmd, data)
+
+            # a zone opening just before the partition goes not ready (or closing just before the partition goes
+            # ready) is in the partition
+            if cmd in (EVL.CMD_PARTITION_READY, EVL.CMD_PARTITION_NOT_READY) and self._lastZoneChange is not None:
+                (zoneNum, zoneCmd, changeTime) = self._lastZoneChange
+                if time.time() - changeTime <= _MEMBERSHIP_CORRELATION_WINDOW and (
+                    (cmd == EVL.CMD_PARTITION_NOT_READY and zoneCmd == EVL.CMD_ZONE_OPEN) or
+                    (cmd == EVL.CMD_PARTITION_READY and zoneCmd == EVL.CMD_ZONE_RESTORED)
+                ):
+                    self.learn_zone_partition(zoneNum, partNum)
+                self._lastZoneChange = None
 
             # if the command is partition ready for partition 1, also clear any active command output state flags
             if cmd == EVL.CMD_PARTITION_READY and partNum == 1:
-                for addr in self.nodes:
-                    if addr[:6] == _CMD_OUTPUT_ADDR_FORMAT_STRING[:6]:
-                        self.nodes[addr].clear_active_state()
+                for i in range(1, self.numCmdOuts + 1):
+                    cmdOutput = self.nodes.get(_CMD_OUTPUT_ADDR_FORMAT_STRING % i)
+                    if cmdOutput is not None:
+                        cmdOutput.clear_active_state()
         
         # Pass zone status commands to correct zone node
         elif cmd in (
@@ -773,15 +2670,58 @@ class AlarmPanel(polyinterface.Controller):
         ):
 
             # get the zone number from the data
+            if not valid_number(data[-3:]):
+                _LOGGER.warning("Invalid zone number received from EnvisaLink. Command: %s, Data: %s", cmd, data)
+                return
             zoneNum = int(data[-3:])
 
-            # check if node for zone
-            for addr in self.nodes:
-                if addr == _ZONE_ADDR_FORMAT_STRING % zoneNum:
-                    
-                    # update the driver values of the node from the commands
-                    self.nodes[addr].update_state_values(cmd, data)
-                    break
+            self.discover_zones((zoneNum,))
+
+            # zone alarms carry the partition number in the data
+            if cmd in (EVL.CMD_ZONE_ALARM, EVL.CMD_ZONE_ALARM_RESTORED) and len(data) == 4 and valid_number(data[:1]):
+                self.learn_zone_partition(zoneNum, int(data[:1]))
+
+            # zone opening and closing is debounced before updating the zone node, but zone alarms are never delayed
+            if cmd in (EVL.CMD_ZONE_OPEN, EVL.CMD_ZONE_RESTORED):
+
+                self.zoneDebouncer.process(zoneNum, cmd, data)
+
+                # zone opening and closing speeds up adaptive zone timer dumps
+                self._lastZoneChange = (zoneNum, cmd, time.time())
+                self.zone_activity()
+
+            else:
+
+                # update the driver values of the zone node (if it exists) from the commands
+                zone = self.nodes.get(_ZONE_ADDR_FORMAT_STRING % zoneNum)
+                if zone is not None:
+                    zone.update_state_values(cmd, data)
+
+        # handle zone tamper and fault commands
+        elif cmd in (
+            EVL.CMD_ZONE_TAMPER,
+            EVL.CMD_ZONE_TAMPER_RESTORED,
+            EVL.CMD_ZONE_FAULT,
+            EVL.CMD_ZONE_FAULT_RESTORED
+        ):
+
+            # get the zone number from the data
+            if not valid_number(data[-3:]):
+                _LOGGER.warning("Invalid zone number received from EnvisaLink. Command: %s, Data: %s", cmd, data)
+                return
+            zoneNum = int(data[-3:])
+            self.discover_zones((zoneNum,))
+
+            if cmd in (EVL.CMD_ZONE_TAMPER, EVL.CMD_ZONE_TAMPER_RESTORED):
+
+                # zone tampers carry the partition number in the data
+                if len(data) == 4 and valid_number(data[:1]):
+                    self.learn_zone_partition(zoneNum, int(data[:1]))
+
+                self.update_zone_trouble(zoneNum, _ZONE_TROUBLE_TAMPER, 1 if cmd == EVL.CMD_ZONE_TAMPER else 0)
+
+            else:
+                self.update_zone_trouble(zoneNum, _ZONE_TROUBLE_FAULT, 1 if cmd == EVL.CMD_ZONE_FAULT else 0)
 
         # handle panel status commands in the controller node
         elif cmd in (
@@ -813,8 +2753,28 @@ class AlarmPanel(polyinterface.Controller):
             # update the driver values of the node from the commands
             self.update_state_values(cmd, data)
 
+        # handle keypad LED state changes
+        elif cmd in (EVL.CMD_LED_STATE, EVL.CMD_LED_FLASH_STATE):
+
+            # check for a complete LED bitfield
+            try:
+                leds = int(data, base=16)
+            except ValueError:
+                leds = None
+            if len(data) != 2 or leds is None:
+                _LOGGER.warning("Invalid keypad LED state received from EnvisaLink. Data: %s", data)
+                return
+
+            # the keypad LED states are reported for partition 1 only
+            self.process_led_state(1, leds, cmd == EVL.CMD_LED_FLASH_STATE)
+
         # handle zone bypass dump
         elif cmd == EVL.CMD_BYPASSED_ZONES_DUMP:
+
+            # check for a complete 64-bit bitfield
+            if len(data) != 16 or not valid_number(data, 16):
+                _LOGGER.warning("Invalid zone bypass dump received from EnvisaLink. Data: %s", data)
+                return
             
             # resequence the hex string in the data to be a big-endian representation
             # of the 64-bit bitfield
@@ -832,14 +2792,27 @@ class AlarmPanel(polyinterface.Controller):
             # bypass status of each of the 64 zones
             bypassFlags = bin(int(beHexString, base=16))[2:].zfill(64)    
             
+            # the bypassed zones are in the partition the bypass zone dump was requested for
+            partNum = self._bypassDumpPartition
+            if partNum is not None:
+                for zoneNum in range(1, 65):
+                    if bypassFlags[-zoneNum] == "1":
+                        self.learn_zone_partition(zoneNum, partNum)
+
+            # bypassed zones exist on the panel
+            self.discover_zones([zoneNum for zoneNum in range(1, 65) if bypassFlags[-zoneNum] == "1"])
+
             # iterate through the zone nodes and set the bypass flag from the bitfield
-            for addr in self.nodes:
-                node = self.nodes[addr]
-                if node.id == "ZONE":
-                    node.set_bypass(int(bypassFlags[-node.zoneNum]))
+            for zone in self.zone_nodes():
+                zone.set_bypass(int(bypassFlags[-zone.zoneNum]))
 
         # handle zone timer dump
         elif cmd == EVL.CMD_ZONE_TIMER_DUMP:
+
+            # check for a complete set of 64 zone timers
+            if len(data) != 256 or not valid_number(data, 16):
+                _LOGGER.warning("Invalid zone timer dump received from EnvisaLink. Data: %s", data)
+                return
             
             # spilt the 256 bytes of data into 64 individual 4-byte hex values 
             zoneTimerHexValues = [data[i:i+4] for i in range(0, len(data), 4)]
@@ -850,35 +2823,87 @@ class AlarmPanel(polyinterface.Controller):
             zoneTimers = []
             for leHexString in zoneTimerHexValues:
                 beHexString = leHexString[2:] + leHexString[:2]
-                time = (int(beHexString, base=16) ^ 0xFFFF) * 5
-                zoneTimers.append(time)
+                zoneTime = (int(beHexString, base=16) ^ 0xFFFF) * 5
+                zoneTimers.append(zoneTime)
                             
-            # iterate through the zone nodes and set the bypass flag from the bitfield
-            for addr in self.nodes:
-                node = self.nodes[addr]
-                if node.id == "ZONE":
-                    node.set_timer(zoneTimers[node.zoneNum - 1])
+            # zones with activity exist on the panel
+            self.discover_zones([i+1 for i in range(len(zoneTimers)) if zoneTimers[i] < _ZONE_TIMER_INACTIVE])
+
+            # iterate through the zone nodes and set the zone timer from the list
+            for zone in self.zone_nodes():
+                zone.set_timer(zoneTimers[zone.zoneNum - 1])
                     
-        elif cmd in (EVL.CMD_COMMAND_OUTPUT_PRESSED):
+        elif cmd == EVL.CMD_COMMAND_OUTPUT_PRESSED:
             
             # get the partition and command output number from the data
+            if len(data) < 2 or not valid_number(data[:2]):
+                _LOGGER.warning("Invalid command output received from EnvisaLink. Data: %s", data)
+                return
             partNum = int(data[0:1])
             cmdOutNum = int(data[1:2])
     
             # set the active state in the corresponding command output node
-            for addr in self.nodes:
-                if addr == _CMD_OUTPUT_ADDR_FORMAT_STRING % cmdOutNum:
-                    self.nodes[addr].set_active_state()
+            cmdOutput = self.nodes.get(_CMD_OUTPUT_ADDR_FORMAT_STRING % cmdOutNum)
+            if cmdOutput is not None:
+                cmdOutput.set_active_state()
 
         # handle user code request
-        elif cmd in (EVL.CMD_CODE_REQD):
+        elif cmd in (EVL.CMD_CODE_REQD, EVL.CMD_MASTER_CODE_REQD, EVL.CMD_INSTALLER_CODE_REQD):
 
-            # send the user code
-            self.envisalink.send_command(EVL.CMD_SEND_CODE, self.userCode)
+            # the code is sent by the auto-responder registered with the EnvisaLink interface
+            _LOGGER.debug("Code requested by alarm panel. Command: %s, Data: %s", cmd.decode("ascii"), data)
 
         else:
             _LOGGER.debug("Unhandled command received from EnvisaLink. Command: %s, Data: %s", cmd.decode("ascii"), data)
     
+    # Update the cached keypad LED state for the partition and process the LEDs that changed
+    def process_led_state(self, partNum, leds, flashing):
+
+        ledState = self.keypadLEDs.get(partNum)
+        if ledState is None:
+            ledState = KeypadLEDState()
+            self.keypadLEDs[partNum] = ledState
+
+        changed = ledState.update(leds, flashing)
+        if not changed:
+            return
+
+        partition = self.nodes.get(_PART_ADDR_FORMAT_STRING % partNum)
+        if partition is not None:
+            partition.update_led_state(ledState.lit, changed)
+
+        # clear all trouble states if the trouble LED for partition 1 is turned off (steady and flashing)
+        if partNum == 1 and changed & EVL.LED_TROUBLE and not ledState.lit & EVL.LED_TROUBLE:
+            self.clear_trouble_states()
+
+    # Update the zone node from a (debounced) zone open or closed event
+    def process_zone_change(self, zoneNum, cmd, data):
+
+        zone = self.nodes.get(_ZONE_ADDR_FORMAT_STRING % zoneNum)
+        if zone is not None:
+            zone.update_state_values(cmd, data)
+
+        self.setDriver("GV23", self.zoneDebouncer.suppressed)
+
+    # Callback function for disconnect from listener thread
+    # Parameters:   lostTime - time (monotonic clock) the connection was lost, if known (defaults to now)
+    def process_disconnect(self, lostTime=None):
+
+        _LOGGER.warning("Connection to EnvisaLink device lost. Reconnecting...")
+
+        # the state may miss changes while disconnected
+        self.state.invalidate()
+
+        # time the reconnection (failover) to an EnvisaLink endpoint
+        self._disconnectTime = lostTime if lostTime is not None else time.monotonic()
+        self.setDriver("GV21", 0)
+
+        # Update the alarm panel connected status
+        self.setDriver("GV1", 0, True, True)
+
+        # wake the connection manager to reconnect
+        self._connectEvent.set()
+
     # Callback function for heartbeat
     def process_heartbeat(self):
 
@@ -910,7 +2935,18 @@ class AlarmPanel(polyinterface.Controller):
         {"driver": "GV9", "value": 0, "uom": _ISY_BOOL_UOM},
         {"driver": "GV10", "value": 0, "uom": _ISY_BOOL_UOM},
         {"driver": "GV11", "value": 0, "uom": _ISY_BOOL_UOM},
-        {"driver": "GV20", "value": 0, "uom": _ISY_INDEX_UOM}
+        {"driver": "GV12", "value": 0, "uom": _ISY_SECONDS_UOM},
+        {"driver": "GV13", "value": 0, "uom": _ISY_INDEX_UOM},
+        {"driver": "GV14", "value": 0, "uom": _ISY_BOOL_UOM},
+        {"driver": "GV15", "value": 0, "uom": _ISY_RAW_UOM},
+        {"driver": "GV16", "value": 0, "uom": _ISY_RAW_UOM},
+        {"driver": "GV17", "value": 0, "uom": _ISY_RAW_UOM},
+        {"driver": "GV18", "value": 0, "uom": _ISY_RAW_UOM},
+        {"driver": "GV19", "value": 0, "uom": _ISY_RAW_UOM},
+        {"driver": "GV20", "value": 0, "uom": _ISY_INDEX_UOM},
+        {"driver": "GV21", "value": 0, "uom": _ISY_RAW_UOM},
+        {"driver": "GV22", "value": 0, "uom": _ISY_MILLISECONDS_UOM},
+        {"driver": "GV23", "value": 0, "uom": _ISY_RAW_UOM}
     ]
 
     commands = {
@@ -919,7 +2955,9 @@ class AlarmPanel(polyinterface.Controller):
 		"PANIC_AUX": trigger_panic_aux, 
 		"PANIC_POLICE": trigger_panic_police,
         "UPDATE_PROFILE" : cmd_updateProfile,
-        "SET_LOGLEVEL": cmd_setLogLevel        
+        "SET_LOGLEVEL": cmd_setLogLevel,
+        "PROFILE": cmd_profile,
+        "TRACE_DUMP": cmd_trace_dump
     }
 
 # Main function to establish Polyglot connection
@@ -0,0 +1,401 @@
+#!/usr/bin/python3
+# Fuzz and stress harness for the TPI framing and the command dispatching of the nodeserver
+# Generates seeded random streams of split, merged, corrupted, and oversized frames and feeds them through
+# get_next_cmd_seq() into AlarmPanel.dispatch_command() of an offline nodeserver (no Polyglot or EnvisaLink
+# connection), checking that nothing raises, the receive buffer and memory stay bounded, every valid frame gets
+# through, and each frame is handled within the time budget. The throughput of the error recovery path is measured
+# with a stream of mostly bad frames.
+# Usage: envisalinkfuzz.py [--frames frames] [--seed seed] [--budget ms] [--max-growth KB]
+
+import os
+import sys
+import time
+import random
+import logging
+import tracemalloc
+import importlib.util
+import queue
+import envisalinktpi as EVL
+
+_LOGGER = logging.getLogger(__name__)
+
+_DEFAULT_FRAMES = 20000 # number of stream elements (frames and bad data) generated for each pass
+_DEFAULT_BUDGET = 2.0 # time budget for parsing and dispatching a frame (99th percentile, in milliseconds)
+_DEFAULT_MAX_GROWTH = 1024 # maximum memory growth over a repeated pass (in KB)
+_RECOVERY_VALID_INTERVAL = 10 # one valid frame for every this many elements in the recovery stream
+
+# nodeserver configuration for the offline nodeserver
+_PANEL_PARAMS = {
+    "ipaddress": "127.0.0.1",
+    "password": "user",
+    "usercode": "5555",
+    "numpartitions": "2",
+    "numzones": "64",
+    "numcmdouts": "4"
+}
+
+# maximum bytes held in the receive buffer - a maximum length frame without CR/LF plus one receive
+_MAX_BUFFER_LENGTH = EVL._MAX_FRAME_LENGTH + EVL._BUFFER_SIZE
+
+# Polyglot interface for running the nodeserver offline - messages to Polyglot are counted and discarded
+class OfflinePolyglot(object):
+
+    def __init__(self, params):
+        self.config = {"customParams": dict(params), "notices": {}, "nodes": [], "shortPoll": 30, "longPoll": 600}
+        self.connected = True
+        self.inQueue = queue.Queue() # never fed, so the controller's input thread just waits
+        self.messages = 0
+
+    def onConfig(self, callback):
+        pass
+
+    def onStop(self, callback):
+        pass
+
+    def send(self, message):
+        self.messages += 1
+
+    def addNode(self, node):
+        self.messages += 1
+
+    def delNode(self, address):
+        self.messages += 1
+
+    def addNotice(self, data):
+        self.messages += 1
+
+    def removeNotice(self, key):
+        pass
+
+    def saveCustomParams(self, data):
+        pass
+
+    def saveCustomData(self, data):
+        pass
+
+# Send side of a connection that discards the commands sent by the nodeserver
+class NullConnection(object):
+
+    def sendall(self, data):
+        pass
+
+    def fileno(self):
+        return 1
+
+    def close(self):
+        pass
+
+# Receive side of a connection that returns a prepared list of chunks, so that the timing isn't affected by the
+# sender - an empty chunk is returned (connection closed) at the end of the list
+class ChunkSource(object):
+
+    def __init__(self, chunks):
+        self._chunks = chunks
+        self._next = 0
+
+    def recv(self, size):
+
+        if self._next >= len(self._chunks):
+            return b""
+
+        chunk = self._chunks[self._next][:size]
+        self._next += 1
+        return chunk
+
+    def close(self):
+        pass
+
+# Load the nodeserver module (the file name isn't a valid module name)
+def load_nodeserver():
+
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "envisalink-poly.py")
+    spec = importlib.util.spec_from_file_location("envisalink_poly", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    # polyinterface redirects stdout and stderr to its log when imported
+    sys.stdout = sys.__stdout__
+    sys.stderr = sys.__stderr__
+
+    return module
+
+# Create an offline nodeserver with nodes for the configured partitions, zones, and command outputs
+# Returns:      tuple of AlarmPanel and the EnvisaLinkInterface holding the receive buffer
+def create_panel(nodeserver):
+
+    poly = OfflinePolyglot(_PANEL_PARAMS)
+    panel = nodeserver.AlarmPanel(poly)
+    panel._customData = {}
+    panel.getCustomParams()
+    panel.build_nodes(panel.numPartitions, panel.numCmdOuts)
+
+    # commands sent by the nodeserver (e.g., the user code for a code prompt) are discarded
+    envisalink = EVL.EnvisaLinkInterface(_LOGGER)
+    envisalink._evlConnection = NullConnection()
+    panel.envisalink = envisalink
+
+    return (panel, envisalink)
+
+# Build a frame with the two hex digit checksum and CR/LF sent by the EnvisaLink
+def build_frame(cmd, data):
+    return cmd + data + b"%02X" % (sum(cmd + data) & 0xFF) + b"\r\n"
+
+# Generate random data for a command in the format sent by the EnvisaLink
+def random_data(rand, cmd):
+
+    def digits(n):
+        return "".join(rand.choice("0123456789") for i in range(n))
+
+    def hexDigits(n):
+        return "".join(rand.choice("0123456789ABCDEF") for i in range(n))
+
+    if b"601" <= cmd <= b"610":
+        data = "%03d" % rand.randint(1, 64)
+    elif cmd == EVL.CMD_ZONE_TIMER_DUMP:
+        data = hexDigits(256)
+    elif cmd == EVL.CMD_BYPASSED_ZONES_DUMP:
+        data = hexDigits(16)
+    elif cmd in (EVL.CMD_LED_STATE, EVL.CMD_LED_FLASH_STATE, EVL.CMD_VERBOSE_TROUBLE_STATUS):
+        data = hexDigits(2)
+    elif cmd in (EVL.CMD_USER_CLOSING, EVL.CMD_USER_OPENING, EVL.CMD_SPECIAL_CLOSING, EVL.CMD_SPECIAL_OPENING):
+        data = "%1d%s" % (rand.randint(1, 8), digits(4))
+    elif cmd in (EVL.CMD_PARTITION_ARMED, EVL.CMD_COMMAND_OUTPUT_PRESSED):
+        data = "%1d%1d" % (rand.randint(1, 8), rand.randint(0, 4))
+    elif cmd == EVL.CMD_SYSTEM_ERROR:
+        data = digits(3)
+    elif b"650" <= cmd <= b"674":
+        data = "%1d" % rand.randint(1, 8)
+    else:
+        data = digits(rand.randint(0, 8))
+
+    return data.encode("ascii")
+
+# Generate a stream of frames and bad data
+# Parameters:   rand - random generator
+#               count - number of stream elements
+#               validRatio - proportion of the elements that are valid frames
+# Returns:      tuple of the stream bytes and the list of valid frames (command, data) expected to get through
+def generate_stream(rand, count, validRatio):
+
+    cmds = [value for (name, value) in vars(EVL).items() if name.startswith("CMD_") and isinstance(value, bytes)]
+    stream = bytearray()
+    expected = []
+    lostNext = False # the next element is swallowed by preceding data without CR/LF
+
+    for i in range(count):
+
+        cmd = rand.choice(cmds)
+        data = random_data(rand, cmd)
+        kind = rand.random()
+
+        # valid frame (with data in the expected format or, for a third of them, out of range numbers, the expected
+        # length of anything printable, or any length of anything printable)
+        if kind < validRatio:
+            mangle = rand.random()
+            if mangle < 0.11:
+                data = bytes(rand.choice(b"0123456789") for j in range(len(data)))
+            elif mangle < 0.22:
+                data = bytes(rand.randint(0x20, 0x7E) for j in range(len(data)))
+            elif mangle < 0.33:
+                data = bytes(rand.randint(0x20, 0x7E) for j in range(rand.randint(0, 300)))
+            stream += build_frame(cmd, data)
+            if not lostNext:
+                expected.append((cmd, data))
+            lostNext = False
+            continue
+
+        lostNext = False
+        kind = rand.randint(0, 7)
+        frame = bytearray(build_frame(cmd, data))
+
+        # corrupted: a command or data character replaced with another printable character (bad checksum)
+        if kind == 0:
+            pos = rand.randrange(len(frame) - 4)
+            frame[pos] = rand.choice([c for c in b"0123456789ABCDEF#*" if c != frame[pos]])
+
+        # corrupted: a non-printable character inserted
+        elif kind == 1:
+            frame.insert(rand.randrange(len(frame) - 2), rand.choice([c for c in range(0x20) if c not in (0x0A, 0x0D)]))
+
+        # truncated (and terminated), e.g., a partial dump
+        elif kind == 2:
+            frame = frame[:rand.randrange(len(frame) - 2)] + b"\r\n"
+
+        # non-numeric command
+        elif kind == 3:
+            frame[rand.randrange(3)] = rand.choice(b"ABCDEF#*")
+
+        # random junk line
+        elif kind == 4:
+            frame = bytearray(b"#" + bytes(rand.choice([c for c in range(256) if c not in (0x0A, 0x0D)]) for j in range(rand.randint(0, 64))) + b"\r\n")
+
+        # oversized frame (terminated)
+        elif kind == 5:
+            frame = bytearray(build_frame(cmd, b"0" * rand.randint(EVL._MAX_FRAME_LENGTH, 4 * EVL._MAX_FRAME_LENGTH)))
+
+        # oversized data without CR/LF, which swallows the next element up to its CR/LF
+        elif kind == 6:
+            frame = bytearray(b"0" * rand.randint(EVL._MAX_FRAME_LENGTH + 1, 8 * EVL._MAX_FRAME_LENGTH))
+            lostNext = True
+
+        # empty line
+        else:
+            frame = bytearray(b"\r\n")
+
+        stream += frame
+
+    return (bytes(stream), expected)
+
+# Split the stream into receive chunks - a third are a few bytes (split frames), the rest up to a full receive
+# (merged frames)
+def split_stream(rand, stream):
+
+    chunks = []
+    pos = 0
+    while pos < len(stream):
+        size = rand.randint(1, 8) if rand.random() < 0.33 else rand.randint(1, EVL._BUFFER_SIZE)
+        chunks.append(stream[pos:pos+size])
+        pos += size
+
+    return chunks
+
+# Feed the chunks through the framing and the dispatching
+# Returns:      dictionary of the results
+def run_stream(panel, envisalink, chunks):
+
+    source = ChunkSource(chunks)
+    received = []
+    times = []
+    errors = 0
+    maxBuffer = 0
+
+    while True:
+
+        startTime = time.perf_counter()
+        cmdSeq = EVL.get_next_cmd_seq(source, envisalink._msgBuffer, _LOGGER, envisalink._bad_frame)
+        if cmdSeq is None:
+            break
+
+        (cmd, data) = cmdSeq
+        try:
+            panel.dispatch_command(cmd, data.decode("ascii"))
+        except Exception:
+            errors += 1
+            _LOGGER.exception("Error dispatching command %s, data %s.", cmd, data)
+
+        times.append(time.perf_counter() - startTime)
+        received.append((cmd, data))
+        maxBuffer = max(maxBuffer, envisalink.buffer_length())
+
+    return {"received": received, "times": times, "errors": errors, "maxBuffer": maxBuffer}
+
+# Check whether the expected frames were received, in order (other frames may be received in between, e.g., a
+# truncated frame that happens to have a valid checksum)
+def received_in_order(expected, received):
+
+    remaining = iter(received)
+    return all(frame in remaining for frame in expected)
+
+# Get the percentile of a list of values
+def percentile(values, p):
+
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(len(values) * p / 100.0), len(values) - 1)]
+
+# Run the harness
+# Returns:      0 if all the checks passed, otherwise 1
+def main(argv=None):
+
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="envisalinkfuzz", description="Fuzz and stress the TPI framing and the command dispatching of the EnvisaLink nodeserver")
+    parser.add_argument("--frames", type=int, default=_DEFAULT_FRAMES, help="number of frames in each stream (default %d)" % _DEFAULT_FRAMES)
+    parser.add_argument("--seed", type=int, default=None, help="seed for the random streams (default random)")
+    parser.add_argument("--budget", type=float, default=_DEFAULT_BUDGET, help="time budget per frame in milliseconds, 99th percentile (default %g)" % _DEFAULT_BUDGET)
+    parser.add_argument("--max-growth", type=int, default=_DEFAULT_MAX_GROWTH, help="maximum memory growth in KB over a repeated stream (default %d)" % _DEFAULT_MAX_GROWTH)
+    args = parser.parse_args(argv)
+
+    seed = args.seed if args.seed is not None else random.randrange(1 << 32)
+    rand = random.Random(seed)
+
+    # the bad frames are logged as warnings - only log errors (e.g., dispatching errors)
+    logging.basicConfig(format="%(levelname)s:%(message)s")
+    _LOGGER.setLevel(logging.ERROR)
+
+    nodeserver = load_nodeserver()
+    nodeserver._LOGGER.setLevel(logging.ERROR)
+    (panel, envisalink) = create_panel(nodeserver)
+
+    print("Seed %d, %d frames per stream." % (seed, args.frames))
+    failures = []
+
+    # stress pass: mostly valid frames
+    (stream, expected) = generate_stream(rand, args.frames, 0.7)
+    chunks = split_stream(rand, stream)
+    results = run_stream(panel, envisalink, chunks)
+
+    p99 = percentile(results["times"], 99) * 1000.0
+    print("Stress: %d bytes in %d chunks, %d frames received, %d valid frames expected" % (len(stream), len(chunks), len(results["received"]), len(expected)))
+    print("  time per frame (ms): mean %.3f, 99th percentile %.3f, max %.3f" % (
+        sum(results["times"]) / max(len(results["times"]), 1) * 1000.0, p99, max(results["times"] or [0.0]) * 1000.0
+    ))
+    print("  maximum receive buffer: %d bytes, dispatching errors: %d, bad frames: %s" % (
+        results["maxBuffer"], results["errors"], ", ".join("%s %d" % (key, value) for (key, value) in sorted(envisalink.stats().items()) if key != "frames")
+    ))
+
+    if results["errors"]:
+        failures.append("%d frames raised in dispatching" % results["errors"])
+    if results["maxBuffer"] > _MAX_BUFFER_LENGTH:
+        failures.append("receive buffer reached %d bytes (limit %d)" % (results["maxBuffer"], _MAX_BUFFER_LENGTH))
+    if not received_in_order(expected, results["received"]):
+        failures.append("valid frames were lost or reordered")
+    if p99 > args.budget:
+        failures.append("99th percentile time per frame %.3f ms over the budget of %.3f ms" % (p99, args.budget))
+
+    # memory pass: the same stream again, measuring the growth over the second run (the first run brings the state
+    # of the nodeserver to the steady state)
+    tracemalloc.start()
+    run_stream(panel, envisalink, chunks)
+    baseline = tracemalloc.get_traced_memory()[0]
+    run_stream(panel, envisalink, chunks)
+    growth = (tracemalloc.get_traced_memory()[0] - baseline) // 1024
+    tracemalloc.stop()
+
+    print("Memory: %d KB growth over a repeated stream" % growth)
+    if growth > args.max_growth:
+        failures.append("memory grew by %d KB (limit %d KB)" % (growth, args.max_growth))
+
+    # recovery pass: mostly bad frames
+    (stream, expected) = generate_stream(rand, args.frames, 1.0 / _RECOVERY_VALID_INTERVAL)
+    chunks = split_stream(rand, stream)
+    statsBefore = envisalink.stats()
+    startTime = time.perf_counter()
+    results = run_stream(panel, envisalink, chunks)
+    elapsed = time.perf_counter() - startTime
+    statsAfter = envisalink.stats()
+
+    badFrames = sum(statsAfter[key] - statsBefore[key] for key in (EVL.BAD_FRAME_MALFORMED, EVL.BAD_FRAME_CHECKSUM, EVL.BAD_FRAME_OVERSIZED))
+    received = set(results["received"])
+    recovered = sum(1 for frame in expected if frame in received)
+    print("Recovery: %d bytes in %.3f s (%.1f MB/s), %d bad frames dropped (%.0f per second), %d resyncs" % (
+        len(stream), elapsed, len(stream) / elapsed / 1e6, badFrames, badFrames / elapsed, statsAfter["resyncs"] - statsBefore["resyncs"]
+    ))
+    print("  recovered %d of %d valid frames (%.1f%%)" % (recovered, len(expected), 100.0 * recovered / max(len(expected), 1)))
+
+    if results["errors"]:
+        failures.append("%d frames raised in dispatching during recovery" % results["errors"])
+    if results["maxBuffer"] > _MAX_BUFFER_LENGTH:
+        failures.append("receive buffer reached %d bytes during recovery (limit %d)" % (results["maxBuffer"], _MAX_BUFFER_LENGTH))
+    if not received_in_order(expected, results["received"]):
+        failures.append("valid frames were lost or reordered during recovery")
+
+    for failure in failures:
+        print("FAILED: %s" % failure)
+    print("PASSED" if not failures else "FAILED (seed %d)" % seed)
+
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,184 @@
+#!/usr/bin/python3
+# Local SQLite history of the zone, partition, and user state transitions reported by the nodeserver
+# Transitions are queued by the nodeserver and written in batched transactions on a background thread, along with
+# hourly rollups (number of transitions into and time spent in each state) so that occupancy and arming history
+# can be aggregated without scanning the transitions.
+
+import sys
+import time
+import sqlite3
+import logging
+import threading
+import collections
+
+_LOGGER = logging.getLogger(__name__)
+
+_BATCH_SIZE = 500 # maximum number of transitions written in a single transaction
+_FLUSH_INTERVAL = 5.0 # maximum time a transition is held before it is written (in seconds)
+_QUEUE_LIMIT = 10000 # maximum number of transitions queued for writing before further transitions are dropped
+_HOUR = 3600
+
+_SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS transitions (time REAL NOT NULL, node TEXT NOT NULL, driver TEXT NOT NULL, value)",
+    "CREATE INDEX IF NOT EXISTS transitions_node_time ON transitions (node, time)",
+    "CREATE INDEX IF NOT EXISTS transitions_time ON transitions (time)",
+    "CREATE TABLE IF NOT EXISTS hourly (hour INTEGER NOT NULL, node TEXT NOT NULL, driver TEXT NOT NULL, value, "
+    "count INTEGER NOT NULL DEFAULT 0, duration REAL NOT NULL DEFAULT 0, PRIMARY KEY (node, driver, value, hour))",
+    "CREATE INDEX IF NOT EXISTS hourly_hour ON hourly (hour)"
+)
+
+_SQL_INSERT_TRANSITION = "INSERT INTO transitions (time, node, driver, value) VALUES (?, ?, ?, ?)"
+_SQL_INSERT_HOURLY = "INSERT OR IGNORE INTO hourly (hour, node, driver, value) VALUES (?, ?, ?, ?)"
+_SQL_UPDATE_HOURLY = "UPDATE hourly SET count = count + ?, duration = duration + ? WHERE hour = ? AND node = ? AND driver = ? AND value = ?"
+_SQL_SELECT_LAST = "SELECT node, driver, value, MAX(time) FROM transitions GROUP BY node, driver" # value of the newest row
+
+# Writer for the history database
+class HistoryWriter(object):
+
+    def __init__(self, path, logger=_LOGGER):
+        self.path = path
+        self._logger = logger
+        self._queue = collections.deque()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopping = False
+        self._last = {} # (node, driver) -> (value, time) of the last transition, for the time spent in each state
+        self.dropped = 0
+
+    # Create the database tables (if needed) and start the writer thread
+    def start(self):
+
+        connection = sqlite3.connect(self.path)
+        try:
+            with connection:
+                for statement in _SCHEMA:
+                    connection.execute(statement)
+
+            # start from the last transitions in the database, so the time spent in a state across a restart is counted
+            self._last = {(node, driver): (value, timestamp) for (node, driver, value, timestamp) in connection.execute(_SQL_SELECT_LAST)}
+        finally:
+            connection.close()
+
+        self._stopping = False
+        self._thread = threading.Thread(target=self._writer, name="HistoryWriter")
+        self._thread.daemon = True
+        self._thread.start()
+
+    # Stop the writer thread after writing the queued transitions
+    def stop(self):
+
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+
+        if self._thread is not None:
+            self._thread.join(10.0)
+
+    # Queue a state transition to be written
+    def record(self, timestamp, node, driver, value):
+
+        with self._cond:
+            if len(self._queue) >= _QUEUE_LIMIT:
+                self.dropped += 1
+                return
+
+            self._queue.append((timestamp, node, driver, value))
+            if len(self._queue) >= _BATCH_SIZE:
+                self._cond.notify()
+
+    # Write the queued transitions in batches - to be executed on seperate, non-blocking thread
+    # NOTE: the connection is used only on this thread
+    def _writer(self):
+
+        connection = sqlite3.connect(self.path)
+
+        while True:
+
+            with self._cond:
+                # wait for a full batch or the flush interval
+                if not self._stopping:
+                    self._cond.wait_for(lambda: len(self._queue) >= _BATCH_SIZE or self._stopping, _FLUSH_INTERVAL)
+
+                batch = [self._queue.popleft() for i in range(min(len(self._queue), _BATCH_SIZE))]
+                stopping = self._stopping and not self._queue
+
+            if batch:
+                try:
+                    self._write_batch(connection, batch)
+                except sqlite3.Error as e:
+                    self._logger.error("Error writing %d transitions to history database: %s", len(batch), str(e))
+
+            if stopping:
+                break
+
+        connection.close()
+
+    # Write a batch of transitions and the hourly rollups in a single transaction
+    def _write_batch(self, connection, batch):
+
+        rollups = collections.defaultdict(lambda: [0, 0.0]) # (hour, node, driver, value) -> [count, duration]
+
+        for (timestamp, node, driver, value) in batch:
+
+            # add the time spent in the previous state, split across the hours
+            last = self._last.get((node, driver))
+            if last is not None:
+                (lastValue, start) = last
+                while start < timestamp:
+                    hour = int(start // _HOUR) * _HOUR
+                    end = min(hour + _HOUR, timestamp)
+                    rollups[(hour, node, driver, lastValue)][1] += end - start
+                    start = end
+
+            rollups[(int(timestamp // _HOUR) * _HOUR, node, driver, value)][0] += 1
+            self._last[(node, driver)] = (value, timestamp)
+
+        with connection:
+            connection.executemany(_SQL_INSERT_TRANSITION, batch)
+            connection.executemany(_SQL_INSERT_HOURLY, list(rollups.keys()))
+            connection.executemany(_SQL_UPDATE_HOURLY, [(count, duration) + key for (key, (count, duration)) in rollups.items()])
+
+# Get aggregates of the hourly rollups from the history database
+# Parameters:   path - path of the history database
+#               node - node address to aggregate for (or None for all nodes)
+#               since, until - start and end times (in seconds since the epoch) - rounded to the hour
+# Returns:      list of (node, driver, value, number of transitions to value, time spent in value in seconds)
+def query(path, node=None, since=None, until=None):
+
+    sql = "SELECT node, driver, value, SUM(count), SUM(duration) FROM hourly WHERE hour >= ? AND hour < ?"
+    params = [int(since // _HOUR) * _HOUR if since is not None else 0, until if until is not None else sys.maxsize]
+    if node is not None:
+        sql += " AND node = ?"
+        params.append(node)
+    sql += " GROUP BY node, driver, value ORDER BY node, driver, value"
+
+    connection = sqlite3.connect("file:%s?mode=ro" % path, uri=True)
+    try:
+        return connection.execute(sql, params).fetchall()
+    finally:
+        connection.close()
+
+# Command line interface for querying the history database
+# Usage: envisalinkhistory.py <database> [-n node] [--hours hours]
+def main(argv=None):
+
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="envisalinkhistory", description="Query the EnvisaLink nodeserver history database")
+    parser.add_argument("database", help="path of the history database")
+    parser.add_argument("-n", "--node", help="node address (e.g., zone01, partition1)")
+    parser.add_argument("--hours", type=float, default=24.0, help="number of hours back to aggregate (default 24)")
+    args = parser.parse_args(argv)
+
+    startTime = time.time()
+    rows = query(args.database, args.node, startTime - args.hours * _HOUR)
+
+    print("%-12s %-6s %-8s %8s %12s" % ("node", "driver", "value", "count", "seconds"))
+    for (node, driver, value, count, duration) in rows:
+        print("%-12s %-6s %-8s %8d %12.0f" % (node, driver, value, count, duration))
+    print("(%d rows in %.1f ms)" % (len(rows), (time.time() - startTime) * 1000))
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,622 @@
+#!/usr/bin/python3
+# Process-isolated interface for EnvisaLink 3/4 (DSC)
+# Runs the EnvisaLinkInterface (socket reads, framing, and command pacing) in a child process so that the reading of
+# the socket isn't delayed by CPU-heavy work in the nodeserver process. Events are passed to the nodeserver and
+# commands passed back to the child process through shared-memory ring buffers, with a pipe used as a doorbell to
+# signal new records.
+# NOTE: requires Python 3.8 or later for multiprocessing.shared_memory
+
+import struct
+import json
+import time
+import logging
+import threading
+import collections
+import multiprocessing
+import envisalinktpi as EVL
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
+
+_LOGGER = logging.getLogger(__name__)
+
+_RING_SIZE = 65536 # size of each ring buffer (in bytes) - well over the maximum frame length
+_RING_HEADER = struct.Struct("<II") # write offset (updated by the writer only), read offset (updated by the reader only)
+_RECORD_LENGTH = struct.Struct("<H")
+_RECORD_WRAP = 0xFFFF # record length marking that the next record is at the start of the ring
+_RING_FULL_RETRY = 0.01 # time to wait for space in a full ring (in seconds)
+
+_LOGIN_TIMEOUT = 10.0 # time for the child process to connect and login to the EnvisaLink (in seconds)
+_SHUTDOWN_TIMEOUT = 2.0 # time for the child process to exit on shutdown (in seconds)
+_STATE_INTERVAL = 5.0 # interval for the child process to report the receiver statistics (in seconds)
+
+# Record types (first byte of each record)
+# child -> nodeserver
+_REC_LOGIN = b"L" # login result: "1" or "0"
+_REC_FRAME = b"F" # event frame: receive time (monotonic clock) + command + data
+_REC_ACK = b"A" # command completion: sequence number + response command (or "---") + response data
+_REC_STATE = b"S" # receiver statistics: JSON
+_REC_LOG = b"G" # log record: level + message
+_REC_DISCONNECT = b"D" # connection to EnvisaLink lost
+# nodeserver -> child
+_REC_COMMAND = b"C" # command to send: sequence number + fresh flag ("1" or "0") + command + data
+_REC_SHUTDOWN = b"X" # shutdown the EnvisaLink connection and exit
+_REC_RESPONDER = b"R" # set auto-responder: prompt command + reply command + reply data (no reply command to remove)
+_REC_FRESHNESS = b"W" # set freshness window for idempotent requests: window in seconds
+
+_SEQ = struct.Struct("<I")
+_TIME = struct.Struct("<d")
+_NO_RESPONSE = b"---"
+
+# Check whether the process-isolated interface is supported by this Python version
+def available():
+    return shared_memory is not None
+
+# Single-producer, single-consumer ring buffer of length-prefixed records in a shared memory block
+class RingBuffer(object):
+
+    def __init__(self, shm):
+        self._shm = shm
+        self._buf = shm.buf
+        self._capacity = len(shm.buf) - _RING_HEADER.size
+
+    # Create a new ring buffer in a new shared memory block
+    @classmethod
+    def create(cls, size=_RING_SIZE):
+        shm = shared_memory.SharedMemory(create=True, size=size + _RING_HEADER.size)
+        _RING_HEADER.pack_into(shm.buf, 0, 0, 0)
+        return cls(shm)
+
+    # Attach to an existing ring buffer by the name of the shared memory block
+    # NOTE: the spawned child process shares the resource tracker of the nodeserver process, which removes the shared
+    # memory block if the nodeserver process exits without removing it
+    @classmethod
+    def attach(cls, name):
+        return cls(shared_memory.SharedMemory(name=name))
+
+    @property
+    def name(self):
+        return self._shm.name
+
+    # Write a record to the ring - returns False if there isn't enough space
+    # NOTE: the record is written before the write offset is updated, so the reader never sees a partial record
+    def put(self, record):
+
+        (head, tail) = _RING_HEADER.unpack_from(self._buf, 0)
+        size = _RECORD_LENGTH.size + len(record)
+
+        if head >= tail:
+
+            # write at the end of the ring if the record fits (without filling the ring)
+            if head + size < self._capacity or (head + size == self._capacity and tail > 0):
+                self._write(head, record)
+                newHead = (head + size) % self._capacity
+
+            # otherwise wrap to the start of the ring if there is space before the reader
+            elif size < tail:
+                if self._capacity - head >= _RECORD_LENGTH.size:
+                    _RECORD_LENGTH.pack_into(self._buf, _RING_HEADER.size + head, _RECORD_WRAP)
+                self._write(0, record)
+                newHead = size
+
+            else:
+                return False
+
+        elif head + size < tail:
+            self._write(head, record)
+            newHead = head + size
+
+        else:
+            return False
+
+        struct.pack_into("<I", self._buf, 0, newHead)
+        return True
+
+    # Read the next record from the ring - returns None if the ring is empty
+    def get(self):
+
+        (head, tail) = _RING_HEADER.unpack_from(self._buf, 0)
+        if head == tail:
+            return None
+
+        # wrap to the start of the ring if there isn't room for a record length at the end or if marked
+        if self._capacity - tail < _RECORD_LENGTH.size:
+            tail = 0
+        else:
+            (length,) = _RECORD_LENGTH.unpack_from(self._buf, _RING_HEADER.size + tail)
+            if length == _RECORD_WRAP:
+                tail = 0
+
+        (length,) = _RECORD_LENGTH.unpack_from(self._buf, _RING_HEADER.size + tail)
+        start = _RING_HEADER.size + tail + _RECORD_LENGTH.size
+        record = bytes(self._buf[start:start + length])
+
+        struct.pack_into("<I", self._buf, 4, (tail + _RECORD_LENGTH.size + length) % self._capacity)
+        return record
+
+    def _write(self, offset, record):
+        start = _RING_HEADER.size + offset
+        _RECORD_LENGTH.pack_into(self._buf, start, len(record))
+        self._buf[start + _RECORD_LENGTH.size:start + _RECORD_LENGTH.size + len(record)] = record
+
+    # Close (and optionally remove) the shared memory block
+    def close(self, unlink=False):
+
+        self._buf = None
+        self._shm.close()
+        if unlink:
+            try:
+                self._shm.unlink()
+            except FileNotFoundError:
+                pass
+
+# Writer for records from the child process to the nodeserver
+# Records are queued so the listener thread in the child process never waits on the nodeserver. A writer thread
+# moves the queued records into the ring (waiting for space if the ring is full) and rings the doorbell.
+class _RecordWriter(object):
+
+    def __init__(self, ring, doorbell):
+        self._ring = ring
+        self._doorbell = doorbell
+        self._queue = collections.deque()
+        self._cond = threading.Condition()
+        self._closed = False
+        self._thread = threading.Thread(target=self._writer, name="RingWriter")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def put(self, record):
+        with self._cond:
+            self._queue.append(record)
+            self._cond.notify()
+
+    # Write any remaining records and stop the writer thread
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join(_SHUTDOWN_TIMEOUT)
+
+    def _writer(self):
+
+        while True:
+            with self._cond:
+                while not self._queue and not self._closed:
+                    self._cond.wait()
+                if not self._queue:
+                    return
+                records = list(self._queue)
+                self._queue.clear()
+
+            for record in records:
+                while not self._ring.put(record):
+                    time.sleep(_RING_FULL_RETRY)
+
+            try:
+                self._doorbell.send_bytes(b"")
+            except OSError:
+                return # nodeserver process has gone away
+
+# Logging handler for forwarding the log records of the child process to the nodeserver
+class _RecordLogHandler(logging.Handler):
+
+    def __init__(self, writer):
+        super(_RecordLogHandler, self).__init__()
+        self._writer = writer
+
+    def emit(self, record):
+        try:
+            self._writer.put(_REC_LOG + bytes([record.levelno]) + self.format(record).encode("utf-8", "replace"))
+        except Exception:
+            self.handleError(record)
+
+# Entry point of the child process
+def _reader_process(deviceAddr, password, eventRingName, cmdRingName, eventDoorbell, cmdDoorbell, logLevel):
+
+    eventRing = RingBuffer.attach(eventRingName)
+    cmdRing = RingBuffer.attach(cmdRingName)
+    writer = _RecordWriter(eventRing, eventDoorbell)
+
+    # forward the log records to the nodeserver
+    logger = logging.getLogger("envisalinkprocess.reader")
+    logger.setLevel(logLevel)
+    logger.addHandler(_RecordLogHandler(writer))
+    logger.propagate = False
+
+    envisalink = EVL.EnvisaLinkInterface(logger)
+    disconnected = threading.Event()
+
+    # pass all event frames to the nodeserver, which does the dispatching
+    def eventListener(cmd, data):
+        writer.put(_REC_FRAME + _TIME.pack(envisalink.frame_time()) + cmd + data)
+
+    def discCallback():
+        writer.put(_REC_DISCONNECT)
+        disconnected.set()
+
+    envisalink.add_event_listener(eventListener)
+
+    if not envisalink.connect(deviceAddr, password, discCallback=discCallback):
+        writer.put(_REC_LOGIN + b"0")
+        writer.close()
+        eventRing.close()
+        cmdRing.close()
+        return
+
+    writer.put(_REC_LOGIN + b"1")
+
+    # send the commands from the nodeserver, and periodically report the receiver statistics
+    nextState = time.monotonic()
+    while not disconnected.is_set():
+
+        try:
+            if cmdDoorbell.poll(_STATE_INTERVAL / 5):
+                while cmdDoorbell.poll(0):
+                    cmdDoorbell.recv_bytes()
+        except (EOFError, OSError):
+
+            # nodeserver process has gone away
+            envisalink.shutdown()
+            break
+
+        record = cmdRing.get()
+        while record is not None:
+
+            if record[:1] == _REC_SHUTDOWN:
+                envisalink.shutdown()
+                disconnected.set()
+                break
+
+            elif record[:1] == _REC_COMMAND:
+                seq = record[1:5]
+
+                # return the response to the nodeserver with the sequence number of the command
+                def ackCallback(cmd, respCmd, respData, seq=seq):
+                    writer.put(_REC_ACK + seq + (respCmd or _NO_RESPONSE) + (respData or b""))
+
+                if not envisalink.send_command(record[6:9], record[9:].decode("ascii"), ackCallback, record[5:6] == b"1"):
+                    ackCallback(record[6:9], None, None)
+
+            elif record[:1] == _REC_RESPONDER:
+                if len(record) > 4:
+                    envisalink.set_auto_responder(record[1:4], record[4:7], record[7:].decode("ascii"))
+                else:
+                    envisalink.remove_auto_responder(record[1:4])
+
+            elif record[:1] == _REC_FRESHNESS:
+                envisalink.set_freshness_window(_TIME.unpack(record[1:9])[0])
+
+            record = cmdRing.get()
+
+        if time.monotonic() >= nextState:
+            state = {"stats": envisalink.stats(), "buffer": envisalink.buffer_length()}
+            writer.put(_REC_STATE + json.dumps(state).encode("ascii"))
+            nextState = time.monotonic() + _STATE_INTERVAL
+
+    writer.close()
+    eventRing.close()
+    cmdRing.close()
+
+# Interface to the EnvisaLink running in a child process
+# Has the same interface as EnvisaLinkInterface. The callbacks are called on a reader thread in the nodeserver process.
+class EnvisaLinkProcessInterface(object):
+
+    def __init__(self, logger=_LOGGER):
+        self._logger = logger
+        self._process = None
+        self._eventRing = None
+        self._cmdRing = None
+        self._eventDoorbell = None
+        self._cmdDoorbell = None
+        self._readerThread = None
+        self._cmdLock = threading.Lock()
+        self._nextSeq = 0
+        self._ackCallbacks = {}
+        self._connected = False
+        self._busyUntil = 0.0
+        self._stats = {}
+        self._bufferLength = 0
+        self._eventListeners = []
+        self._frameTime = 0.0
+
+    # Start the child process and connect to the EnvisaLink
+    def connect(self, deviceAddr, password, cmdCallback=None, hbCallback=None, discCallback=None):
+
+        self._eventRing = RingBuffer.create()
+        self._cmdRing = RingBuffer.create()
+        (self._eventDoorbell, childEventDoorbell) = multiprocessing.Pipe(duplex=False)
+        (childCmdDoorbell, self._cmdDoorbell) = multiprocessing.Pipe(duplex=False)
+
+        # spawn (rather than fork) the child process so it doesn't inherit the threads and locks of the nodeserver
+        context = multiprocessing.get_context("spawn")
+        self._process = context.Process(
+            target=_reader_process,
+            args=(deviceAddr, password, self._eventRing.name, self._cmdRing.name, childEventDoorbell, childCmdDoorbell, self._logger.getEffectiveLevel()),
+            name="EVLReader"
+        )
+        self._process.daemon = True
+        self._process.start()
+
+        # close the child's ends of the doorbells so that the child exiting is detected
+        childEventDoorbell.close()
+        childCmdDoorbell.close()
+
+        # wait for the login result from the child process
+        deadline = time.monotonic() + _LOGIN_TIMEOUT
+        while time.monotonic() < deadline:
+
+            record = self._next_record(deadline - time.monotonic())
+            if record is None:
+                break
+
+            if record[:1] == _REC_LOG:
+                self._logger.log(record[1], record[2:].decode("utf-8", "replace"))
+
+            elif record[:1] == _REC_LOGIN:
+
+                if record[1:2] != b"1":
+                    break
+
+                self._connected = True
+                self._readerThread = threading.Thread(target=self._event_reader, args=(cmdCallback, hbCallback, discCallback), name="EVLProcessReader")
+                self._readerThread.daemon = True
+                self._readerThread.start()
+
+                return True
+
+        self._logger.error("Unable to establish connection with EnvisaLink device through reader process.")
+        self._cleanup()
+        return False
+
+    # Get the next record from the child process, waiting on the doorbell up to the timeout (in seconds)
+    # Returns None if the wait times out or the child process has exited
+    def _next_record(self, timeout):
+
+        while True:
+
+            ring = self._eventRing
+            if ring is None:
+                return None
+
+            record = ring.get()
+            if record is not None:
+                return record
+
+            try:
+                if not self._eventDoorbell.poll(timeout):
+                    return None
+                while self._eventDoorbell.poll(0):
+                    self._eventDoorbell.recv_bytes()
+            except (EOFError, OSError):
+
+                # check the ring for any remaining records written before the child process exited
+                ring = self._eventRing
+                return ring.get() if ring is not None else None
+
+    # Dispatch the records from the child process - to be executed on seperate, non-blocking thread
+    def _event_reader(self, cmdCallback, hbCallback, discCallback):
+
+        while True:
+
+            record = self._next_record(None)
+
+            # the child process exited without reporting a disconnect (e.g., crashed or was shutdown)
+            if record is None:
+                record = _REC_DISCONNECT
+
+            recType = record[:1]
+
+            if recType == _REC_FRAME:
+
+                (self._frameTime,) = _TIME.unpack(record[1:9])
+                cmd = record[9:12]
+                data = record[12:]
+
+                for listener in self._eventListeners:
+                    try:
+                        listener(cmd, data)
+                    except Exception:
+                        self._logger.exception("Error in event listener for command %s.", cmd.decode("ascii"))
+
+                if cmd == EVL.CMD_TIME_BROADCAST:
+                    if hbCallback is not None:
+                        hbCallback()
+
+                else:
+
+                    # if the partition is busy, hold off on further commands for a bit
+                    if cmd == EVL.CMD_PARTITION_IS_BUSY:
+                        self._busyUntil = time.monotonic() + EVL._BUSY_HOLDOFF
+
+                    if cmdCallback is not None:
+                        try:
+                            cmdCallback(cmd, data.decode("ascii"))
+                        except Exception:
+                            self._logger.exception("Error processing command from EnvisaLink. Command: %s, Data: %s", cmd.decode("ascii"), data.decode("ascii"))
+
+            elif recType == _REC_ACK:
+
+                (seq,) = _SEQ.unpack(record[1:5])
+                respCmd = record[5:8]
+                respData = record[8:]
+                if respCmd == _NO_RESPONSE:
+                    respCmd = None
+                else:
+                    self._frameTime = time.monotonic()
+
+                # if the keybus is busy, hold off on further commands for a bit
+                if respCmd == EVL.CMD_SYSTEM_ERROR and respData.decode("ascii") in EVL._SYS_ERROR_KEYBUS_BUSY:
+                    self._busyUntil = time.monotonic() + EVL._BUSY_HOLDOFF
+
+                with self._cmdLock:
+                    (cmd, ackCallback) = self._ackCallbacks.pop(seq, (None, None))
+                if ackCallback is not None:
+                    self._call_ack_callback(ackCallback, cmd, respCmd, respData)
+
+            elif recType == _REC_STATE:
+                state = json.loads(record[1:].decode("ascii"))
+                self._stats = state["stats"]
+                self._bufferLength = state["buffer"]
+
+            elif recType == _REC_LOG:
+                self._logger.log(record[1], record[2:].decode("utf-8", "replace"))
+
+            elif recType == _REC_DISCONNECT:
+
+                wasConnected = self._connected
+                self._cleanup()
+
+                # call disconnect callback function so the caller can reconnect right away
+                if wasConnected and discCallback is not None:
+                    discCallback()
+
+                return
+
+    def _call_ack_callback(self, ackCallback, cmd, respCmd, respData):
+        try:
+            ackCallback(cmd, respCmd, respData)
+        except Exception:
+            self._logger.exception("Error in acknowledgement callback for command %s.", cmd.decode("ascii"))
+
+    # Send a keypad macro, queueing each command with the child process as the previous one is acknowledged
+    # (see EnvisaLinkInterface.send_macro)
+    def send_macro(self, macro, doneCallback=None):
+        return EVL.MacroRunner(self, macro.compile(), doneCallback, self._logger).send_next()
+
+    # Queue command to be sent to Envisalink by the child process (see EnvisaLinkInterface.send_command)
+    def send_command(self, cmd, data="", ackCallback=None, fresh=False):
+
+        self._logger.debug("Sending command to EnvisaLink reader process: Command %s, Data %s", cmd.decode("ascii"), data)
+
+        with self._cmdLock:
+
+            if not self.connected():
+                self._logger.debug("Not connected. Send failed.")
+                return False
+
+            seq = self._nextSeq
+            self._nextSeq = (self._nextSeq + 1) & 0xFFFFFFFF
+
+            if not self._cmdRing.put(_REC_COMMAND + _SEQ.pack(seq) + (b"1" if fresh else b"0") + cmd + data.encode("ascii")):
+                self._logger.warning("Command queue to EnvisaLink reader process full. Send failed.")
+                return False
+
+            self._ackCallbacks[seq] = (cmd, ackCallback)
+
+            try:
+                self._cmdDoorbell.send_bytes(b"")
+            except OSError:
+                pass # reader thread handles the child process exiting
+
+        return True
+
+    # Register an auto-responder with the child process (see EnvisaLinkInterface.set_auto_responder)
+    def set_auto_responder(self, cmd, replyCmd, replyData=""):
+        self._send_record(_REC_RESPONDER + cmd + replyCmd + replyData.encode("ascii"))
+
+    # Remove the auto-responder for a prompt
+    def remove_auto_responder(self, cmd):
+        self._send_record(_REC_RESPONDER + cmd)
+
+    # Set the freshness window for idempotent requests in the child process (see EnvisaLinkInterface.send_command)
+    def set_freshness_window(self, window):
+        self._send_record(_REC_FRESHNESS + _TIME.pack(window))
+
+    # Send a control record to the child process
+    def _send_record(self, record):
+
+        with self._cmdLock:
+
+            if not self.connected() or not self._cmdRing.put(record):
+                self._logger.warning("Unable to send record to EnvisaLink reader process.")
+                return
+
+            try:
+                self._cmdDoorbell.send_bytes(b"")
+            except OSError:
+                pass # reader thread handles the child process exiting
+
+    # Shutdown the child process and the connection to the EnvisaLink
+    def shutdown(self):
+
+        with self._cmdLock:
+            connected = self._connected
+            self._connected = False
+            if connected:
+                self._cmdRing.put(_REC_SHUTDOWN)
+                try:
+                    self._cmdDoorbell.send_bytes(b"")
+                except OSError:
+                    pass
+
+        if self._process is not None:
+            self._process.join(_SHUTDOWN_TIMEOUT)
+            if self._process.is_alive():
+                self._process.terminate()
+
+        if self._readerThread is not None and self._readerThread is not threading.current_thread():
+            self._readerThread.join(_SHUTDOWN_TIMEOUT)
+
+        self._cleanup()
+
+    # Release the shared memory and doorbells, and fail any commands waiting on a response
+    def _cleanup(self):
+
+        with self._cmdLock:
+
+            self._connected = False
+
+            ackCallbacks = list(self._ackCallbacks.values())
+            self._ackCallbacks.clear()
+
+            if self._eventRing is not None:
+                self._eventRing.close(unlink=True)
+                self._eventRing = None
+            if self._cmdRing is not None:
+                self._cmdRing.close(unlink=True)
+                self._cmdRing = None
+            for doorbell in (self._eventDoorbell, self._cmdDoorbell):
+                if doorbell is not None:
+                    doorbell.close()
+            self._eventDoorbell = None
+            self._cmdDoorbell = None
+
+        for (cmd, ackCallback) in ackCallbacks:
+            if ackCallback is not None:
+                self._call_ack_callback(ackCallback, cmd, None, None)
+
+    # Add a listener called with the command and data (bytes) of each event from the EnvisaLink
+    def add_event_listener(self, listener):
+        self._eventListeners.append(listener)
+
+    # Remove an event listener
+    def remove_event_listener(self, listener):
+        if listener in self._eventListeners:
+            self._eventListeners.remove(listener)
+
+    # Get the receiver statistics reported by the child process
+    def stats(self):
+        return dict(self._stats)
+
+    # Get the number of bytes of partial data held in the receive buffer of the child process
+    def buffer_length(self):
+        return self._bufferLength
+
+    # Get the time (monotonic clock) the last frame was received by the child process (while an event is dispatched,
+    # its frame) or the last command response was passed back
+    # NOTE: the monotonic clock is system-wide, so the times from the child process are comparable
+    def frame_time(self):
+        return self._frameTime
+
+    # Check whether a command has been sent but not yet completed
+    def command_pending(self):
+        return len(self._ackCallbacks) > 0
+
+    # Check whether the panel has recently reported that it is busy
+    def panel_busy(self):
+        return time.monotonic() < self._busyUntil
+
+    def connected(self):
+        return self._connected and self._process is not None and self._process.is_alive()
@@ -0,0 +1,336 @@
+#!/usr/bin/python3
+# TPI multiplexing proxy for EnvisaLink 3/4 (DSC)
+# Holds the single TPI session to the EnvisaLink and allows multiple downstream clients to share it. Downstream
+# clients connect and login to the proxy as if it were the EnvisaLink.
+
+import sys
+import socket
+import logging
+import threading
+import collections
+import envisalinktpi as EVL
+
+_LOGGER = logging.getLogger(__name__)
+
+_DEFAULT_PROXY_PORT = 4025
+_DEFAULT_BIND_ADDRESS = "127.0.0.1" # local clients only - clients have full control of the panel
+
+_CLIENT_LOGIN_TIMEOUT = 10.0 # time for a downstream client to login after connecting (in seconds)
+_CLIENT_QUEUE_LIMIT = 1000 # maximum frames queued for a downstream client before it is disconnected as too slow
+
+# Commands that change the TPI session state, which are acknowledged by the proxy but not forwarded to the
+# EnvisaLink so that one client can't change the session for the others
+_SESSION_CMDS = (
+    EVL.CMD_NETWORK_LOGIN,
+    EVL.CMD_TIMESTAMP_CONTROL,
+    EVL.CMD_TIME_BROADCAST_CONTROL,
+    EVL.CMD_TEMP_BROADCAST_CONTROL
+)
+
+# Build a TPI frame for sending to a downstream client
+# Parameters:   cmd - bytes for command code
+#               data - bytes for data
+# Returns:      bytes for the command sequence with checksum and CR/LF
+def build_frame(cmd, data=b""):
+    return cmd + data + EVL.checksum(cmd + data) + b"\r\n"
+
+# Downstream client connection
+class ProxyClient(object):
+
+    def __init__(self, proxy, sock, addr, logger):
+        self._proxy = proxy
+        self._sock = sock
+        self._logger = logger
+        self._msgBuffer = bytearray()
+        self._sendQueue = collections.deque()
+        self._sendCond = threading.Condition()
+        self._closed = False
+        self.addr = addr
+        self.loggedIn = False
+
+    # Start the reader and writer threads for the client
+    def start(self):
+
+        readerThread = threading.Thread(target=self._reader, name="ProxyReader")
+        readerThread.daemon = True
+        readerThread.start()
+
+        writerThread = threading.Thread(target=self._writer, name="ProxyWriter")
+        writerThread.daemon = True
+        writerThread.start()
+
+    # Queue a frame to be sent to the client
+    # NOTE: the same frame bytes are queued for every client
+    def send_frame(self, frame):
+
+        with self._sendCond:
+            if self._closed:
+                return
+
+            # disconnect a client that can't keep up rather than holding up the other clients
+            if len(self._sendQueue) >= _CLIENT_QUEUE_LIMIT:
+                self._logger.warning("Proxy client %s not keeping up. Disconnecting.", self.addr)
+                self._sendQueue.clear()
+                self._closed = True
+            else:
+                self._sendQueue.append(frame)
+
+            self._sendCond.notify()
+
+    # Close the client connection (after any queued frames are sent)
+    def close(self):
+
+        with self._sendCond:
+            self._closed = True
+            self._sendCond.notify()
+
+    # Send queued frames to the client
+    # To be executed on seperate, non-blocking thread
+    def _writer(self):
+
+        while True:
+            with self._sendCond:
+                while not self._sendQueue and not self._closed:
+                    self._sendCond.wait()
+
+                # send any remaining frames (e.g., login failure) before closing
+                if not self._sendQueue:
+                    break
+                frame = self._sendQueue.popleft()
+
+            try:
+                self._sock.sendall(frame)
+            except OSError as e:
+                self._logger.info("Proxy client %s disconnected on send: %s", self.addr, str(e))
+                break
+
+        self._closed = True
+        self._proxy.remove_client(self)
+
+        # shutdown the socket to end the reader thread, then close
+        try:
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._sock.close()
+
+    # Login the client and then read commands from the client and pass them to the proxy
+    # To be executed on seperate, non-blocking thread
+    def _reader(self):
+
+        # disconnect the client if it hasn't logged in by the deadline, however it trickles data
+        loginTimer = threading.Timer(_CLIENT_LOGIN_TIMEOUT, self._login_timeout)
+        loginTimer.daemon = True
+        loginTimer.start()
+
+        # request the password from the client
+        self.send_frame(build_frame(EVL.CMD_LOGIN_INTERACTION, b"3"))
+
+        while True:
+
+            cmd_seq = EVL.get_next_cmd_seq(self._sock, self._msgBuffer, self._logger, self._bad_frame)
+            if cmd_seq is None:
+                break
+
+            cmd = cmd_seq[0]
+            data = cmd_seq[1]
+
+            # process the login (password is checked against the password for the EnvisaLink)
+            if not self.loggedIn:
+
+                # disconnect a client that sends anything other than the login first
+                if cmd != EVL.CMD_NETWORK_LOGIN:
+                    self._logger.warning("Proxy client %s sent command %s before login.", self.addr, cmd.decode("ascii"))
+                    self.send_frame(build_frame(EVL.CMD_SYSTEM_ERROR, b"020"))
+                    break
+
+                self.send_frame(build_frame(EVL.CMD_ACK, cmd))
+                if data.decode("ascii") != self._proxy.password[:6]:
+                    self._logger.warning("Proxy client %s failed login.", self.addr)
+                    self.send_frame(build_frame(EVL.CMD_LOGIN_INTERACTION, b"0"))
+                    break
+
+                self.send_frame(build_frame(EVL.CMD_LOGIN_INTERACTION, b"1"))
+                loginTimer.cancel()
+                self.loggedIn = True
+                self._proxy.add_client(self)
+                continue
+
+            self._proxy.forward_command(self, cmd, data)
+
+        loginTimer.cancel()
+        self.close()
+
+    # Disconnect the client if it hasn't logged in (called on the timer thread)
+    def _login_timeout(self):
+
+        if not self.loggedIn:
+            self._logger.warning("Proxy client %s didn't login within %d seconds. Disconnecting.", self.addr, _CLIENT_LOGIN_TIMEOUT)
+
+            # shutdown the socket to end the reader thread
+            try:
+                self._sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    # Answer a frame with a bad checksum from the client with a command error, as the EnvisaLink does
+    # NOTE: called on the reader thread from get_next_cmd_seq()
+    def _bad_frame(self, reason):
+
+        if reason == EVL.BAD_FRAME_CHECKSUM:
+            self.send_frame(build_frame(EVL.CMD_ERR))
+
+# Proxy for sharing a single EnvisaLink TPI session with multiple downstream clients
+# Events from the EnvisaLink are broadcast to all logged in clients. Commands from the clients are sent through the
+# paced command queue of the EnvisaLinkInterface and the response is routed back to the client that sent the command.
+class TPIProxy(object):
+
+    def __init__(self, password, port=_DEFAULT_PROXY_PORT, bindAddr=_DEFAULT_BIND_ADDRESS, logger=_LOGGER):
+        self.password = password
+        self._port = port
+        self._bindAddr = bindAddr
+        self._logger = logger
+        self._envisalink = None
+        self._serverSocket = None
+        self._clients = []
+        self._clientsLock = threading.Lock()
+
+    # Start listening for downstream clients
+    def start(self):
+
+        self._serverSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._serverSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._serverSocket.bind((self._bindAddr, self._port))
+        self._serverSocket.listen(5)
+
+        self._logger.info("TPI proxy listening on %s:%d.", self._bindAddr, self._port)
+
+        acceptThread = threading.Thread(target=self._accept, name="ProxyAccept")
+        acceptThread.daemon = True
+        acceptThread.start()
+
+    # Stop the proxy and disconnect all downstream clients
+    def stop(self):
+
+        self.attach(None)
+
+        if self._serverSocket is not None:
+            try:
+                self._serverSocket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self._serverSocket.close()
+            self._serverSocket = None
+
+        with self._clientsLock:
+            clients = list(self._clients)
+        for client in clients:
+            client.close()
+
+    # Attach the proxy to a (newly) connected EnvisaLinkInterface, or detach it if None
+    # NOTE: downstream clients stay connected while the EnvisaLink connection is reestablished
+    def attach(self, envisalink):
+
+        if self._envisalink is not None:
+            self._envisalink.remove_event_listener(self.broadcast)
+
+        self._envisalink = envisalink
+
+        if envisalink is not None:
+            envisalink.add_event_listener(self.broadcast)
+
+    # Accept connections from downstream clients
+    # To be executed on seperate, non-blocking thread
+    def _accept(self):
+
+        while True:
+            try:
+                sock, addr = self._serverSocket.accept()
+            except (OSError, AttributeError):
+                return
+
+            self._logger.info("TPI proxy client connected from %s.", addr)
+            ProxyClient(self, sock, addr, self._logger).start()
+
+    # Add a logged in client to receive broadcasts
+    def add_client(self, client):
+        with self._clientsLock:
+            self._clients.append(client)
+
+    # Remove a client from receiving broadcasts
+    def remove_client(self, client):
+        with self._clientsLock:
+            if client in self._clients:
+                self._clients.remove(client)
+
+    # Broadcast an event received from the EnvisaLink to all logged in clients (called on the listener thread)
+    def broadcast(self, cmd, data):
+
+        # build the frame once and queue the same bytes for every client
+        frame = build_frame(cmd, data)
+        with self._clientsLock:
+            for client in self._clients:
+                client.send_frame(frame)
+
+    # Forward a command from a client to the EnvisaLink and route the response back to the client
+    def forward_command(self, client, cmd, data):
+
+        # acknowledge session commands locally
+        if cmd in _SESSION_CMDS:
+            client.send_frame(build_frame(EVL.CMD_ACK, cmd))
+            return
+
+        # route the response to the client
+        def ackCallback(cmd, respCmd, respData):
+            if respCmd == EVL.CMD_ACK:
+                client.send_frame(build_frame(EVL.CMD_ACK, cmd))
+            elif respCmd is not None:
+                client.send_frame(build_frame(respCmd, respData))
+
+        # NOTE: a client request is never answered with a recent result, since the client needs the data the panel
+        # sends after the acknowledgement
+        envisalink = self._envisalink
+        if envisalink is None or not envisalink.send_command(cmd, data.decode("ascii"), ackCallback, fresh=True):
+
+            # report the keybus as not functioning if there is no EnvisaLink connection
+            client.send_frame(build_frame(EVL.CMD_SYSTEM_ERROR, b"014"))
+
+    # Get the number of logged in clients
+    def client_count(self):
+        return len(self._clients)
+
+    # Get the number of bytes of partial data held in the receive buffers of the logged in clients
+    def buffer_length(self):
+        with self._clientsLock:
+            return sum(len(client._msgBuffer) for client in self._clients)
+
+# Run the proxy standalone, holding the EnvisaLink session itself
+# Usage: envisalinkproxy.py <EnvisaLink address> <password> [port [bind address]]
+if __name__ == "__main__":
+
+    logging.basicConfig(format="%(asctime)s %(levelname)s:%(message)s", level=logging.INFO)
+
+    if len(sys.argv) < 3:
+        print("Usage: %s <EnvisaLink address> <password> [port [bind address]]" % sys.argv[0])
+        sys.exit(1)
+
+    proxy = TPIProxy(
+        sys.argv[2],
+        int(sys.argv[3]) if len(sys.argv) > 3 else _DEFAULT_PROXY_PORT,
+        sys.argv[4] if len(sys.argv) > 4 else _DEFAULT_BIND_ADDRESS
+    )
+    proxy.start()
+
+    disconnected = threading.Event()
+    try:
+        while True:
+            envisalink = EVL.EnvisaLinkInterface(_LOGGER)
+            disconnected.clear()
+            if envisalink.connect(sys.argv[1], sys.argv[2], discCallback=disconnected.set):
+                proxy.attach(envisalink)
+                disconnected.wait()
+                proxy.attach(None)
+            else:
+                disconnected.wait(10.0)
+    except KeyboardInterrupt:
+        proxy.stop()
@@ -1,14 +1,19 @@
 #!/usr/bin/python3
 # Interface to EnvisaLink 3/4 TPI (DSC)
+# Can also be run from the command line to stream panel events as JSON lines, e.g.:
+#   python3 -m envisalinktpi monitor <EnvisaLink address> <password> [--filter zone,partition]
 
+import sys
 import socket
 import logging
 import threading
+import time
+import collections
+import functools
 
-# Pickup the root logger, and add a handler for module testing if none exists
-_LOGGER = logging.getLogger()
-if not _LOGGER.hasHandlers():
-    logging.basicConfig(format='%(asctime)s %(levelname)s:%(message)s', level=logging.DEBUG)
+# Module logger (no handlers are configured on import - the command line sets up logging to stderr)
+_LOGGER = logging.getLogger(__name__)
+_LOGGER.addHandler(logging.NullHandler())
 
 # Commands to control DSC Alarm Panel
 CMD_POLL = b"000"
@@ -109,10 +114,44 @@ CMD_COMMAND_OUTPUT_PRESSED = b"912"
 CMD_MASTER_CODE_REQD = b"921"
 CMD_INSTALLER_CODE_REQD = b"922"
 
+# Command names (without the "CMD_" prefix) for each command code
+CMD_NAMES = {v: k[4:] for (k, v) in list(globals().items()) if k.startswith("CMD_")}
+
+# Command classes for filtering events
+CLASS_SYSTEM = "system"
+CLASS_LED = "led"
+CLASS_ZONE = "zone"
+CLASS_ALARM = "alarm"
+CLASS_PARTITION = "partition"
+CLASS_USER = "user"
+CLASS_TROUBLE = "trouble"
+CLASS_PROMPT = "prompt"
+
+_CMD_CLASSES = {
+    CMD_LED_STATE: CLASS_LED,
+    CMD_LED_FLASH_STATE: CLASS_LED,
+    CMD_USER_CLOSING: CLASS_USER,
+    CMD_SPECIAL_CLOSING: CLASS_USER,
+    CMD_PARTIAL_CLOSING: CLASS_USER,
+    CMD_USER_OPENING: CLASS_USER,
+    CMD_SPECIAL_OPENING: CLASS_USER,
+    CMD_COMMAND_OUTPUT_PRESSED: CLASS_PARTITION
+}
+
 # Keypad keystrokes for specific commands to be sent with CMD_SEND_KEYSTROKES
 KEYS_TOGGLE_DOOR_CHIME = "*4"
 KEYS_DUMP_BYPASS_ZONES = "*1#"
 
+# Keypad LED bits in the data for CMD_LED_STATE and CMD_LED_FLASH_STATE (partition 1 only)
+LED_READY = 0x01
+LED_ARMED = 0x02
+LED_MEMORY = 0x04
+LED_BYPASS = 0x08
+LED_TROUBLE = 0x10
+LED_PROGRAM = 0x20
+LED_FIRE = 0x40
+LED_BACKLIGHT = 0x80
+
 # Error codes returned in data for CMD_SYSTEM_ERROR command
 _SYS_ERROR_CODES = {
     "000": "No Error.",
@@ -143,8 +182,171 @@ _EVL_TCP_PORT = 4025
 _INITIAL_SOCKET_TIMEOUT = 0.5 # socket send/receive timeout for initial handshake (500ms)
 _LISTENER_SOCKET_TIMEOUT = 600 # socket receive timeout for listener (10 minutes)
 
-_msgBuffer = None
+_PROBE_TIMEOUT = 2.0 # time to wait for a TCP connection when probing EnvisaLink endpoints
+
+_SHUTDOWN_TIMEOUT = 1.0 # time to wait for the listener and sender threads to end on shutdown
+
+_ACK_TIMEOUT = 3.0 # time to wait for an acknowledgement before a sent command is no longer considered pending
+_BUSY_HOLDOFF = 5.0 # time the panel is considered busy after a partition busy or keybus busy indication
+
+# System error codes indicating the keybus is busy
+_SYS_ERROR_KEYBUS_BUSY = ("015", "016", "017", "018")
+
+_MAX_KEYSTROKES = 6 # maximum keystrokes following the partition number in the data for CMD_SEND_KEYSTROKES
+_MACRO_BUSY_RETRIES = 3 # times a macro command is resent after a keybus busy error before the macro fails
+
+# Idempotent requests that only ask the panel to report its state, and so can be merged with an identical request that
+# is already in flight (or answered with a recent result) rather than sent to the panel again
+_IDEMPOTENT_CMDS = (CMD_STATUS_REPORT, CMD_DUMP_ZONE_TIMERS)
+_IDEMPOTENT_KEYSTROKES = (KEYS_DUMP_BYPASS_ZONES,)
+
+# Commands that don't change the state reported by the idempotent requests (so don't start them fresh)
+_STATE_NEUTRAL_CMDS = (CMD_POLL, CMD_KEEP_ALIVE)
+
 _BUFFER_SIZE = 1024
+_MIN_FRAME_LENGTH = 5 # 3 digit command plus 2 character checksum
+_MAX_FRAME_LENGTH = 512 # well over the longest frame (zone timer dump: 3 digit command, 256 characters, checksum)
+
+# a burst of this many bad frames within the resync window causes the receiver to resynchronize
+_RESYNC_BAD_FRAME_COUNT = 3
+_RESYNC_WINDOW = 10.0
+
+# reasons for dropping a received frame
+BAD_FRAME_MALFORMED = "malformed"
+BAD_FRAME_CHECKSUM = "checksum"
+BAD_FRAME_OVERSIZED = "oversized"
+
+# Keypad macro - a sequence of keystrokes and API commands for the panel, built up with the methods below (which can
+# be chained) and compiled into the fewest TPI commands. Consecutive keystrokes for the same partition are combined and
+# split into CMD_SEND_KEYSTROKES commands of up to six keystrokes.
+# e.g., KeypadMacro().bypass_zones(1, [3, 7, 12]).arm_stay(1) compiles to 071 1*10307, 071 112#, 031 1
+class KeypadMacro(object):
+
+    def __init__(self):
+        self._steps = [] # list of (command, partition number for keystrokes or None, data)
+
+    # Add keystrokes for the partition
+    def keys(self, partNum, keys):
+        if keys:
+            self._steps.append((CMD_SEND_KEYSTROKES, partNum, keys))
+        return self
+
+    # Add an API command with the data string
+    def command(self, cmd, data=""):
+        self._steps.append((cmd, None, data))
+        return self
+
+    # Add keystrokes to toggle the bypass of the zones in the partition (through the keypad bypass menu)
+    def bypass_zones(self, partNum, zones):
+        if zones:
+            self.keys(partNum, "*1" + "".join("%02d" % zone for zone in sorted(set(zones))) + "#")
+        return self
+
+    # Add the command to arm the partition in Away mode
+    def arm_away(self, partNum):
+        return self.command(CMD_ARM_PARTITION, "%1d" % partNum)
+
+    # Add the command to arm the partition in Stay mode
+    def arm_stay(self, partNum):
+        return self.command(CMD_ARM_PARTITION_STAY, "%1d" % partNum)
+
+    # Add the command to arm the partition with no entry delay
+    def arm_zero_entry(self, partNum):
+        return self.command(CMD_ARM_PARTITION_NO_ENTRY_DELAY, "%1d" % partNum)
+
+    # Add the command to disarm the partition with the user code
+    def disarm(self, partNum, code):
+        return self.command(CMD_DISARM_PARTITION, "%1d%s" % (partNum, code))
+
+    # Compile the macro into a list of (command, data string) tuples
+    def compile(self):
+
+        cmds = []
+        keyPart = None
+        keyBuffer = ""
+
+        for (cmd, partNum, data) in self._steps:
+
+            # combine consecutive keystrokes for the same partition
+            if cmd == CMD_SEND_KEYSTROKES and partNum == keyPart:
+                keyBuffer += data
+                continue
+
+            cmds.extend(_split_keystrokes(keyPart, keyBuffer))
+
+            if cmd == CMD_SEND_KEYSTROKES:
+                keyPart = partNum
+                keyBuffer = data
+            else:
+                keyPart = None
+                keyBuffer = ""
+                cmds.append((cmd, data))
+
+        cmds.extend(_split_keystrokes(keyPart, keyBuffer))
+
+        return cmds
+
+# Split keystrokes for a partition into CMD_SEND_KEYSTROKES commands within the length limit
+def _split_keystrokes(partNum, keys):
+    return [(CMD_SEND_KEYSTROKES, "%1d%s" % (partNum, keys[i:i + _MAX_KEYSTROKES])) for i in range(0, len(keys), _MAX_KEYSTROKES)]
+
+# Sends the compiled commands of a keypad macro through the command queue of an EnvisaLink interface, sending each
+# command after the previous one is acknowledged and resending a command after the busy holdoff if the keybus is busy
+class MacroRunner(object):
+
+    def __init__(self, envisalink, cmds, doneCallback, logger):
+        self._envisalink = envisalink
+        self._cmds = cmds
+        self._doneCallback = doneCallback
+        self._logger = logger
+        self._index = 0
+        self._retries = 0
+
+    # Send the next command of the macro - returns False if the command could not be queued
+    def send_next(self):
+
+        if self._index >= len(self._cmds):
+            self._done(True)
+            return True
+
+        (cmd, data) = self._cmds[self._index]
+        if self._envisalink.send_command(cmd, data, self._ack):
+            return True
+
+        # the first command failing to queue is reported by send_macro() to the caller
+        if self._index > 0 or self._retries > 0:
+            self._done(False)
+        return False
+
+    # Handle the response to a macro command (called on the sender thread)
+    def _ack(self, cmd, respCmd, respData):
+
+        if respCmd == CMD_ACK:
+            self._index += 1
+            self._retries = 0
+            self.send_next()
+
+        elif respCmd == CMD_SYSTEM_ERROR and respData.decode("ascii") in _SYS_ERROR_KEYBUS_BUSY and self._retries < _MACRO_BUSY_RETRIES:
+
+            # resend the command once the busy holdoff has passed
+            self._retries += 1
+            self._logger.debug("Keybus busy. Resending macro command %s in %.0f seconds.", cmd.decode("ascii"), _BUSY_HOLDOFF)
+            timer = threading.Timer(_BUSY_HOLDOFF, self.send_next)
+            timer.daemon = True
+            timer.start()
+
+        else:
+            self._logger.warning("Keypad macro stopped at command %d of %d (%s).", self._index + 1, len(self._cmds), cmd.decode("ascii"))
+            self._done(False)
+
+    # Report the completion of the macro
+    def _done(self, success):
+
+        if self._doneCallback is not None:
+            try:
+                self._doneCallback(success, self._index, len(self._cmds))
+            except Exception:
+                self._logger.exception("Error in completion callback for keypad macro.")
 
 class EnvisaLinkInterface(object):
 
@@ -156,17 +358,37 @@ class EnvisaLinkInterface(object):
         self._listenerThread = None
         self._lastCmd = b''
         self._sendLock = threading.Lock()
+        self._cmdPending = False
+        self._busyUntil = 0.0
+        self._msgBuffer = bytearray()
+        self._badFrameTimes = []
+        self._stats = {"frames": 0, BAD_FRAME_MALFORMED: 0, BAD_FRAME_CHECKSUM: 0, BAD_FRAME_OVERSIZED: 0, "resyncs": 0, "merged": 0, "reused": 0}
+        self._senderThread = None
+        self._cmdQueue = collections.deque()
+        self._queueCond = threading.Condition()
+        self._cmdResult = None
+        self._stopSender = False
+        self._shutdown = False
+        self._eventListeners = []
+        self._autoResponders = {}
+        self._autoResponsesPending = collections.deque()
+        self._frameTime = 0.0
+        self._inFlight = {} # (command, data) of idempotent request -> list of ackCallbacks of the requesters
+        self._recentResults = {} # (command, data) of idempotent request -> (time completed, response command, data)
+        self._freshnessWindow = 0.0
 
         self._logger = logger
 
-    def connect(self, deviceAddr, password, cmdCallback=None, hbCallback=None):
+    def connect(self, deviceAddr, password, cmdCallback=None, hbCallback=None, discCallback=None):
+
+        self._shutdown = False
 
         if self._connect_evl(deviceAddr, password):
 
             self._logger.debug("Starting listener thread...")
             
             # setup thread for listener for commands from EnvisaLink with specified callback function
-            self._listenerThread = threading.Thread(target=self._command_listener, args=(cmdCallback,hbCallback,))
+            self._listenerThread = threading.Thread(target=self._command_listener, args=(cmdCallback,hbCallback,discCallback,))
             self._listenerThread.daemon = True
             try:
                 self._listenerThread.start()
@@ -174,6 +396,12 @@ class EnvisaLinkInterface(object):
                 self._logger.error("Error starting listener thread.")
                 raise
 
+            # setup thread for sending queued commands to the EnvisaLink one at a time
+            self._stopSender = False
+            self._senderThread = threading.Thread(target=self._command_sender)
+            self._senderThread.daemon = True
+            self._senderThread.start()
+
             return True
         
         else:
@@ -191,8 +419,11 @@ class EnvisaLinkInterface(object):
             self._logger.error("Unable to establish connection with EnvisaLink device.")
             return False
 
+        # initialize a new message buffer for the socket connection
+        self._msgBuffer = bytearray()
+
         # wait for password request
-        cmd_seq = get_next_cmd_seq(self._evlConnection, self._logger)
+        cmd_seq = get_next_cmd_seq(self._evlConnection, self._msgBuffer, self._logger, self._bad_frame)
         if cmd_seq is None or (cmd_seq[0] != CMD_LOGIN_INTERACTION or cmd_seq[1] != b"3"):
             self._logger.error("Invalid sequence received from EnvisaLink upon connection: %s", cmd_seq)
             self._evlConnection.close()
@@ -200,14 +431,14 @@ class EnvisaLinkInterface(object):
 
         # send password to EVL
         send_cmd(self._evlConnection, CMD_NETWORK_LOGIN, password[:6].encode("ascii"), self._logger)
-        cmd_seq = get_next_cmd_seq(self._evlConnection, self._logger)
+        cmd_seq = get_next_cmd_seq(self._evlConnection, self._msgBuffer, self._logger, self._bad_frame)
         if cmd_seq is None or (cmd_seq[0] != CMD_ACK or cmd_seq[1] != CMD_NETWORK_LOGIN):
             self._logger.error("Failure in sending password to EnvisaLink. Received sequence: %s", cmd_seq)
             self._evlConnection.close()
             return False
         
         # wait for login verification
-        cmd_seq = get_next_cmd_seq(self._evlConnection, self._logger)
+        cmd_seq = get_next_cmd_seq(self._evlConnection, self._msgBuffer, self._logger, self._bad_frame)
         if cmd_seq is None or (cmd_seq[0] != CMD_LOGIN_INTERACTION or cmd_seq[1] not in (b"0", b"1")):
             self._logger.error("Invalid sequence received from EnvisaLink on login: %s", cmd_seq)
             self._evlConnection.close()
@@ -220,7 +451,7 @@ class EnvisaLinkInterface(object):
 
         # send a command to the EnvisaLink to send time broadcasts (every 4 minutes) to be used as a keepalive
         send_cmd(self._evlConnection, CMD_TIME_BROADCAST_CONTROL, b"1", self._logger)
-        cmd_seq = get_next_cmd_seq(self._evlConnection, self._logger)
+        cmd_seq = get_next_cmd_seq(self._evlConnection, self._msgBuffer, self._logger, self._bad_frame)
         if cmd_seq is None or (cmd_seq[0] != CMD_ACK or cmd_seq[1] != CMD_TIME_BROADCAST_CONTROL):
             self._logger.error("Failure in setting time broadcasts on EnvisaLink. Received sequence: %s", cmd_seq)
             self._evlConnection.close()
@@ -233,7 +464,7 @@ class EnvisaLinkInterface(object):
 
     # Monitors the EnvisaLink for TPI commands and updates node status in the nodeserver
     # To be executed on seperate, non-blocking thread
-    def _command_listener(self, cmdCallback, hbCallback):
+    def _command_listener(self, cmdCallback, hbCallback, discCallback):
 
         self._logger.debug("In command_listener()...")
 
@@ -241,19 +472,47 @@ class EnvisaLinkInterface(object):
         while True:
 
             # get next status message
-            cmd_seq = get_next_cmd_seq(self._evlConnection, self._logger)
+            cmd_seq = get_next_cmd_seq(self._evlConnection, self._msgBuffer, self._logger, self._bad_frame)
 
             # if the cmd_seq is blank, then an error occurred (either socket error or timeout)
             # NOTE: right now we treat this as an error since the EVL should be broadcasting a time broadcast 
             # every _LISTENER_SOCKET_TIMEOUT seconds. Call function should reconnect
             if cmd_seq is None:
+
+                # the socket was shutdown to end the listener thread
+                if self._shutdown:
+                    self._logger.debug("command_listener() being shutdown.")
+                    self._stop_sender()
+                    return
+
                 self._logger.error("No data returned by EnvisaLink device. Probable connection error or timeout. Shutting down socket and listener thread.")
                 self._evlConnection.close()
+                self._stop_sender()
+
+                # call disconnect callback function so the caller can reconnect right away
+                if discCallback is not None:
+                    discCallback()
+
                 return
 
-            # extract the command and data
+            # extract the command and data and note the time the frame was received
             cmd = cmd_seq[0]
             data = cmd_seq[1]
+            self._frameTime = time.monotonic()
+            self._stats["frames"] += 1
+
+            # answer prompts that have an auto-responder right away, ahead of any queued commands
+            autoResponse = self._autoResponders.get(cmd)
+            if autoResponse is not None:
+                self._send_auto_response(*autoResponse)
+
+            # pass all event commands (other than command responses) to any event listeners
+            if self._eventListeners and cmd not in (CMD_ACK, CMD_ERR, CMD_SYSTEM_ERROR):
+                for listener in self._eventListeners:
+                    try:
+                        listener(cmd, data)
+                    except Exception:
+                        self._logger.exception("Error in event listener for command %s.", cmd.decode("ascii"))
 
             # determine action to take based on the command
             if cmd == CMD_TIME_BROADCAST:
@@ -269,24 +528,37 @@ class EnvisaLinkInterface(object):
                 # log bad checksum error
                 self._logger.warning("(%s) Bad checksum error returned. Last Command: %s", cmd.decode("ascii"), self._lastCmd.decode("ascii"))
 
+                # an error with no command pending is for an auto-response
+                if self._autoResponsesPending and not self._cmdPending:
+                    self._autoResponsesPending.popleft()
+                else:
+                    self._complete_command(cmd, data)
+
             elif cmd == CMD_SYSTEM_ERROR:
 
                 # log the system error
-                self._logger.warning("(%s) Envisalink returned system error code %s - %s.", cmd.decode("ascii"), data.decode("ascii"), _SYS_ERROR_CODES[data.decode("ascii")])            
+                self._logger.warning("(%s) Envisalink returned system error code %s - %s.", cmd.decode("ascii"), data.decode("ascii"), _SYS_ERROR_CODES.get(data.decode("ascii"), "Unknown Error."))
 
-            elif cmd == CMD_ACK:
+                # if the keybus is busy, hold off on further commands for a bit
+                if data.decode("ascii") in _SYS_ERROR_KEYBUS_BUSY:
+                    self._busyUntil = time.monotonic() + _BUSY_HOLDOFF
 
-                # if the command was CMD_TIMESTAMP_CONTROL, then the nodeserver is trying to gracefully
-                # shutdown the thread
-                if data == CMD_TIME_BROADCAST_CONTROL:
+                # an error with no command pending is for an auto-response
+                if self._autoResponsesPending and not self._cmdPending:
+                    self._autoResponsesPending.popleft()
+                else:
+                    self._complete_command(cmd, data)
 
-                    self._logger.debug("command_listener() being shutdown.")
-                    return
+            elif cmd == CMD_ACK:
+
+                # acknowledgement of an auto-response
+                if self._autoResponsesPending and data == self._autoResponsesPending[0]:
+                    self._autoResponsesPending.popleft()
 
                 # if the command being acknowledged is the last command sent, then all is well
                 elif data == self._lastCmd:
 
-                    pass
+                    self._complete_command(cmd, data)
 
                 # otherwise log an error
                 else:
@@ -295,70 +567,317 @@ class EnvisaLinkInterface(object):
             # otherwise, pass the command and data to the callback function for handling
             else:
 
+                # if the partition is busy, hold off on further commands for a bit
+                if cmd == CMD_PARTITION_IS_BUSY:
+                    self._busyUntil = time.monotonic() + _BUSY_HOLDOFF
+
                 # call status update callback function
+                # NOTE: errors in handling a command are logged and the command dropped so that a malformed
+                # command doesn't kill the listener thread
                 if not cmdCallback is None:
-                    cmdCallback(cmd, data.decode("ascii"))
+                    try:
+                        cmdCallback(cmd, data.decode("ascii"))
+                    except Exception:
+                        self._logger.exception("Error processing command from EnvisaLink. Command: %s, Data: %s", cmd.decode("ascii"), data.decode("ascii"))
 
 
-    # Send command to Envisalink - manage thread lock to prevent stepping on thread
+    # Queue command to be sent to Envisalink - commands are sent one at a time by the sender thread, waiting for
+    # each command to be acknowledged before sending the next
     # Parameters:   cmd - bytearray with 3 digit command
     #               data - data string
-    # Returns:      True if command succesful
-    def send_command(self, cmd, data=""):
+    #               ackCallback - function called with the command, response command (CMD_ACK, CMD_ERR, or
+    #               CMD_SYSTEM_ERROR, or None if no response), and response data when the command is completed
+    #               fresh - True if an idempotent request must not be answered with a recent result (e.g., when the
+    #               requester needs the data the panel sends with the response)
+    # Returns:      True if command queued succesfully
+    # NOTE: idempotent requests (status report, zone timer dump, and bypass zone dump) are merged with an identical
+    # request in flight, and all the requesters are called back with the single response. If the freshness window is
+    # set, a request completed within the window is not sent again and the ackCallback is called right away.
+    def send_command(self, cmd, data="", ackCallback=None, fresh=False):
            
         self._logger.debug("Sending command to EnvisaLink device: Command %s, Data %s", cmd.decode("ascii"), data)
 
-        # acquire the send lock
-        if self._sendLock.acquire():
+        key = request_key(cmd, data)
+        result = None
+
+        with self._queueCond:
+
+            if self._stopSender or not self.connected():
+                self._logger.debug("Not connected. Send failed.")
+                return False
+
+            if key is None:
+
+                # any other command may change the state reported by the idempotent requests
+                if cmd not in _STATE_NEUTRAL_CMDS:
+                    self._recentResults.clear()
+                self._cmdQueue.append((cmd, data, ackCallback))
+                self._queueCond.notify_all()
+
+            elif key in self._inFlight:
+
+                # merge with the identical request in flight
+                self._logger.debug("Merged command %s with identical request in flight.", cmd.decode("ascii"))
+                self._stats["merged"] += 1
+                self._inFlight[key].append(ackCallback)
+
+            else:
+
+                # reuse the result of an identical request completed within the freshness window
+                result = None if fresh else self._recentResults.get(key)
+                if result is not None and time.monotonic() - result[0] < self._freshnessWindow:
+                    self._logger.debug("Reused recent result for command %s.", cmd.decode("ascii"))
+                    self._stats["reused"] += 1
+
+                else:
+                    result = None
+                    self._inFlight[key] = [ackCallback]
+                    self._cmdQueue.append((cmd, data, functools.partial(self._complete_request, key)))
+                    self._queueCond.notify_all()
+
+        if result is not None:
+            self._call_ack_callback(ackCallback, cmd, result[1:])
+
+        return True
+
+    # Set the window (in seconds) in which the result of an idempotent request is reused rather than sending the
+    # request to the panel again (0 to always send)
+    def set_freshness_window(self, window):
+        self._freshnessWindow = window
+
+    # Complete an idempotent request and call back all the requesters merged with it (called on the sender thread)
+    def _complete_request(self, key, cmd, respCmd, respData):
 
+        with self._queueCond:
+            ackCallbacks = self._inFlight.pop(key, [])
+
+            # only an acknowledged request is reused
+            if respCmd == CMD_ACK:
+                self._recentResults[key] = (time.monotonic(), respCmd, respData)
+
+        for ackCallback in ackCallbacks:
+            self._call_ack_callback(ackCallback, cmd, (respCmd, respData) if respCmd is not None else None)
+
+    # Register an auto-responder that sends a reply to a prompt from the EnvisaLink (e.g., CMD_CODE_REQD) directly
+    # from the listener thread, ahead of any queued commands
+    # Parameters:   cmd - bytes for the prompt command
+    #               replyCmd - bytes for the reply command (e.g., CMD_SEND_CODE)
+    #               replyData - data string for the reply
+    def set_auto_responder(self, cmd, replyCmd, replyData=""):
+
+        # build the reply frame up front
+        replyData = replyData.encode("ascii")
+        self._autoResponders[cmd] = (replyCmd, replyCmd + replyData + calc_checksum(replyCmd, replyData) + b"\r\n")
+
+    # Remove the auto-responder for a prompt
+    def remove_auto_responder(self, cmd):
+        self._autoResponders.pop(cmd, None)
+
+    # Send the reply frame of an auto-responder (called on the listener thread)
+    def _send_auto_response(self, replyCmd, frame):
+
+        self._logger.debug("Sending auto-response %s to EnvisaLink.", replyCmd.decode("ascii"))
+
+        # the acknowledgement (or error) for the reply is matched before the pending command
+        self._autoResponsesPending.append(replyCmd)
+
+        with self._sendLock:
             try:
+                self._evlConnection.sendall(frame)
+            except OSError as e:
+                self._logger.error("Unable to send auto-response to EnvisaLink. Socket error: %s", str(e))
+                self._autoResponsesPending.pop()
+
+    # Send a keypad macro to the EnvisaLink - the commands are queued one at a time as each is acknowledged
+    # Parameters:   macro - KeypadMacro to send
+    #               doneCallback - function called with success (True/False), the number of commands acknowledged,
+    #               and the total number of commands when the macro completes or fails
+    # Returns:      True if the macro was started succesfully
+    def send_macro(self, macro, doneCallback=None):
+        return MacroRunner(self, macro.compile(), doneCallback, self._logger).send_next()
+
+    # Send queued commands to the EnvisaLink one at a time
+    # To be executed on seperate, non-blocking thread
+    def _command_sender(self):
+
+        self._logger.debug("In command_sender()...")
+
+        while True:
+
+            # wait for the next command in the queue
+            with self._queueCond:
+                while not self._cmdQueue and not self._stopSender:
+                    self._queueCond.wait()
+                if self._stopSender:
+                    break
+
+                cmd, data, ackCallback = self._cmdQueue.popleft()
+
+                # set the last command before sending so that a fast acknowledgement is matched
+                self._lastCmd = cmd
+                self._cmdResult = None
+                self._cmdPending = True
+
+            # send the command (manage thread lock to prevent stepping on other sends)
+            with self._sendLock:
                 send_cmd(self._evlConnection, cmd, data.encode("ascii"), self._logger)
-            except:
-                raise
-            finally:
 
-                # release the lock
-                self._sendLock.release()
+            # wait for the response from the EnvisaLink
+            with self._queueCond:
+                self._queueCond.wait_for(lambda: not self._cmdPending or self._stopSender, _ACK_TIMEOUT)
+                if self._cmdPending:
+                    self._logger.warning("No acknowledgement received from EnvisaLink for command %s.", cmd.decode("ascii"))
+                self._cmdPending = False
+                result = self._cmdResult
 
-            self._lastCmd = cmd
-            return True
-        else:
-            self._logger.debug("Cannot acquire lock. Send failed.")
-            return False
+            self._call_ack_callback(ackCallback, cmd, result)
+
+        # fail any commands left in the queue
+        with self._queueCond:
+            remaining = list(self._cmdQueue)
+            self._cmdQueue.clear()
+        for (cmd, data, ackCallback) in remaining:
+            self._call_ack_callback(ackCallback, cmd, None)
+
+    # Call the acknowledgement callback for a completed command
+    def _call_ack_callback(self, ackCallback, cmd, result):
+
+        if ackCallback is not None:
+            try:
+                if result is None:
+                    ackCallback(cmd, None, b"")
+                else:
+                    ackCallback(cmd, result[0], result[1])
+            except Exception:
+                self._logger.exception("Error in acknowledgement callback for command %s.", cmd.decode("ascii"))
+
+    # Complete the pending command with the response from the EnvisaLink (called on the listener thread)
+    def _complete_command(self, respCmd, respData):
+
+        with self._queueCond:
+            self._cmdResult = (respCmd, respData)
+            self._cmdPending = False
+            self._queueCond.notify_all()
+
+    # Stop the sender thread
+    def _stop_sender(self):
+
+        with self._queueCond:
+            self._stopSender = True
+            self._queueCond.notify_all()
+
+    # Add a listener function called (on the listener thread) with the command and data bytes of every
+    # command received from the EnvisaLink other than command responses
+    def add_event_listener(self, listener):
+        self._eventListeners.append(listener)
+
+    # Remove an event listener function
+    def remove_event_listener(self, listener):
+        if listener in self._eventListeners:
+            self._eventListeners.remove(listener)
 
     # Shutdown listener thread and connection
+    # NOTE: the socket is shutdown to wake the listener thread immediately, whatever the state of the connection
     def shutdown(self):
            
         self._logger.debug("In shutdown()...")
 
-        # acquire the send lock
-        if self._sendLock.acquire():
+        self._shutdown = True
 
-            # Send a 
+        # stop the sender thread from sending any further queued commands
+        self._stop_sender()
+
+        connection = self._evlConnection
+        if connection is None:
+            return
+
+        if self.connected():
+
+            # turn off the time broadcasts, without blocking if the connection is dead
             try:
-                send_cmd(self._evlConnection, CMD_TIME_BROADCAST_CONTROL, b"0", self._logger)
-            except:
-                raise
-            finally:
-                # release the lock
-                self._sendLock.release()
+                connection.send(CMD_TIME_BROADCAST_CONTROL + b"0" + calc_checksum(CMD_TIME_BROADCAST_CONTROL, b"0") + b"\r\n", socket.MSG_DONTWAIT)
+            except OSError:
+                pass
 
-            # give the listener thread a couple of seconds to end
-            self._listenerThread.join(2.0)
+            # shutdown the socket so that the listener thread returns from recv() (and the sender thread from any
+            # blocked send) right away
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
 
-        else:
-            self._logger.debug("Cannot acquire lock. Shutdown failed.")
+        # give the listener and sender threads a moment to end
+        for thread in (self._listenerThread, self._senderThread):
+            if thread is not None and thread is not threading.current_thread():
+                thread.join(_SHUTDOWN_TIMEOUT)
 
         # close the connection
-        self._evlConnection.close()
+        connection.close()
+
+    # Count a bad frame dropped by the receiver and resynchronize after a burst of bad frames
+    # NOTE: called on the listener thread from get_next_cmd_seq()
+    def _bad_frame(self, reason):
+
+        self._stats[reason] += 1
+
+        # keep the times of the bad frames within the resync window
+        now = time.monotonic()
+        self._badFrameTimes = [t for t in self._badFrameTimes if now - t < _RESYNC_WINDOW]
+        self._badFrameTimes.append(now)
+
+        if len(self._badFrameTimes) >= _RESYNC_BAD_FRAME_COUNT:
+
+            self._logger.warning("%d bad frames received from EnvisaLink within %d seconds. Resynchronizing...", len(self._badFrameTimes), _RESYNC_WINDOW)
+            self._stats["resyncs"] += 1
+            self._badFrameTimes = []
+
+            # the recent results no longer reflect the panel state, since frames may have been lost since
+            with self._queueCond:
+                self._recentResults.clear()
+
+            # request a status report to correct any missed states
+            # NOTE: the buffer is kept, since the bad frame has already been dropped up to its CR/LF and the rest of
+            # the buffer may hold complete, valid frames
+            self.send_command(CMD_STATUS_REPORT, fresh=True)
+
+    # Get the receiver statistics (frame count, bad frame counts, and resyncs)
+    def stats(self):
+        return dict(self._stats)
+
+    # Get the number of bytes of partial data held in the receive buffer
+    def buffer_length(self):
+        return len(self._msgBuffer)
+
+    # Get the time (monotonic clock) the last frame was received (while an event is dispatched, its frame)
+    def frame_time(self):
+        return self._frameTime
+
+    # Check whether a command is queued or has been sent but not yet acknowledged
+    def command_pending(self):
+        return self._cmdPending or len(self._cmdQueue) > 0
+
+    # Check whether the panel has recently reported that it is busy
+    def panel_busy(self):
+        return time.monotonic() < self._busyUntil
 
     # Check the state of the socket connection
     def connected(self):
-        if self._evlConnection.fileno() > 0:
+        if self._evlConnection is not None and self._evlConnection.fileno() > 0:
             return True
         else:
             return False
 
+# Get the key for merging an idempotent request with identical requests
+# Parameters:   cmd - bytes for command code
+#               data - data string
+# Returns:      tuple of command and data if the request is idempotent, otherwise None
+def request_key(cmd, data):
+
+    if cmd in _IDEMPOTENT_CMDS or (cmd == CMD_SEND_KEYSTROKES and data[1:] in _IDEMPOTENT_KEYSTROKES):
+        return (cmd, data)
+    else:
+        return None
+
 # Establish a TCP connection to device
 # Parameters:   ipAddr - IP4 address of device
 # Returns:      connected socket
@@ -366,8 +885,6 @@ def connect(ipAddr, timeout, logger):
 
     logger.debug("In connect()...")        
 
-    global _msgBuffer
-
     # Open a socket for communication with the device at the specified address
     s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     s.settimeout(timeout)
@@ -379,12 +896,36 @@ def connect(ipAddr, timeout, logger):
         return None
     except:
         raise
-    
-    # initialize a new message buffer for the socket connection
-    _msgBuffer = bytearray()
 
     return s
 
+# Probe EnvisaLink endpoints concurrently by opening (and closing) a TCP connection to the TPI port of each
+# Parameters:   addrs - list of IP addresses or hostnames of the devices
+# Returns:      list of (address, connection time in seconds) for the reachable devices, fastest first
+def probe_endpoints(addrs, timeout=_PROBE_TIMEOUT, logger=_LOGGER):
+
+    results = {}
+
+    def probe(addr):
+        startTime = time.monotonic()
+        try:
+            s = socket.create_connection((addr, _EVL_TCP_PORT), timeout)
+        except OSError as e:
+            logger.debug("Probe of EnvisaLink at %s failed: %s", addr, str(e))
+            return
+        results[addr] = time.monotonic() - startTime
+        s.close()
+
+    threads = [threading.Thread(target=probe, args=(addr,), name="EVLProbe") for addr in addrs]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join(timeout + 1.0)
+
+    # sort by connection time, keeping the configured order for equal times
+    return sorted(((addr, results[addr]) for addr in addrs if addr in results), key=lambda result: result[1])
+
 # Send a command to the device
 # Parameters:   s- socket for EVL
 #               cmd - bytes for command code
@@ -401,52 +942,103 @@ def send_cmd(s, cmd, data, logger):
 
     except socket.timeout:
         logger.error("Unable to communication with EnvisaLink - connection closed.")
-        s.close()
+        _close_socket(s)
     except socket.error as e:
         logger.error("Connection to EnvisaLink unexpectedly closed. Socket error: %s", str(e))
-        s.close()
+        _close_socket(s)
     except:
         raise
 
+# Shutdown and close a socket - the shutdown wakes the listener thread if it is blocked receiving on the socket
+def _close_socket(s):
+    try:
+        s.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+    s.close()
+
 # Gets the next full command sequence (delimited by CR/LF pair) from the device
 # Parameters:   s- socket for EVL
+#               buffer - bytearray message buffer for the socket connection (updated in place)
+#               badFrameCallback - function called with the reason when a frame is dropped
 # Returns:      tuple with command and data bytes or None if no data
-def get_next_cmd_seq(s, logger):
+def get_next_cmd_seq(s, buffer, logger, badFrameCallback=None):
 
     logger.debug("In get_next_cmd_seq()...")
 
-    global _msgBuffer
+    discarding = False
 
-    # If there is no full command sequence in the buffer, get data from the socket
-    if _msgBuffer.count(b"\r\n") == 0:
-        
-        try:
-            msg = s.recv(_BUFFER_SIZE)
-        # Note that the listener thread exits for both timeout and errors, so for now we basically
-        # handle them the same
-        except (socket.timeout, TimeoutError):
-            logger.debug("recv() timed out - no data returned.")
-            return None
-        except socket.error as e:
-            logger.error("TCP Connection to EnvisaLink unexpectedly closed. Socket error: %s", str(e))
-            s.close()
-            return None
-        except:
-            raise
-
-        if len(msg) == 0:
-            logger.error("TCP Connection to EnvisaLink closed with no error.")
+    while True:
 
-        else:
-            _msgBuffer += msg
+        # If there is no full command sequence in the buffer, get data from the socket
+        idx = buffer.find(b"\r\n")
+        if idx == -1:
+
+            # discard partial data longer than the longest frame (e.g., data without CR/LF) and skip to the next
+            # CR/LF to resynchronize - this bounds the buffer to the maximum frame length plus one receive
+            if len(buffer) > _MAX_FRAME_LENGTH:
+                if not discarding:
+                    logger.warning("Data exceeding maximum frame length received from EnvisaLink and dropped: %d bytes", len(buffer))
+                    if badFrameCallback is not None:
+                        badFrameCallback(BAD_FRAME_OVERSIZED)
+                    discarding = True
+
+                # keep a trailing CR, since the LF of the CR/LF pair may be in the next receive
+                if buffer.endswith(b"\r"):
+                    del buffer[:-1]
+                else:
+                    del buffer[:]
+            
+            try:
+                msg = s.recv(_BUFFER_SIZE)
+            # Note that the listener thread exits for both timeout and errors, so for now we basically
+            # handle them the same
+            except (socket.timeout, TimeoutError):
+                logger.debug("recv() timed out - no data returned.")
+                return None
+            except socket.error as e:
+                logger.error("TCP Connection to EnvisaLink unexpectedly closed. Socket error: %s", str(e))
+                s.close()
+                return None
+            except:
+                raise
+
+            if len(msg) == 0:
+                logger.error("TCP Connection to EnvisaLink closed with no error.")
+                return None
+
+            # append the data and keep reading until there is a full command sequence
+            buffer += msg
+            continue
 
-    # check to see if there is a command sequence in the buffer
-    idx = _msgBuffer.find(b"\r\n")
-    if idx > -1:
-        
         # extract the command sequence from the buffer
-        seq = _msgBuffer[:idx]
-        _msgBuffer = _msgBuffer[idx+2:] # skip CR/LF pair
+        seq = bytes(buffer[:idx])
+        del buffer[:idx+2] # skip CR/LF pair
+
+        # drop the remainder of discarded data and command sequences that are too long
+        if discarding:
+            discarding = False
+            continue
+
+        if len(seq) > _MAX_FRAME_LENGTH:
+            logger.warning("Data exceeding maximum frame length received from EnvisaLink and dropped: %d bytes", len(seq))
+            if badFrameCallback is not None:
+                badFrameCallback(BAD_FRAME_OVERSIZED)
+            continue
+
+        # drop malformed command sequences (too short, non-numeric command, or non-printable characters)
+        if not valid_cmd_seq(seq):
+            logger.warning("Malformed command sequence received from EnvisaLink and dropped: %s", seq)
+            if badFrameCallback is not None:
+                badFrameCallback(BAD_FRAME_MALFORMED)
+            continue
+
+        # drop command sequences with a bad checksum
+        if seq[-2:].upper() != checksum(seq[:-2]):
+            logger.warning("Command sequence with bad checksum received from EnvisaLink and dropped: %s", seq)
+            if badFrameCallback is not None:
+                badFrameCallback(BAD_FRAME_CHECKSUM)
+            continue
 
         # get the command and data from the sequence
         cmd = seq[:3]
@@ -455,29 +1047,164 @@ def get_next_cmd_seq(s, logger):
         # log the received command
         logger.debug("Command recived from EnvisaLink: Command %s, Data %s", cmd.decode("ascii"), data.decode("ascii"))
 
-        # return a tuple with the command and data (ignore checksum)
+        # return a tuple with the command and data
         return (cmd, data)
 
-    # otherwise return empty
+# Check that a command sequence (without CR/LF) is well formed
+# Parameters:   seq - bytes for command sequence
+# Returns:      True if the sequence has a numeric command and only printable ASCII characters
+def valid_cmd_seq(seq):
+
+    if len(seq) < _MIN_FRAME_LENGTH or not seq[:3].isdigit():
+        return False
+
+    for c in seq:
+        if c < 0x20 or c > 0x7E:
+            return False
+
+    return True
+
+# Get the command class of a command code
+# Parameters:   cmd - bytes for command code
+# Returns:      command class string
+def cmd_class(cmd):
+
+    if cmd in _CMD_CLASSES:
+        return _CMD_CLASSES[cmd]
+    elif cmd < b"600":
+        return CLASS_SYSTEM
+    elif cmd < b"620":
+        return CLASS_ZONE
+    elif cmd < b"650":
+        return CLASS_ALARM
+    elif cmd < b"800":
+        return CLASS_PARTITION
+    elif cmd < b"900":
+        return CLASS_TROUBLE
     else:
-        return None    
+        return CLASS_PROMPT
+
+# Decode a command received from the EnvisaLink into a dictionary of values
+# Parameters:   cmd - bytes for command code
+#               data - bytes for data
+# Returns:      dictionary with the command code, name, class, data, and any decoded values (partition,
+#               zone, user, bypassed zones, zone timers, LED bits)
+def decode_event(cmd, data):
+
+    data = data.decode("ascii")
+    cls = cmd_class(cmd)
+    event = {
+        "cmd": cmd.decode("ascii"),
+        "name": CMD_NAMES.get(cmd, "UNKNOWN"),
+        "class": cls,
+        "data": data
+    }
+
+    try:
+        if cmd in (CMD_ZONE_ALARM, CMD_ZONE_ALARM_RESTORED, CMD_ZONE_TAMPER, CMD_ZONE_TAMPER_RESTORED, CMD_ZONE_OPEN, CMD_ZONE_RESTORED):
+            if len(data) == 4:
+                event["partition"] = int(data[:1])
+            event["zone"] = int(data[-3:])
+
+        elif cmd in (CMD_ZONE_FAULT, CMD_ZONE_FAULT_RESTORED):
+            event["zone"] = int(data[-3:])
+
+        elif cmd == CMD_BYPASSED_ZONES_DUMP:
+            event["bypassed"] = [z + 1 for z in range(64) if (int(data[(z // 8) * 2:(z // 8) * 2 + 2], 16) >> (z % 8)) & 1]
+
+        elif cmd == CMD_ZONE_TIMER_DUMP:
+            event["timers"] = [(int(data[i+2:i+4] + data[i:i+2], 16) ^ 0xFFFF) * 5 for i in range(0, len(data) - 3, 4)]
+
+        elif cmd in (CMD_LED_STATE, CMD_LED_FLASH_STATE):
+            event["leds"] = int(data[-2:], 16)
+
+        elif cls == CLASS_USER:
+            event["partition"] = int(data[:1])
+            if len(data) > 1:
+                event["user"] = int(data[-4:])
+
+        elif cls == CLASS_PARTITION or cmd in (CMD_TROUBLE_LED_ON, CMD_TROUBLE_LED_OFF):
+            if data:
+                event["partition"] = int(data[:1])
+
+    except ValueError:
+        pass
+
+    return event
 
 # Calculate checksum for a TPI command
 # Parameters:   cmd - bytes for command code
 #               data - bytes for data
 # Returns:      bytes for ASCII codes for hex digits of checksum
 def calc_checksum(cmd, data):
-    
-    val = 0
+    return checksum(cmd + data)
+
+# Calculate checksum for a TPI command sequence (without checksum or CR/LF)
+# Parameters:   seq - bytes for command code and data
+# Returns:      bytes for ASCII codes for two hex digits of checksum
+def checksum(seq):
+
+    # Add up ASCII codes for all characters, mask off all bits but the last 8, and get the ASCII
+    # characters for the two digit hex value
+    return b"%02X" % (sum(seq) & 0xFF)
+
+# Stream events from the EnvisaLink to stdout as JSON lines (one JSON object per line)
+# Parameters:   deviceAddr - address of EnvisaLink device
+#               password - password for EnvisaLink device
+#               classes - list of command classes to output (or None for all)
+def monitor(deviceAddr, password, classes=None, out=sys.stdout):
+
+    import json
+
+    # write each event as a single line and flush right away for low latency
+    def write_event(cmd, data):
+        event = decode_event(cmd, data)
+        if classes is None or event["class"] in classes:
+            event["time"] = round(time.time(), 3)
+            out.write(json.dumps(event, separators=(",", ":")) + "\n")
+            out.flush()
+
+    disconnected = threading.Event()
+    while True:
+
+        envisalink = EnvisaLinkInterface(_LOGGER)
+        envisalink.add_event_listener(write_event)
+        disconnected.clear()
+
+        # reconnect after a lost connection (or failed connection attempt)
+        if envisalink.connect(deviceAddr, password, discCallback=disconnected.set):
+            disconnected.wait()
+        else:
+            disconnected.wait(10.0)
+
+# Command line interface
+def main(argv=None):
 
-    # Add up ASCII codes for command characters
-    for c in cmd:
-        val += c
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="envisalinktpi", description="Interface to EnvisaLink 3/4 TPI (DSC)")
+    parser.add_argument("-v", "--verbose", action="store_true", help="log debug messages to stderr")
+    subparsers = parser.add_subparsers(dest="command")
+    monitorParser = subparsers.add_parser("monitor", help="stream panel events to stdout as JSON lines")
+    monitorParser.add_argument("address", help="address of EnvisaLink device")
+    monitorParser.add_argument("password", help="password for EnvisaLink device")
+    monitorParser.add_argument("-f", "--filter", help="comma separated list of command classes to output (%s)" % ", ".join(
+        (CLASS_SYSTEM, CLASS_LED, CLASS_ZONE, CLASS_ALARM, CLASS_PARTITION, CLASS_USER, CLASS_TROUBLE, CLASS_PROMPT)))
+    args = parser.parse_args(argv)
+
+    if args.command != "monitor":
+        parser.print_help()
+        return 1
+
+    # log to stderr so that stdout only has events
+    logging.basicConfig(stream=sys.stderr, format="%(asctime)s %(levelname)s:%(message)s", level=logging.DEBUG if args.verbose else logging.WARNING)
+
+    try:
+        monitor(args.address, args.password, args.filter.split(",") if args.filter else None)
+    except KeyboardInterrupt:
+        pass
 
-    # Add up ASCII codes for data characters
-    for c in data:
-        val += c
+    return 0
 
-    # Mask off all bits but the last 8 and get the ASCII characters for the hex value
-    val = val & 0xFF
-    return hex(val)[2:4].upper().encode("ascii")
\ No newline at end of file
+if __name__ == "__main__":
+    sys.exit(main())